@@ -0,0 +1,379 @@
+#! /usr/bin/env python
+#
+"""
+End-to-end benchmark of JoPlot.
+
+Generate synthetic TORQUE accounting logs (see `synthlog`), then time:
+
+* the log parser of `pbslogs2sql.py`, alone;
+* the ingestion of the logs into a SQLite DB by `pbslogs2sql.py`
+  (and into the column store, with ``--columnar``);
+* the same, with ``pbslogs2sql.py --bulk-load``, from the plain and
+  from gzip-compressed logs, checking that the resulting tables are
+  the same;
+* the query, table building and HTML rendering steps of `joplot.py`
+  for daily, monthly and yearly plots over the whole history.
+
+With ``--explain``, the SQLite DB is loaded with the initial schema
+instead, and the execution plans of typical queries are printed
+before and after upgrading it to the latest schema version (see
+``pbslogs2sql.py --migrate``); the upgrade itself is timed, too.
+
+Results are printed, and written as a JSON document with ``--output``,
+so that runs on different versions can be compared: ``--compare``
+prints the ratio of each timing to the one in an earlier results file.
+"""
+__docformat__ = 'reStructuredText'
+
+
+import datetime
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+import pbslogs2sql
+import synthlog
+
+import json # Python 2.6+
+import sqlite3
+
+
+# the scopes plotted in the query benchmarks: total, all VOs, one role
+SCOPES = [
+    ('Tier-2 total', None, None),
+    ('atlas', 'atlas', None),
+    ('atlas/Role=production', 'atlas', 'production'),
+    ('cms', 'cms', None),
+    ('lhcb', 'lhcb', None),
+    ]
+
+
+def best_of(repeat, fn, *args):
+    """Call `fn(*args)` `repeat` times; return the shortest run time
+    and the value returned by the last call."""
+    best = None
+    for n in range(repeat):
+        t = time.time()
+        result = fn(*args)
+        elapsed = time.time() - t
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def version_label():
+    """Describe the version of the source tree, via `git describe`."""
+    try:
+        proc = subprocess.Popen(['git', 'describe', '--always', '--dirty'], cwd=HERE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode == 0:
+            return out.strip()
+    except OSError:
+        pass
+    return 'unknown'
+
+
+## the benchmarks
+
+def parse_files(filenames):
+    parse_line = pbslogs2sql.parse_line
+    lines = jobs = 0
+    for filename in filenames:
+        for line in open(filename, 'r'):
+            lines += 1
+            if parse_line(line) is not None:
+                jobs += 1
+    return lines, jobs
+
+def bench_parser(filenames, repeat):
+    seconds, (lines, jobs) = best_of(repeat, parse_files, filenames)
+    return { 'seconds':seconds, 'lines':lines, 'lines_per_second':lines / seconds }
+
+
+def ingest_files(writer, filenames):
+    for filename in filenames:
+        pbslogs2sql.ingest(writer, filename, rescan=True)
+    writer.flush()
+
+def bench_sqlite_ingest(filenames, path, batch_size, jobs, schema=None):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    pbslogs2sql.PARAM = '?'
+    pbslogs2sql.BINARY = sqlite3.Binary
+    db = conn.cursor()
+    pbslogs2sql.migrate(db, 'sqlite', schema)
+    conn.commit()
+    writer = pbslogs2sql.BulkWriter(conn, batch_size)
+    seconds, result = best_of(1, ingest_files, writer, filenames)
+    db.close()
+    conn.close()
+    return { 'seconds':seconds, 'jobs':jobs, 'jobs_per_second':jobs / seconds }
+
+def bench_sqlite_bulk_load(filenames, path, batch_size, jobs):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    pbslogs2sql.PARAM = '?'
+    pbslogs2sql.BINARY = sqlite3.Binary
+    db = conn.cursor()
+    pbslogs2sql.migrate(db, 'sqlite')
+    conn.commit()
+    writer = pbslogs2sql.BulkLoader(conn, 'sqlite', batch_size)
+    seconds, result = best_of(1, ingest_files, writer, filenames)
+    db.close()
+    conn.close()
+    result = { 'seconds':seconds, 'jobs':jobs, 'jobs_per_second':jobs / seconds }
+    for step, seconds in writer.timings:
+        result[step.replace(' ', '_')] = seconds
+    return result
+
+def gzip_files(filenames, directory):
+    """Write a gzip-compressed copy of each of `filenames` into
+    `directory`; return the list of new file names."""
+    import gzip
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    compressed = []
+    for filename in filenames:
+        name = os.path.join(directory, os.path.basename(filename) + '.gz')
+        output = gzip.open(name, 'wb')
+        shutil.copyfileobj(open(filename, 'rb'), output)
+        output.close()
+        compressed.append(name)
+    return compressed
+
+# tables that must have the same contents however the DB was loaded
+TABLES = ['accounting', 'accounting_daily', 'occupancy_daily', 'quantile_daily', 'catalog']
+
+def same_tables(path1, path2):
+    """Return the list of `TABLES` whose contents differ between
+    SQLite DBs `path1` and `path2`."""
+    conn = sqlite3.connect(path1)
+    db = conn.cursor()
+    db.execute("ATTACH DATABASE ? AS other", (path2,))
+    differ = []
+    for table in TABLES:
+        db.execute("SELECT COUNT(*) FROM (SELECT * FROM main.%s EXCEPT SELECT * FROM other.%s"
+                   " UNION ALL SELECT * FROM other.%s EXCEPT SELECT * FROM main.%s)"
+                   % (table, table, table, table))
+        if db.fetchone()[0] != 0:
+            differ.append(table)
+    conn.close()
+    return differ
+
+def bench_sqlite_migrate(path):
+    """Upgrade the DB schema to the latest version, printing the
+    query plans before and after."""
+    conn = sqlite3.connect(path)
+    db = conn.cursor()
+    print
+    print "Query plans with schema version %d:" % pbslogs2sql.schema_version(db)
+    pbslogs2sql.explain(db, 'sqlite')
+    t = time.time()
+    pbslogs2sql.migrate(db, 'sqlite')
+    conn.commit()
+    seconds = time.time() - t
+    print "Query plans with schema version %d:" % pbslogs2sql.schema_version(db)
+    pbslogs2sql.explain(db, 'sqlite')
+    db.close()
+    conn.close()
+    return { 'seconds':seconds }
+
+def bench_columnar_ingest(filenames, path, batch_size, jobs):
+    import colstore
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    writer = pbslogs2sql.ColumnarWriter(colstore.ColumnStore(path, create=True), batch_size)
+    seconds, result = best_of(1, ingest_files, writer, filenames)
+    return { 'seconds':seconds, 'jobs':jobs, 'jobs_per_second':jobs / seconds }
+
+
+def load_joplot(engine, db, workdir):
+    """Import `joplot.py`, configured to read from `db`."""
+    config = os.path.join(workdir, 'joplot-%s.ini' % engine)
+    output = open(config, 'w')
+    output.write('[database]\nengine=%s\ndb=%s\n' % (engine, db))
+    output.close()
+    os.environ['JOPLOT_CONFIG'] = config
+    os.environ['JOPLOT_TEMPLATE'] = os.path.join(HERE, '..', 'html', 'joplot.template.html')
+    # `joplot` reads its configuration when imported
+    sys.modules.pop('joplot', None)
+    import joplot
+    return joplot
+
+def export(joplot, y, scopes, timescale, date1, date2):
+    size = 0
+    rows = joplot.stream_table(y, scopes, timescale, date1, date2)
+    for chunk in joplot.chunked(joplot.export_json(y, scopes, rows)):
+        size += len(chunk)
+    return size
+
+def bench_queries(joplot, date1, date2, repeat):
+    """Time the steps of a `joplot.py` plot request, for each timescale."""
+    results = {}
+    y = 'walltime'
+    for timescale in ['daily', 'monthly', 'yearly']:
+        seconds, data = best_of(repeat, joplot.fetch_results,
+                                y, SCOPES, timescale, date1, date2)
+        results['%s.fetch' % timescale] = { 'seconds':seconds }
+        seconds, table = best_of(repeat, joplot.make_table, data, timescale, date1, date2)
+        results['%s.table' % timescale] = { 'seconds':seconds, 'rows':len(table) }
+        seconds, html = best_of(repeat, joplot.render, y, SCOPES, table)
+        results['%s.render' % timescale] = { 'seconds':seconds, 'bytes':len(html) }
+        if joplot.store is None:
+            seconds, size = best_of(repeat, export, joplot, y, SCOPES, timescale, date1, date2)
+            results['%s.export_json' % timescale] = { 'seconds':seconds, 'bytes':size }
+            seconds, data = best_of(repeat, joplot.fetch_results,
+                                    'walltime_p95', SCOPES, timescale, date1, date2)
+            results['%s.fetch_p95' % timescale] = { 'seconds':seconds }
+    return results
+
+
+## main
+
+def compare(results, filename):
+    """Print the ratio of each timing in `results` to the one in
+    the results file `filename`."""
+    old = json.load(open(filename, 'r'))
+    print
+    print "Compared with %s (%s):" % (old['label'], filename)
+    for name in sorted(results['results']):
+        if name not in old['results']:
+            continue
+        t0 = old['results'][name]['seconds']
+        t1 = results['results'][name]['seconds']
+        if t0 > 0:
+            ratio = t1 / t0
+            # differences below 1ms are noise
+            if abs(t1 - t0) < 0.001:
+                note = ''
+            elif ratio > 1.1:
+                note = '  SLOWER'
+            elif ratio < 0.9:
+                note = '  faster'
+            else:
+                note = ''
+            print "  %-32s %9.4fs -> %9.4fs  x%.2f%s" % (name, t0, t1, ratio, note)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-y", "--years", dest="years", type="float", default=1,
+                      help="years of history to generate (default: %default)")
+    parser.add_option("-n", "--jobs-per-day", dest="jobs_per_day", type="int", default=2000,
+                      help="number of jobs ending each day (default: %default)")
+    parser.add_option("-m", "--vo-mix", dest="vo_mix", default=synthlog.DEFAULT_VO_MIX,
+                      help="relative share of jobs of each VO (default: %default)")
+    parser.add_option("-s", "--start-date", dest="start_date", default="2009-01-01",
+                      help="date of the first log file (default: %default)")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=1000,
+                      help="batch size for pbslogs2sql.py (default: %default)")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="take the best of this many runs, except for ingestion (default: %default)")
+    parser.add_option("--columnar", dest="columnar", action="store_true", default=False,
+                      help="also benchmark the column store (needs NumPy)")
+    parser.add_option("--explain", dest="explain", action="store_true", default=False,
+                      help="load the SQLite DB with the initial schema, then upgrade it"
+                      " and print query plans before and after")
+    parser.add_option("-l", "--label", dest="label", default=None,
+                      help="name of this run in the results (default: output of `git describe`)")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="write results as JSON to this file")
+    parser.add_option("-c", "--compare", dest="compare", default=None,
+                      help="compare results with those in this JSON file")
+    parser.add_option("-w", "--workdir", dest="workdir", default=None,
+                      help="keep logs and DBs in this directory (default: a temporary one, removed at the end)")
+    (options, args) = parser.parse_args()
+
+    if options.workdir:
+        workdir = options.workdir
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix='joplot-bench.')
+    try:
+        year, month, day = [ int(x) for x in options.start_date.split('-') ]
+        start = datetime.date(year, month, day)
+        days = int(options.years * 365)
+        end = start + datetime.timedelta(days=days-1)
+        filenames = synthlog.generate(os.path.join(workdir, 'logs'), start, days,
+                                      options.jobs_per_day, options.vo_mix)
+        jobs = days * options.jobs_per_day
+
+        results = {}
+        def report(name, result):
+            results[name] = result
+            print "%-32s %9.4fs" % (name, result['seconds'])
+
+        report('parse', bench_parser(filenames, options.repeat))
+        sqlite_db = os.path.join(workdir, 'pbs.db')
+        if options.explain:
+            report('ingest.sqlite', bench_sqlite_ingest(filenames, sqlite_db,
+                                                        options.batch_size, jobs, 1))
+            report('migrate.sqlite', bench_sqlite_migrate(sqlite_db))
+        else:
+            report('ingest.sqlite', bench_sqlite_ingest(filenames, sqlite_db,
+                                                        options.batch_size, jobs))
+        if not options.explain:
+            bulk_db = os.path.join(workdir, 'pbs-bulk.db')
+            report('ingest.sqlite.bulk', bench_sqlite_bulk_load(filenames, bulk_db,
+                                                                options.batch_size, jobs))
+            differ = same_tables(sqlite_db, bulk_db)
+            if differ:
+                print "WARNING: bulk-loaded tables differ: %s" % str.join(", ", differ)
+            # compressed logs have no checkpoints, so take another path
+            # through `BulkLoader.flush`
+            bulk_db = os.path.join(workdir, 'pbs-bulk-gz.db')
+            report('ingest.sqlite.bulk_gz',
+                   bench_sqlite_bulk_load(gzip_files(filenames, os.path.join(workdir, 'logs.gz')),
+                                          bulk_db, options.batch_size, jobs))
+            differ = same_tables(sqlite_db, bulk_db)
+            if differ:
+                print "WARNING: tables bulk-loaded from compressed logs differ: %s" % str.join(", ", differ)
+        engines = [ ('sqlite', sqlite_db) ]
+        if options.columnar:
+            store = os.path.join(workdir, 'pbs.store')
+            report('ingest.columnar', bench_columnar_ingest(filenames, store, options.batch_size, jobs))
+            engines.append(('columnar', store))
+        for engine, db in engines:
+            joplot = load_joplot(engine, db, workdir)
+            queries = bench_queries(joplot, str(start), str(end), options.repeat)
+            for name in sorted(queries):
+                report('query.%s.%s' % (engine, name), queries[name])
+
+        results = {
+            'label':options.label or version_label(),
+            'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python':sys.version.split()[0],
+            'params':{
+                'years':options.years,
+                'jobs_per_day':options.jobs_per_day,
+                'vo_mix':options.vo_mix,
+                'start_date':options.start_date,
+                'batch_size':options.batch_size,
+                'repeat':options.repeat,
+                },
+            'results':results,
+            }
+        if options.output:
+            output = open(options.output, 'w')
+            json.dump(results, output, indent=1, sort_keys=True)
+            output.write('\n')
+            output.close()
+        if options.compare:
+            compare(results, options.compare)
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
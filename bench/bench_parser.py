@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+#
+"""
+Micro-benchmark of the PBS accounting log parser in `pbslogs2sql.py`.
+
+Generate a synthetic accounting log (or use the one given on the
+command line) and report how many lines per second are processed by
+the `parse_line` function, and by the `Record` class it replaced.
+No DB is involved.
+"""
+__docformat__ = 'reStructuredText'
+
+
+import os
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import pbslogs2sql
+from synthlog import write_synthetic_log
+
+
+class LegacyRecord(object):
+    """The `Record` class from `pbslogs2sql.py` before `parse_line` replaced it."""
+
+    ATTRS_TO_COLUMNS_MAP = {
+        'Exit_status':'exit_status',
+        'Resource_List.cput':'req_cputime',
+        'Resource_List.mem':'req_mem',
+        'Resource_List.pmem':None,
+        'Resource_List.pvmem':None,
+        'Resource_List.vmem':None,
+        'Resource_List.neednodes':None,
+        'Resource_List.nodect':None,
+        'Resource_List.nodes':None,
+        'Resource_List.walltime':'req_walltime',
+        'ctime':None,
+        'end':'end_time',
+        'etime':'timestamp',
+        'exec_host':'wn',
+        'group':'group',
+        'jobname':None,
+        'owner':None,
+        'queue':'queue',
+        'qtime':None,
+        'resources_used.cput':'used_cputime',
+        'resources_used.mem':'used_mem',
+        'resources_used.vmem':'used_vmem',
+        'resources_used.walltime':'used_walltime',
+        'session':None,
+        'start':'start_time',
+        'user':'user',
+        }
+
+    def __init__(self, jobid, timestamp, attrs):
+        self.jobid = jobid
+
+        # provide defaults
+        self.req_mem = '0'
+        self.req_cputime = '0:00:00'
+        self.req_walltime = '0:00:00'
+
+        # parse timestamp
+        date, time = timestamp.split()
+        month, day, year = date.split("/")
+        self.date = '%s-%s-%s' % (year, month, day)
+
+        # parse attrs
+        for kv in attrs.split():
+            key, val = kv.split("=")
+            try:
+                key = LegacyRecord.ATTRS_TO_COLUMNS_MAP[key]
+            except KeyError: # no mapping, keep "key" unchanged
+                pass
+            if key is not None:
+                setattr(self, key, val)
+
+        # check required fields
+        for attr in ['used_mem', 'used_vmem', 'used_cputime', 'used_walltime']:
+            if not hasattr(self, attr):
+                raise ValueError("missing required attribute '%s'" % attr)
+
+        # only keep hostname for WNs
+        self.wn = self.wn.split(".")[0]
+
+        # convert group names to VO names
+        self.vo, self.role = pbslogs2sql.creds_to_vo_and_role_map(self.user, self.group)
+
+        # convert memory units
+        def to_bytes(val):
+            if 'b' != val[-1]:
+                return int(val)
+            val = val[:-1] # strip off last char
+            if 'k' == val[-1]:
+                return int(val[:-1]) * 1024
+            elif 'm' == val[-1]:
+                return int(val[:-1]) * 1024 * 1024
+            elif 'g' == val[-1]:
+                return int(val[:-1]) * 1024 * 1024 * 1024
+            return int(val)
+        for attr in ['req_mem', 'used_mem', 'used_vmem']:
+            setattr(self, attr, to_bytes(getattr(self, attr)))
+
+        # convert time units
+        def to_seconds(val):
+            hrs, mins, secs = val.split(":")
+            return (int(hrs)*3600 + int(mins)*60 + int(secs))
+        for attr in ['req_cputime', 'req_walltime', 'used_cputime', 'used_walltime']:
+            setattr(self, attr, to_seconds(getattr(self, attr)))
+
+
+def run_legacy(filename):
+    for line in open(filename, 'r'):
+        timestamp, kind, jobid, attrs = line.split(";")
+        if kind != 'E':
+            continue
+        LegacyRecord(jobid, timestamp, attrs)
+
+def run_parse_line(filename):
+    parse_line = pbslogs2sql.parse_line
+    for line in open(filename, 'r'):
+        parse_line(line)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [LOGFILE]")
+    parser.add_option("-n", "--lines", dest="lines", type="int", default=3000000,
+                      help="number of lines of the synthetic log (default: %default)")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="take the best of this many runs (default: %default)")
+    (options, args) = parser.parse_args()
+
+    if args:
+        filename = args[0]
+        tmp = None
+    else:
+        fd, filename = tempfile.mkstemp(prefix='bench_parser.', suffix='.log')
+        tmp = os.fdopen(fd, 'w')
+        write_synthetic_log(tmp, options.lines)
+        tmp.close()
+    try:
+        lines = 0
+        for line in open(filename, 'r'):
+            lines += 1
+        results = []
+        for name, fn in [('Record (legacy)', run_legacy),
+                         ('parse_line', run_parse_line)]:
+            best = None
+            for n in range(options.repeat):
+                t = time.time()
+                fn(filename)
+                elapsed = time.time() - t
+                if best is None or elapsed < best:
+                    best = elapsed
+            results.append(best)
+            print "%-16s %10.0f lines/s  (%.2fs for %d lines)" % (name, lines / best, best, lines)
+        print "speedup: %.2fx" % (results[0] / results[1])
+    finally:
+        if tmp is not None:
+            os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
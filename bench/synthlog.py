@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+#
+"""
+Generate synthetic TORQUE accounting logs, in the format parsed by
+`pbslogs2sql.py`, for benchmarking.
+
+Logs are written one file per day, named ``YYYYMMDD`` as TORQUE
+does.  Each job gets a queued (Q), a start (S) and an exit (E)
+record, written together to the file of the day the job ended.  The
+mix of VOs, the VOMS roles and the number of jobs per day can be
+chosen; the UNIX user and group of each job are picked so that
+`pbslogs2sql.creds_to_vo_and_role_map` maps them back to the chosen
+VO and role.
+
+Can be run as a script; see ``python bench/synthlog.py --help``.
+"""
+__docformat__ = 'reStructuredText'
+
+
+import calendar
+import datetime
+import os
+import random
+import time
+from optparse import OptionParser
+
+
+# (UNIX user, UNIX group) pairs for each VO and role
+CREDS = {
+    'atlas': {
+        'production':('atlasprd', 'atlas'),
+        'pilot':('atlasplt', 'atlas'),
+        'NULL':('atlas001', 'atlas'),
+        },
+    'cms': {
+        'production':('cmsprd', 'prdcms'),
+        'priorityuser':('cmspri', 'pricms'),
+        'NULL':('cms001', 'cms'),
+        },
+    'lhcb': {
+        'production':('lhcbprd', 'lhcb'),
+        'NULL':('lhcb001', 'lhcb'),
+        },
+    'dteam': {
+        'NULL':('dteam001', 'dteam'),
+        },
+    }
+
+DEFAULT_VO_MIX = 'atlas:5,cms:3,lhcb:1,dteam:1'
+
+QUEUES = ['egee48h', 'egee24h', 'short']
+
+
+def parse_vo_mix(spec):
+    """Parse a VO mix like ``atlas:5,cms:3`` into a list of
+    `(vo, weight)` pairs."""
+    mix = []
+    for item in spec.split(','):
+        vo, weight = item.split(':')
+        if vo not in CREDS:
+            raise ValueError("Unknown VO '%s', valid values are: %s"
+                             % (vo, str.join(", ", sorted(CREDS))))
+        mix.append((vo, float(weight)))
+    return mix
+
+
+def make_creds(vo_mix, roles=None):
+    """
+    Return a list of `(user, group, weight)` tuples: the weight of
+    each VO in `vo_mix` is split evenly among its roles; only roles
+    in `roles` are used, if given.
+    """
+    creds = []
+    for vo, weight in vo_mix:
+        pairs = [ CREDS[vo][role] for role in sorted(CREDS[vo])
+                  if roles is None or role in roles ]
+        for user, group in pairs:
+            creds.append((user, group, weight / len(pairs)))
+    if not creds:
+        raise ValueError("No (VO, role) combination left to generate jobs for")
+    return creds
+
+
+def hms(t):
+    return '%02d:%02d:%02d' % (t / 3600, (t / 60) % 60, t % 60)
+
+def stamp(t):
+    return time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime(t))
+
+
+def write_job(output, rnd, jobid, user, group, queue, qtime, start, end):
+    """Write the Q, S and E records of one job to stream `output`."""
+    walltime = end - start
+    cputime = rnd.randint(0, walltime)
+    wn = rnd.randint(1, 40)
+    slot = rnd.randint(0, 7)
+    common = ('user=%s group=%s jobname=STDIN queue=%s ctime=%d qtime=%d etime=%d'
+              % (user, group, queue, qtime, qtime, qtime))
+    output.write('%s;Q;%s;queue=%s\n' % (stamp(qtime), jobid, queue))
+    output.write('%s;S;%s;%s start=%d exec_host=wn%02d.lcg.cscs.ch/%d'
+                 ' Resource_List.cput=48:00:00 Resource_List.mem=2000mb'
+                 ' Resource_List.walltime=60:00:00\n'
+                 % (stamp(start), jobid, common, start, wn, slot))
+    output.write('%s;E;%s;%s start=%d owner=%s@ce01.lcg.cscs.ch'
+                 ' exec_host=wn%02d.lcg.cscs.ch/%d Resource_List.cput=48:00:00'
+                 ' Resource_List.mem=2000mb Resource_List.neednodes=1 Resource_List.nodect=1'
+                 ' Resource_List.nodes=1 Resource_List.walltime=60:00:00 session=%d end=%d'
+                 ' Exit_status=0 resources_used.cput=%s resources_used.mem=%dkb'
+                 ' resources_used.vmem=%dkb resources_used.walltime=%s\n'
+                 % (stamp(end), jobid, common, start, user, wn, slot,
+                    rnd.randint(1000, 30000), end, hms(cputime), rnd.randint(1000, 2000000),
+                    rnd.randint(1000, 4000000), hms(walltime)))
+
+
+def pick(rnd, creds):
+    """Pick a `(user, group)` pair from `creds` (see `make_creds`)
+    with probability proportional to its weight."""
+    x = rnd.random() * sum([ c[2] for c in creds ])
+    for user, group, weight in creds:
+        x -= weight
+        if x < 0:
+            return user, group
+    return creds[-1][0], creds[-1][1]
+
+
+def write_synthetic_log(output, lines, seed=0):
+    """
+    Write `lines` lines of a TORQUE accounting log to stream `output`,
+    with jobs of the default VO mix queued 10 seconds apart.
+    """
+    rnd = random.Random(seed)
+    creds = make_creds(parse_vo_mix(DEFAULT_VO_MIX))
+    t0 = 1258930667
+    for n in xrange(lines / 3):
+        user, group = pick(rnd, creds)
+        qtime = t0 + n * 10
+        start = qtime + rnd.randint(0, 3600)
+        end = start + rnd.randint(1, 48*3600)
+        write_job(output, rnd, '%d.ce01.lcg.cscs.ch' % (1000000 + n),
+                  user, group, QUEUES[0], qtime, start, end)
+
+
+def generate(directory, start_date, days, jobs_per_day,
+             vo_mix=DEFAULT_VO_MIX, roles=None, seed=0):
+    """
+    Write `days` daily log files, starting at `start_date` (a
+    `datetime.date`), with `jobs_per_day` jobs ending on each day,
+    into `directory`.  Return the list of file names.
+    """
+    rnd = random.Random(seed)
+    creds = make_creds(parse_vo_mix(vo_mix), roles)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filenames = []
+    n = 0
+    for d in range(days):
+        date = start_date + datetime.timedelta(days=d)
+        t0 = calendar.timegm(date.timetuple())
+        filename = os.path.join(directory, date.strftime('%Y%m%d'))
+        output = open(filename, 'w')
+        # jobs end throughout the day, in order
+        for end in sorted([ t0 + rnd.randint(0, 86399) for j in xrange(jobs_per_day) ]):
+            user, group = pick(rnd, creds)
+            start = end - rnd.randint(1, 48*3600)
+            qtime = start - rnd.randint(0, 3600)
+            write_job(output, rnd, '%d.ce01.lcg.cscs.ch' % (1000000 + n),
+                      user, group, rnd.choice(QUEUES), qtime, start, end)
+            n += 1
+        output.close()
+        filenames.append(filename)
+    return filenames
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] DIRECTORY")
+    parser.add_option("-s", "--start-date", dest="start_date", default="2009-01-01",
+                      help="date of the first log file, as YYYY-MM-DD (default: %default)")
+    parser.add_option("-y", "--years", dest="years", type="float", default=1,
+                      help="years of history to generate (default: %default)")
+    parser.add_option("-n", "--jobs-per-day", dest="jobs_per_day", type="int", default=2000,
+                      help="number of jobs ending each day (default: %default)")
+    parser.add_option("-m", "--vo-mix", dest="vo_mix", default=DEFAULT_VO_MIX,
+                      help="relative share of jobs of each VO (default: %default)")
+    parser.add_option("-r", "--roles", dest="roles", default=None,
+                      help="comma-separated list of VOMS roles to generate jobs for"
+                      " (default: all roles known for each VO)")
+    parser.add_option("--seed", dest="seed", type="int", default=0,
+                      help="seed of the random number generator (default: %default)")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Exactly one argument required: the output directory")
+    year, month, day = [ int(x) for x in options.start_date.split('-') ]
+    if options.roles:
+        roles = options.roles.split(',')
+    else:
+        roles = None
+    filenames = generate(args[0], datetime.date(year, month, day),
+                         int(options.years * 365), options.jobs_per_day,
+                         options.vo_mix, roles, options.seed)
+    print "Wrote %d files in '%s'" % (len(filenames), args[0])
+
+
+if __name__ == '__main__':
+    main()
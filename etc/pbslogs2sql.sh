@@ -1,2 +1,6 @@
 #!/bin/bash
-(cd /opt/cscs/libexec/pbsplots && ./pbslogs2sql.py -H mon.lcg.cscs.ch -u pbs -D pbs /var/spool/pbs/server_priv/accounting/`perl -e 'use POSIX qw(strftime); print strftime("%Y%m%d", localtime(time()-86400));'`)
+# load yesterday's (to catch the lines written just before midnight) and
+# today's accounting files; thanks to the checkpoints kept in the DB, only
+# the lines appended since the previous run are actually parsed
+ACCOUNTING=/var/spool/pbs/server_priv/accounting
+(cd /opt/cscs/libexec/pbsplots && ./pbslogs2sql.py -H mon.lcg.cscs.ch -u pbs -D pbs $ACCOUNTING/`perl -e 'use POSIX qw(strftime); print strftime("%Y%m%d", localtime(time()-86400));'` $ACCOUNTING/`perl -e 'use POSIX qw(strftime); print strftime("%Y%m%d", localtime(time()));'`)
@@ -0,0 +1,458 @@
+#! /usr/bin/env python
+#
+"""
+A column-oriented store for PBS accounting data, held in NumPy_
+arrays backed by memory-mapped files.
+
+It is an alternative to the SQL database: ``pbslogs2sql.py`` writes
+into it when run with ``--db-engine columnar``, and ``joplot.py``
+aggregates over it when configured with ``engine=columnar`` in
+section ``[database]``.  No database server is needed.
+
+The store is a directory, laid out as follows::
+
+  dict_vo.txt         # distinct values of VO, role, queue and WN name;
+  dict_role.txt       # the code of a value is its (0-based) line number
+  dict_queue.txt
+  dict_wn.txt
+  checkpoints.txt     # how far each log file has been read
+  watermark.txt       # see `ColumnStore.watermark`
+  2009-11/            # one partition per month of job exit date
+    jobid.txt         # job IDs, one per line, in row order
+    day.int32         # job exit date, as number of days since 1970-01-01
+    vo.uint16         # dictionary-encoded columns
+    ...
+    used_walltime.int64
+    ...
+
+Each column file is a flat array of the given NumPy type.  Rows are
+appended at the end of each partition; loading a job that is already
+in the store overwrites its row in place, so the same log can be
+loaded many times.
+
+.. _NumPy: http://numpy.scipy.org/
+"""
+__docformat__ = 'reStructuredText'
+
+
+import datetime
+import os
+
+import numpy as np
+
+
+# days are stored as offsets from this date
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+# numeric columns and their type; `day` is computed from `date`
+NUMERIC_COLUMNS = [
+    ('day', 'int32'),
+    ('start_time', 'int64'),
+    ('end_time', 'int64'),
+    ('req_cputime', 'int64'),
+    ('req_walltime', 'int64'),
+    ('req_mem', 'int64'),
+    ('used_cputime', 'int64'),
+    ('used_walltime', 'int64'),
+    ('used_mem', 'int64'),
+    ('used_vmem', 'int64'),
+    ('exit_status', 'int32'),
+    ]
+
+# dictionary-encoded columns
+CODED_COLUMNS = ['vo', 'role', 'queue', 'wn']
+
+COLUMNS = NUMERIC_COLUMNS + [ (name, 'uint16') for name in CODED_COLUMNS ]
+
+# column to sum for each `y` metric of the web interface; `None`
+# means: count jobs
+Y = {
+    'jobs':None,
+    'walltime':'used_walltime',
+    'cputime':'used_cputime',
+    }
+
+
+def to_day(date):
+    """Convert a ``YYYY-MM-DD`` string into a day number."""
+    year, month, day = date.split('-')
+    return datetime.date(int(year), int(month), int(day)).toordinal() - EPOCH
+
+def from_day(day):
+    """Convert a day number into a `datetime.date` object."""
+    return datetime.date.fromordinal(int(day) + EPOCH)
+
+
+def months(date1, date2):
+    """Return the list of ``YYYY-MM`` months from the one of `date1`
+    to the one of `date2`, both included."""
+    y, m = int(date1[:4]), int(date1[5:7])
+    y2, m2 = int(date2[:4]), int(date2[5:7])
+    result = []
+    while (y, m) <= (y2, m2):
+        result.append('%04d-%02d' % (y, m))
+        if m == 12:
+            y += 1
+            m = 1
+        else:
+            m += 1
+    return result
+
+
+class Dictionary(object):
+    """Map strings to small integer codes and back; the mapping is
+    persisted in file `path`, one value per line."""
+
+    def __init__(self, path):
+        self.path = path
+        self.values = []
+        self.codes = {}
+        # number of bytes of file `path` read so far
+        self.size = 0
+        self.refresh()
+
+    def refresh(self):
+        """Read the values appended to file `path` since it was last
+        read, e.g., by the loader while the web interface runs."""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == self.size:
+            return
+        source = open(self.path, 'r')
+        source.seek(self.size)
+        for line in source:
+            if not line.endswith('\n'):
+                # being written
+                break
+            self._add(line[:-1])
+            self.size += len(line)
+        source.close()
+
+    def _add(self, value):
+        code = len(self.values)
+        self.values.append(value)
+        self.codes[value] = code
+        return code
+
+    def encode(self, value):
+        """Return the code of `value`, assigning a new one if needed."""
+        try:
+            return self.codes[value]
+        except KeyError:
+            pass
+        self.refresh()
+        if value in self.codes:
+            return self.codes[value]
+        output = open(self.path, 'a')
+        output.write(value + '\n')
+        output.close()
+        self.size += len(value) + 1
+        return self._add(value)
+
+
+class ColumnStore(object):
+    """Accounting data stored in the directory `path`, as described
+    in the module documentation."""
+
+    def __init__(self, path, create=False):
+        if create and not os.path.isdir(path):
+            os.makedirs(path)
+        if not os.path.isdir(path):
+            raise ValueError("No columnar store at '%s'" % path)
+        self.path = path
+        # map month to the `{jobid: row number}` index of the
+        # partitions written to so far
+        self.positions = {}
+        self.dicts = {}
+        for name in CODED_COLUMNS:
+            self.dicts[name] = Dictionary(os.path.join(path, 'dict_%s.txt' % name))
+
+    def _column_file(self, month, name, dtype):
+        return os.path.join(self.path, month, '%s.%s' % (name, dtype))
+
+    ## writing
+
+    def write(self, rows, columns):
+        """
+        Store `rows`, each one a tuple of values for the columns
+        named in `columns`, replacing any earlier row with the same
+        job ID.  Job IDs must be unique within `rows`.  Return the
+        earliest date (as a ``YYYY-MM-DD`` string) of the rows written
+        or replaced.
+        """
+        index = {}
+        for n in range(len(columns)):
+            index[columns[n]] = n
+        partitions = {}
+        i = index['date']
+        for row in rows:
+            partitions.setdefault(row[i][:7], []).append(row)
+        first = None
+        for month, part in partitions.iteritems():
+            day = self._write_partition(month, part, index)
+            if first is None or day < first:
+                first = day
+        return str(from_day(first))
+
+    def _open_partition(self, month):
+        """Return the `{jobid: row number}` index of partition `month`,
+        creating the partition if needed."""
+        try:
+            return self.positions[month]
+        except KeyError:
+            pass
+        directory = os.path.join(self.path, month)
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        positions = {}
+        jobids_file = os.path.join(directory, 'jobid.txt')
+        if os.path.exists(jobids_file):
+            for line in open(jobids_file, 'r'):
+                positions[line[:-1]] = len(positions)
+        n = len(positions)
+        # the job IDs file is written last, so any column data past
+        # its length is left over from an interrupted write
+        for name, dtype in COLUMNS:
+            path = self._column_file(month, name, dtype)
+            size = n * np.dtype(dtype).itemsize
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            if os.path.getsize(path) != size:
+                f = open(path, 'r+b')
+                f.truncate(size)
+                f.close()
+        self.positions[month] = positions
+        return positions
+
+    def _write_partition(self, month, rows, index):
+        """Write `rows` into partition `month`, as in `write`; return
+        the earliest day number of the rows written or replaced."""
+        positions = self._open_partition(month)
+        n = len(positions)
+
+        # encode the new values, column by column
+        values = {}
+        values['day'] = np.array([ to_day(row[index['date']]) for row in rows ], dtype='int32')
+        for name, dtype in NUMERIC_COLUMNS[1:]:
+            i = index[name]
+            values[name] = np.array([ int(row[i]) for row in rows ], dtype=dtype)
+        for name in CODED_COLUMNS:
+            i = index[name]
+            encode = self.dicts[name].encode
+            values[name] = np.array([ encode(row[i]) for row in rows ], dtype='uint16')
+
+        i = index['jobid']
+        where = np.array([ positions.get(row[i], -1) for row in rows ], dtype='int64')
+        old = (where >= 0)
+        new = ~old
+        first = int(values['day'].min())
+
+        # overwrite rows of jobs already in the store...
+        if old.any():
+            for name, dtype in COLUMNS:
+                column = np.memmap(self._column_file(month, name, dtype),
+                                   dtype=dtype, mode='r+', shape=(n,))
+                if name == 'day':
+                    first = min(first, int(column[where[old]].min()))
+                column[where[old]] = values[name][old]
+                column.flush()
+                del column
+        # ...and append the others
+        if new.any():
+            for name, dtype in COLUMNS:
+                output = open(self._column_file(month, name, dtype), 'ab')
+                output.write(values[name][new].tostring())
+                output.close()
+            output = open(os.path.join(self.path, month, 'jobid.txt'), 'a')
+            for row, is_new in zip(rows, new):
+                if is_new:
+                    output.write(row[i] + '\n')
+                    positions[row[i]] = len(positions)
+            output.close()
+        return first
+
+    ## reading
+
+    def _read_partition(self, month, names):
+        """Return a dictionary mapping each column in `names` to a
+        read-only array of its values in partition `month`, or
+        `None` if the partition is empty."""
+        dtypes = dict(COLUMNS)
+        sizes = []
+        for name in names:
+            path = self._column_file(month, name, dtypes[name])
+            if not os.path.exists(path):
+                return None
+            sizes.append(os.path.getsize(path) / np.dtype(dtypes[name]).itemsize)
+        # columns can be longer than others while a write is in progress
+        n = min(sizes)
+        if n == 0:
+            return None
+        result = {}
+        for name in names:
+            result[name] = np.memmap(self._column_file(month, name, dtypes[name]),
+                                     dtype=dtypes[name], mode='r', shape=(n,))
+        return result
+
+    def aggregate(self, y, timescale, date1, date2=None, vos=None):
+        """
+        Return a list of `(period, vo, role, value)` tuples, with
+        the total of metric `y` (see `Y`) for each period, VO and
+        role in the date range from `date1` to `date2` (both
+        included); `timescale` is one of ``daily``, ``monthly`` or
+        ``yearly``.  If `vos` is given, only those VOs are returned.
+
+        Periods are `datetime.date` objects for the daily timescale,
+        and ``YYYY-MM`` or ``YYYY`` strings otherwise, i.e., the same
+        values the web interface gets from its SQL queries.
+        """
+        if date2 is None:
+            date2 = date1
+        d1, d2 = to_day(date1), to_day(date2)
+        column = Y[y]
+        names = ['day', 'vo', 'role']
+        if column is not None:
+            names.append(column)
+        # the loader may have added VOs and roles since the last call
+        vo_dict, role_dict = self.dicts['vo'], self.dicts['role']
+        vo_dict.refresh()
+        role_dict.refresh()
+        if vos is not None:
+            vos = set(vos)
+            if not vos.intersection(vo_dict.codes):
+                return []
+
+        totals = {}
+        for month in months(date1, date2):
+            part = self._read_partition(month, names)
+            if part is None:
+                continue
+            day, vo, role = part['day'], part['vo'], part['role']
+            # partitions in the middle of the range need no date filter
+            if month in (date1[:7], date2[:7]):
+                mask = (day >= d1) & (day <= d2)
+                if not mask.any():
+                    continue
+                day, vo, role = day[mask], vo[mask], role[mask]
+            else:
+                mask = None
+            # one bin per (day, VO, role) for daily plots, per (VO,
+            # role) otherwise, since a partition spans a single month;
+            # unwanted VOs are dropped from the sums, which is cheaper
+            # than filtering the rows.  Bins are sized from the codes
+            # actually present, which may be newer than the dictionaries
+            nvo = int(vo.max()) + 1
+            nrole = int(role.max()) + 1
+            if nvo > len(vo_dict.values):
+                vo_dict.refresh()
+            if nrole > len(role_dict.values):
+                role_dict.refresh()
+            key = vo.astype('int64') * nrole + role
+            if timescale == 'daily':
+                key += (day - d1).astype('int64') * (nvo * nrole)
+            if column is None:
+                sums = np.bincount(key)
+            elif mask is None:
+                sums = np.bincount(key, weights=part[column])
+            else:
+                sums = np.bincount(key, weights=part[column][mask])
+            if timescale == 'monthly':
+                period = month
+            elif timescale == 'yearly':
+                period = month[:4]
+            for k in np.flatnonzero(sums):
+                bucket, rest = divmod(int(k), nvo * nrole)
+                v, r = divmod(rest, nrole)
+                if vos is not None and vo_dict.values[v] not in vos:
+                    continue
+                if timescale == 'daily':
+                    period = from_day(d1 + bucket)
+                t = (period, vo_dict.values[v], role_dict.values[r])
+                totals[t] = totals.get(t, 0) + int(round(sums[k]))
+        return [ (period, vo, role, value)
+                 for (period, vo, role), value in totals.iteritems() ]
+
+    ## bookkeeping
+
+    def watermark(self):
+        """
+        Return a triple `(last_date, serial, epoch)`, with the same
+        meaning as the columns of table ``ingest_watermark`` in the
+        SQL database (see ``pbslogs2sql.py``).
+        """
+        path = os.path.join(self.path, 'watermark.txt')
+        if not os.path.exists(path):
+            return (None, 0, 0)
+        last_date, serial, epoch = open(path, 'r').read().split()
+        return (last_date, int(serial), int(epoch))
+
+    def update_watermark(self, last_date, first_date=None):
+        """Record that data up to `last_date` has been written, and
+        that earlier data has changed if `first_date` (the earliest
+        date written) is before the last date recorded so far."""
+        old_date, serial, epoch = self.watermark()
+        if old_date is not None and first_date is not None and first_date < old_date:
+            epoch += 1
+        if old_date is not None and old_date > last_date:
+            last_date = old_date
+        self._replace_file('watermark.txt', '%s %d %d\n' % (last_date, serial+1, epoch))
+
+    def catalog(self):
+        """
+        Return the list of `(vo, role, queue, first_seen, last_seen)`
+        tuples, one for each combination of values found in the data,
+        with the same meaning as table ``catalog`` in the SQL
+        database (see ``pbslogs2sql.py``).
+        """
+        path = os.path.join(self.path, 'catalog.txt')
+        if not os.path.exists(path):
+            return []
+        return [ tuple(line[:-1].split('\t')) for line in open(path, 'r') ]
+
+    def update_catalog(self, seen):
+        """Merge into the catalog the dictionary `seen`, mapping
+        `(vo, role, queue)` to the `(first, last)` dates of jobs."""
+        catalog = {}
+        for vo, role, queue, first, last in self.catalog():
+            catalog[vo, role, queue] = (first, last)
+        for key, (first, last) in seen.iteritems():
+            if key in catalog:
+                first = min(first, catalog[key][0])
+                last = max(last, catalog[key][1])
+            catalog[key] = (first, last)
+        self._replace_file('catalog.txt',
+                           str.join('', [ ('%s\t%s\t%s\t%s\t%s\n' % (key + catalog[key]))
+                                          for key in sorted(catalog) ]))
+
+    def checkpoint(self, filename):
+        """Return the `(inode, offset, last_line_md5)` checkpoint saved
+        for log file `filename`, or `None`."""
+        path = os.path.join(self.path, 'checkpoints.txt')
+        if not os.path.exists(path):
+            return None
+        for line in open(path, 'r'):
+            name, inode, offset, digest = line[:-1].split('\t')
+            if name == filename:
+                return (int(inode), int(offset), digest)
+        return None
+
+    def save_checkpoints(self, checkpoints):
+        """Save checkpoints, given as a dictionary mapping file names
+        to `(inode, offset, last_line_md5)` triples."""
+        path = os.path.join(self.path, 'checkpoints.txt')
+        saved = {}
+        if os.path.exists(path):
+            for line in open(path, 'r'):
+                name, inode, offset, digest = line[:-1].split('\t')
+                saved[name] = (int(inode), int(offset), digest)
+        saved.update(checkpoints)
+        self._replace_file('checkpoints.txt',
+                           str.join('', [ ('%s\t%d\t%d\t%s\n' % ((name,) + saved[name]))
+                                          for name in sorted(saved) ]))
+
+    def _replace_file(self, name, contents):
+        # write to a temporary file and rename, so that readers
+        # never see a half-written file
+        path = os.path.join(self.path, name)
+        output = open(path + '.tmp', 'w')
+        output.write(contents)
+        output.close()
+        os.rename(path + '.tmp', path)
@@ -1,21 +1,37 @@
 #! /usr/bin/env python
 #
 """
-A CGI application for plotting the PBS accounting data.
+A WSGI application for plotting the PBS accounting data.
+
+The module-level `application` object can be served by any
+long-running WSGI container (e.g., Apache's ``mod_wsgi``): the
+configuration and the HTML template are then read only once per
+process, and DB connections are kept open in a pool and reused
+across requests.  When run as a script, the module serves a single
+request through the CGI interface.
+
+Data is read from the MySQL DB filled by ``pbslogs2sql.py``, or from
+a SQLite file or the column store of module `colstore` if
+``engine=sqlite`` or ``engine=columnar`` is set in section
+``[database]`` of the configuration file.
 """
 __docformat__ = 'reStructuredText'
 
 from math import log
+import cPickle as pickle
 import cgi
+from cStringIO import StringIO
+import calendar
+import csv
 import datetime
-import itertools
+import os
+import Queue
+import re
 import sys
+import threading
+import time
 
-# for debugging
-import cgitb; cgitb.enable(display=1, logdir="/tmp")
-
-# DB connectivity
-import MySQLdb as sql
+from sketch import DDSketch
 
 # configuration
 from ConfigParser import SafeConfigParser
@@ -38,6 +54,14 @@ class DateRange(object):
     MONTH_END = ["There's no month 0!", 
               #  Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec
                  31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+    @staticmethod
+    def month_end(year, month):
+        """Return the last day of `month` in `year`, taking leap
+        years into account."""
+        if month == 2 and calendar.isleap(year):
+            return 29
+        return DateRange.MONTH_END[month]
     
     def __init__(self, start, end, step='daily'):
         #: starting date
@@ -77,7 +101,7 @@ class DateRange(object):
                 raise StopIteration
             # advance month and year if needed
             if self.d: # daily
-                if self.d == DateRange.MONTH_END[self.m]:
+                if self.d == DateRange.month_end(self.y, self.m):
                     if self.m == 12:
                         self.y +=1
                         self.m = 1
@@ -101,15 +125,239 @@ class DateRange(object):
         else: # yearly
             return '%04d' % self.y
 
-## main
 
-# get configuration options
-config = SafeConfigParser()
-config.read('pbsplots.ini')
-db_db = config.get('database', 'db')
-db_user = config.get('database', 'user')
-db_host = config.get('database', 'host')
-db_passwd = config.get('database', 'password')
+class ConnectionPool(object):
+    """Keep up to `size` idle DB connections around for reuse,
+    opening new ones with `connect()` as needed.  Safe to use
+    from multiple threads."""
+
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return a DB connection, reusing an idle one if possible."""
+        self._lock.acquire()
+        try:
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                conn = None
+        finally:
+            self._lock.release()
+        if conn is not None:
+            if not hasattr(conn, 'ping'): # SQLite
+                return conn
+            try:
+                # the server may have dropped the connection meanwhile
+                conn.ping()
+                return conn
+            except sql.Error:
+                pass
+        return self.connect()
+
+    def put(self, conn):
+        """Give back a connection obtained with `get`.  Connections
+        that are in an unknown state after an error should be closed
+        instead."""
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                conn = None
+        finally:
+            self._lock.release()
+        if conn is not None:
+            conn.close()
+
+
+class ResultCache(object):
+    """
+    Cache query results in the SQLite DB file `path`; when the
+    total size of the cached results exceeds `max_size` bytes, the
+    least recently used ones are evicted.
+
+    Cache validity is checked against the *watermark* that
+    `pbslogs2sql.py` updates when loading data, i.e., a triple
+    `(last_date, serial, epoch)`: results for date ranges that end
+    before `last_date` are final, and stay valid until `epoch`
+    changes; results that touch later dates are only valid as long
+    as `serial` does not change, i.e., until new data is loaded.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        conn = self._connect()
+        conn.execute("""
+CREATE TABLE IF NOT EXISTS results (
+  key       TEXT PRIMARY KEY,
+  final     INTEGER NOT NULL,
+  serial    INTEGER NOT NULL,
+  epoch     INTEGER NOT NULL,
+  size      INTEGER NOT NULL,
+  atime     REAL NOT NULL,
+  value     BLOB NOT NULL
+)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_atime ON results (atime)")
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        import sqlite3 # Python 2.5+
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key, watermark):
+        """Return the value cached under `key`, or `None` if there
+        is none or it is no longer valid at `watermark`."""
+        last_date, serial, epoch = watermark
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT final, serial, epoch, value FROM results WHERE key=?",
+                               (key,)).fetchone()
+            if row is None:
+                return None
+            if row[2] != epoch or not (row[0] or row[1] == serial):
+                conn.execute("DELETE FROM results WHERE key=?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE results SET atime=? WHERE key=?", (time.time(), key))
+            conn.commit()
+            return pickle.loads(str(row[3]))
+        finally:
+            conn.close()
+
+    def put(self, key, watermark, end_date, value, final=True):
+        """Cache `value` under `key`; `end_date` is the last date
+        (as a ``YYYY-MM-DD`` string) that `value` depends on.  If
+        `final` is false, `value` may change whenever new data is
+        loaded, whatever `end_date`."""
+        last_date, serial, epoch = watermark
+        final = (final and last_date is not None and end_date < str(last_date))
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        conn = self._connect()
+        try:
+            conn.execute("REPLACE INTO results (key, final, serial, epoch, size, atime, value)"
+                         " VALUES (?,?,?,?,?,?,?)",
+                         (key, int(final), serial, epoch, len(data), time.time(), buffer(data)))
+            # evict least recently used entries
+            total = conn.execute("SELECT SUM(size) FROM results").fetchone()[0]
+            if total > self.max_size:
+                for old_key, size in conn.execute("SELECT key, size FROM results ORDER BY atime").fetchall():
+                    conn.execute("DELETE FROM results WHERE key=?", (old_key,))
+                    total -= size
+                    if total <= self.max_size:
+                        break
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class ExpiringValue(object):
+    """Hold the value returned by `load()` for `ttl` seconds, then
+    call `load()` again.  Safe to use from multiple threads."""
+
+    def __init__(self, load, ttl):
+        self.load = load
+        self.ttl = ttl
+        self._value = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if now >= self._expires:
+                self._value = self.load()
+                self._expires = now + self.ttl
+            return self._value
+        finally:
+            self._lock.release()
+
+
+class RequestTimer(object):
+    """
+    Account for the time spent in each phase of serving a request.
+
+    Phases are delimited by `start` and `stop` calls and can nest:
+    time is charged to the innermost phase only, so that the times
+    of all phases add up to the total.  SQL queries are recorded
+    with `query`, which may be called from any thread.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.elapsed = None
+        # phase name -> seconds, and names in the order first seen
+        self.phases = {}
+        self.order = []
+        self._stack = []
+        self._since = self.started
+        self.queries = []
+        self.params = {}
+        self.cache = None
+        self._lock = threading.Lock()
+
+    def _charge(self, now):
+        if self._stack:
+            name = self._stack[-1]
+            if name not in self.phases:
+                self.order.append(name)
+            self.phases[name] = self.phases.get(name, 0) + (now - self._since)
+        self._since = now
+
+    def start(self, name):
+        """Start timing phase `name`, suspending the current one."""
+        self._charge(time.time())
+        self._stack.append(name)
+
+    def stop(self):
+        """Stop timing the current phase, resuming the enclosing one."""
+        self._charge(time.time())
+        self._stack.pop()
+
+    def query(self, sql, params, rows, seconds):
+        """Record that query `sql` returned `rows` rows in `seconds`."""
+        self._lock.acquire()
+        try:
+            self.queries.append((sql, params, rows, seconds))
+        finally:
+            self._lock.release()
+
+    def done(self):
+        """Record the end of the request."""
+        self.elapsed = time.time() - self.started
+
+    def report(self):
+        """Return the collected data as a dictionary, with times in
+        milliseconds."""
+        return {
+            'time':time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'total_ms':round(1000 * self.elapsed, 1),
+            'params':self.params,
+            'cache':self.cache,
+            'phases_ms':[ (name, round(1000 * self.phases[name], 1))
+                          for name in self.order ],
+            'queries':[ { 'sql':sql, 'params':params, 'rows':rows,
+                          'ms':round(1000 * seconds, 1) }
+                        for sql, params, rows, seconds in self.queries ],
+            }
+
+
+# the `RequestTimer` of the request served by the current thread
+_current = threading.local()
+
+def request_timer():
+    """Return the `RequestTimer` of the request being served, or a
+    throwaway one when called outside of a request."""
+    try:
+        return _current.timer
+    except AttributeError:
+        return RequestTimer()
+
 
 # template defaults
 class DictWithEmptyStringDefault(dict):
@@ -120,158 +368,846 @@ class DictWithEmptyStringDefault(dict):
             return dict.__getitem__(self, key)
         else:
             return ''
-values = DictWithEmptyStringDefault([
-        ('content', 'Select plot characteristics above and click the "plot" button.')
-        ])
 IS_CHECKED = 'checked="checked"' # HTML ...*sigh*
 IS_SELECTED = 'selected="selected"' 
 
-print "Content-type: text/html"
-print
-form = cgi.FieldStorage()
-if not form.has_key('y'):
-    blank_form = open('pbsplots.template.html', 'r')
-    print blank_form.read() % values
-    sys.exit(0)
-
-# what shall we SELECT for?
-y = {
-    'jobs':'COUNT(jobid)',
+
+## configuration: loaded once per process
+
+# configuration and template files are looked up in the directory
+# where this script lives (the CGI working directory) unless the
+# environment says otherwise
+HERE = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.environ.get('JOPLOT_CONFIG', os.path.join(HERE, 'pbsplots.ini'))
+TEMPLATE_FILE = os.environ.get('JOPLOT_TEMPLATE', os.path.join(HERE, 'pbsplots.template.html'))
+
+# get configuration options
+config = SafeConfigParser()
+config.read(CONFIG_FILE)
+if config.has_option('database', 'engine'):
+    db_engine = config.get('database', 'engine')
+else:
+    db_engine = 'mysql'
+db_db = config.get('database', 'db')
+if config.has_option('database', 'pool_size'):
+    db_pool_size = config.getint('database', 'pool_size')
+else:
+    db_pool_size = 4
+
+TEMPLATE = open(TEMPLATE_FILE, 'r').read()
+
+if db_engine == 'columnar':
+    # `db` is the directory of the column store written by
+    # `pbslogs2sql.py --db-engine columnar`
+    import colstore
+    store = colstore.ColumnStore(db_db)
+    pool = None
+elif db_engine == 'sqlite':
+    # `db` is the SQLite file written by `pbslogs2sql.py --db-engine sqlite`
+    import sqlite3 as sql
+    # SQLite cursors step through results lazily anyway
+    SSCursor = sql.Cursor
+    store = None
+
+    def connect():
+        # return DATE columns as `datetime.date`, as MySQLdb does
+        return sql.connect(db_db, check_same_thread=False,
+                           detect_types=sql.PARSE_DECLTYPES)
+    pool = ConnectionPool(connect, db_pool_size)
+    PARAM = '?'
+else:
+    # DB connectivity
+    import MySQLdb as sql
+    from MySQLdb.cursors import SSCursor
+    store = None
+
+    db_user = config.get('database', 'user')
+    db_host = config.get('database', 'host')
+    db_passwd = config.get('database', 'password')
+
+    def connect():
+        return sql.connect(host=db_host, user=db_user,
+                           passwd=db_passwd, db=db_db)
+    pool = ConnectionPool(connect, db_pool_size)
+
+    # placeholder for bound parameters in SQL statements
+    if sql.paramstyle == 'qmark':
+        PARAM = '?'
+    else: # 'format' (MySQLdb) or 'pyformat'
+        PARAM = '%s'
+
+if config.has_option('query', 'deadline'):
+    query_deadline = config.getfloat('query', 'deadline')
+else:
+    query_deadline = 25
+if config.has_option('query', 'max_concurrent'):
+    query_max_concurrent = config.getint('query', 'max_concurrent')
+else:
+    query_max_concurrent = 4
+
+# the list of VOs and roles is read from the DB at most once
+# every `catalog_ttl` seconds
+if config.has_option('cache', 'catalog_ttl'):
+    catalog_ttl = config.getfloat('cache', 'catalog_ttl')
+else:
+    catalog_ttl = 300
+
+if config.has_option('cache', 'file'):
+    if config.has_option('cache', 'max_size'):
+        cache_max_size = config.getint('cache', 'max_size') * 1024 * 1024
+    else:
+        cache_max_size = 64 * 1024 * 1024
+    cache = ResultCache(config.get('cache', 'file'), cache_max_size)
+else:
+    cache = None
+
+# requests taking longer than `slow_threshold` milliseconds are
+# logged to file `slow_log`, one JSON object per line
+if config.has_option('debug', 'slow_log'):
+    slow_log = config.get('debug', 'slow_log')
+else:
+    slow_log = None
+if config.has_option('debug', 'slow_threshold'):
+    slow_threshold = config.getfloat('debug', 'slow_threshold')
+else:
+    slow_threshold = 2000
+if config.has_option('debug', 'footer'):
+    debug_footer = config.getboolean('debug', 'footer')
+else:
+    debug_footer = False
+
+# `svg` draws charts locally, `google` links to the Google Chart API
+if config.has_option('chart', 'renderer'):
+    chart_renderer = config.get('chart', 'renderer')
+else:
+    chart_renderer = 'svg'
+if config.has_option('chart', 'max_age'):
+    chart_max_age = config.getint('chart', 'max_age')
+else:
+    chart_max_age = 600
+
+
+# what shall we SELECT for? (all queries run against the daily
+# rollup table maintained by `pbslogs2sql.py`, so they scale with
+# the number of days in the range, not with the number of jobs)
+Y = {
+    'jobs':'SUM(jobs)',
+    'walltime':'SUM(used_walltime)',
+    'cputime':'SUM(used_cputime)',
+    }
+
+# occupancy metrics: the seconds that jobs (resp. job slots) of each
+# VO and role have been running each day, from table `occupancy_daily`;
+# they are plotted as the average number of running jobs (resp. busy
+# slots) over each period, see `per_second`
+OCCUPANCY = {
+    'running':'SUM(job_seconds)',
+    'slots':'SUM(slot_seconds)',
+    }
+Y.update(OCCUPANCY)
+
+# same as `Y`, but for queries on the per-job table
+Y_RAW = {
+    'jobs':'COUNT(*)',
     'walltime':'SUM(used_walltime)',
     'cputime':'SUM(used_cputime)',
-    }[form.getvalue('y')]
-values["y_"+form.getvalue('y')+"_checked"] = IS_CHECKED
+    }
 
-y_legend = {
+Y_LEGEND = {
     'jobs':'Number of jobs',
     'walltime':'Consumed wall-clock time (in seconds)',
     'cputime':'Consumed CPU time (in seconds)',
-    }[form.getvalue('y')]
+    'running':'Average number of running jobs',
+    'slots':'Average number of busy job slots',
+    }
+
+# percentiles of per-job values, estimated by merging the quantile
+# sketches of table `quantile_daily` (see module `sketch`); the form
+# selects a metric (e.g., ``y=walltime_pct``) and a percentile, which
+# `parse_form` combine into one of the keys of `QUANTILES` (e.g.,
+# ``walltime_p95``), mapped to the metric name and quantile
+PERCENTILE_PLOTS = {
+    'walltime_pct':('walltime', 'wall-clock time (in seconds)'),
+    'mem_pct':('mem', 'used memory (in bytes)'),
+    'efficiency_pct':('efficiency', 'CPU efficiency (CPU time / wall-clock time)'),
+    }
+PERCENTILES = ['50', '90', '95', '99']
+QUANTILES = {}
+for metric, legend in PERCENTILE_PLOTS.itervalues():
+    for percentile in PERCENTILES:
+        QUANTILES[metric + '_p' + percentile] = (metric, int(percentile) / 100.0)
+        Y_LEGEND[metric + '_p' + percentile] = ('%sth percentile of per-job %s'
+                                                % (percentile, legend))
 
+# VOs and roles offered when the DB has no catalog of them (i.e.,
+# its schema is older than version 6, see `pbslogs2sql.py --migrate`)
+DEFAULT_VO_ROLES = [
+    ('atlas', ['production', 'pilot', 'NULL']),
+    ('cms', [ 'production', 'priorityuser', 'NULL']),
+    ('lhcb', [ 'production', 'NULL' ]),
+    ]
 
-vo_roles = { # FIXME: this should be gotten by a DB query?
-    'atlas': ['production', 'pilot', 'NULL'],
-    'cms': [ 'production', 'priorityuser', 'NULL'],
-    'lhcb': [ 'production', 'NULL' ],
+# how VO and role names are shown in the form; others are shown
+# upper-cased, resp. capitalized
+VO_LABELS = {
+    'atlas':'ATLAS',
+    'cms':'CMS',
+    'lhcb':'LHCb',
+    }
+ROLE_LABELS = {
+    'priorityuser':'Priority',
+    'NULL':'User',
     }
 
-scopes = []
-if form.has_key('total'):
-    scopes.append(('Tier-2 total', ''))
-    values['totals_checked'] = IS_CHECKED
-for vo in ['atlas', 'cms', 'lhcb']:
-    if form.has_key(vo):
-        scopes.append((vo, 'AND vo="%s"' % vo))
-        values[vo+'_checked'] = IS_CHECKED
-        for role in vo_roles[vo]:
-            if form.has_key('vo_'+vo+'_'+role):
-                scopes.append(("%s/Role=%s" % (vo, role),
-                               'AND vo="%s" AND role="%s"' % (vo, role)))
-                values['vo_'+vo+'_'+role+'_checked'] = IS_CHECKED
-n = len(scopes)
-
-if 'range_of_days' == form.getvalue('timescale'):
-    timescale='daily'
-    date1, date2 = form.getvalue('from'), form.getvalue('to')
-    values['range_of_days_checked'] = IS_CHECKED
-    values['from_value'] = 'value="' + form.getvalue('from') + '"'
-    values['to_value'] = 'value="' + form.getvalue('to') + '"'
-elif 'single_day' == form.getvalue('timescale'):
-    timescale='daily'
-    date1, date2 = form.getvalue('date'), None
-    values['single_day_checked'] = IS_CHECKED
-    values['date_value'] = 'value="' + form.getvalue('date') + '"'
-elif 'range_of_months' == form.getvalue('timescale'):
-    timescale='monthly'
-    date1 = '%s-%s-01' % (form.getvalue('monthly_from_year'), form.getvalue('monthly_from_month'))
-    date2 = '%s-%s-%s' % (form.getvalue('monthly_to_year'), form.getvalue('monthly_to_month'), 
-                              DateRange.MONTH_END[int(form.getvalue('monthly_to_month'))])
-    values['range_of_months_checked'] = IS_CHECKED
-    values['month_'+form.getvalue('monthly_from_month')+'_selected'] = IS_SELECTED
-    values['year_'+form.getvalue('monthly_from_year')+'_selected'] = IS_SELECTED
-    values['to_month_'+form.getvalue('monthly_to_month')+'_selected'] = IS_SELECTED
-    values['to_year_'+form.getvalue('monthly_to_year')+'_selected'] = IS_SELECTED
-elif 'single_month' == form.getvalue('timescale'):
-    timescale='monthly'
-    date1 = '%s-%s-01' % (form.getvalue('monthly_year'), form.getvalue('monthly_month'))
-    date2 = '%s-%s-%s' % (form.getvalue('monthly_year'), form.getvalue('monthly_month'), 
-                          DateRange.MONTH_END[int(form.getvalue('monthly_month'))])
-    values['single_month_checked'] = IS_CHECKED
-    values['month_'+form.getvalue('monthly_month')+'_selected'] = IS_SELECTED
-    values['year_'+form.getvalue('monthly_year')+'_selected'] = IS_SELECTED
-elif 'range_of_years' == form.getvalue('timescale'):
-    timescale='yearly'
-    date1 = '%s-01-01' % form.getvalue('yearly_from_year')
-    date2 = '%s-12-31' % form.getvalue('yearly_to_year')
-    values['range_of_years_checked'] = IS_CHECKED
-    values['year_'+form.getvalue('yearly_from_year')+'_selected'] = IS_SELECTED
-    values['to_year_'+form.getvalue('yearly_to_year')+'_selected'] = IS_SELECTED
-elif 'single_year' == form.getvalue('timescale'):
-    timescale='yearly'
-    date1 = '%s-01-01' % form.getvalue('yearly_year')
-    date2 = '%s-12-31' % form.getvalue('yearly_year')
-    values['single_year_checked'] = IS_CHECKED
-    values['year_'+form.getvalue('yearly_year')+'_selected'] = IS_SELECTED
-else:
-    raise ValueError('unknown value "%s" in "timescale" field' % form.getvalue('timescale'))
 
+def fetch_catalog():
+    """
+    Return the list of `(vo, role, queue, first_seen, last_seen)`
+    tuples recorded by `pbslogs2sql.py` for each combination of
+    values found in the data, or `None` if there is no catalog.
+    """
+    if store is not None:
+        return store.catalog() or None
+    conn = pool.get()
+    try:
+        db = conn.cursor()
+        db.execute("SELECT vo, role, queue, first_seen, last_seen FROM catalog")
+        rows = db.fetchall()
+        db.close()
+    except sql.Error:
+        # no such table: DB schema not upgraded yet
+        conn.close()
+        return None
+    pool.put(conn)
+    # (SQLite returns Unicode strings)
+    return [ (str(vo), str(role), str(queue), first, last)
+             for vo, role, queue, first, last in rows ] or None
+
+catalog = ExpiringValue(fetch_catalog, catalog_ttl)
+
+
+def vo_roles():
+    """
+    Return a list of `(vo, roles, first_seen, last_seen)` tuples,
+    one per VO, sorted by VO name; `roles` is the list of roles
+    seen for the VO, with ``NULL`` (i.e., no role) last.  Dates are
+    `None` if the DB has no catalog.
+    """
+    timer = request_timer()
+    timer.start('catalog')
+    rows = catalog.get()
+    timer.stop()
+    if rows is None:
+        return [ (vo, roles, None, None) for vo, roles in DEFAULT_VO_ROLES ]
+    vos = {}
+    for vo, role, queue, first, last in rows:
+        roles, first0, last0 = vos.get(vo, (set(), first, last))
+        roles.add(role)
+        vos[vo] = (roles, min(first, first0), max(last, last0))
+    result = []
+    for vo in sorted(vos):
+        roles, first, last = vos[vo]
+        result.append((vo, sorted(roles, key=lambda role: (role == 'NULL', role)),
+                       first, last))
+    return result
+
+
+def vo_checkboxes(values):
+    """Return the HTML list items for selecting VOs and roles in the
+    form, checked according to `values` (see `parse_form`)."""
+    items = []
+    for vo, roles, first, last in vo_roles():
+        if first is not None:
+            title = ' title="Jobs from %s to %s"' % (first, last)
+        else:
+            title = ''
+        item = ('            <li%s>\n'
+                '              <label><input type="checkbox" name="%s"\n'
+                '                              %s />%s</label>'
+                % (title, cgi.escape(vo, True), values[vo+'_checked'],
+                   cgi.escape(VO_LABELS.get(vo, vo.upper()))))
+        if roles:
+            item += ('\n              (Plot separately: \n'
+                     + str.join(",\n", [
+                        ('              <label><input type="checkbox" name="%s"\n'
+                         '                              %s \n'
+                         '                            />%s</label>'
+                         % (cgi.escape('vo_'+vo+'_'+role, True),
+                            values['vo_'+vo+'_'+role+'_checked'],
+                            cgi.escape(ROLE_LABELS.get(role, role.capitalize()))))
+                        for role in roles ])
+                     + ' jobs)')
+        items.append(item + '\n            </li>')
+    return str.join("\n", items)
 
-# connect to the database
-mysql = sql.connect(host=db_host, user=db_user, 
-                    passwd=db_passwd, db=db_db)
-db = mysql.cursor()
 
-results = []
-for scope in scopes:
+VALID_USER = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+def parse_form(form, values):
+    """
+    Extract the plot parameters from the CGI `form` and return
+    them as a tuple `(y, scopes, timescale, date1, date2, user)`,
+    where `user` is `None` unless the plot is restricted to the
+    jobs of a single UNIX user.  Also
+    set the entries in `values` that make the HTML template show
+    the same choices as the form.
+    """
+    y = form.getvalue('y')
+    if y in PERCENTILE_PLOTS:
+        values["y_"+y+"_checked"] = IS_CHECKED
+        percentile = form.getvalue('percentile', '50')
+        if percentile not in PERCENTILES:
+            raise ValueError('unknown value "%s" in "percentile" field' % percentile)
+        values['percentile_'+percentile+'_selected'] = IS_SELECTED
+        y = PERCENTILE_PLOTS[y][0] + '_p' + percentile
+    elif y in Y:
+        values["y_"+y+"_checked"] = IS_CHECKED
+    else:
+        raise ValueError('unknown value "%s" in "y" field' % y)
+
+    # each scope is a triple `(label, vo, role)`; `None` in the `vo`
+    # or `role` position means "any value"
+    scopes = []
+    if form.has_key('total'):
+        scopes.append(('Tier-2 total', None, None))
+        values['totals_checked'] = IS_CHECKED
+    for vo, roles, first, last in vo_roles():
+        if form.has_key(vo):
+            scopes.append((vo, vo, None))
+            values[vo+'_checked'] = IS_CHECKED
+            for role in roles:
+                if form.has_key('vo_'+vo+'_'+role):
+                    scopes.append(("%s/Role=%s" % (vo, role), vo, role))
+                    values['vo_'+vo+'_'+role+'_checked'] = IS_CHECKED
+
+    if 'range_of_days' == form.getvalue('timescale'):
+        timescale='daily'
+        date1, date2 = form.getvalue('from'), form.getvalue('to')
+        values['range_of_days_checked'] = IS_CHECKED
+        values['from_value'] = 'value="' + form.getvalue('from') + '"'
+        values['to_value'] = 'value="' + form.getvalue('to') + '"'
+    elif 'single_day' == form.getvalue('timescale'):
+        timescale='daily'
+        date1, date2 = form.getvalue('date'), None
+        values['single_day_checked'] = IS_CHECKED
+        values['date_value'] = 'value="' + form.getvalue('date') + '"'
+    elif 'range_of_months' == form.getvalue('timescale'):
+        timescale='monthly'
+        date1 = '%s-%s-01' % (form.getvalue('monthly_from_year'), form.getvalue('monthly_from_month'))
+        date2 = '%s-%s-%s' % (form.getvalue('monthly_to_year'), form.getvalue('monthly_to_month'), 
+                                  DateRange.month_end(int(form.getvalue('monthly_to_year')),
+                                                      int(form.getvalue('monthly_to_month'))))
+        values['range_of_months_checked'] = IS_CHECKED
+        values['month_'+form.getvalue('monthly_from_month')+'_selected'] = IS_SELECTED
+        values['year_'+form.getvalue('monthly_from_year')+'_selected'] = IS_SELECTED
+        values['to_month_'+form.getvalue('monthly_to_month')+'_selected'] = IS_SELECTED
+        values['to_year_'+form.getvalue('monthly_to_year')+'_selected'] = IS_SELECTED
+    elif 'single_month' == form.getvalue('timescale'):
+        timescale='monthly'
+        date1 = '%s-%s-01' % (form.getvalue('monthly_year'), form.getvalue('monthly_month'))
+        date2 = '%s-%s-%s' % (form.getvalue('monthly_year'), form.getvalue('monthly_month'), 
+                              DateRange.month_end(int(form.getvalue('monthly_year')),
+                                                  int(form.getvalue('monthly_month'))))
+        values['single_month_checked'] = IS_CHECKED
+        values['month_'+form.getvalue('monthly_month')+'_selected'] = IS_SELECTED
+        values['year_'+form.getvalue('monthly_year')+'_selected'] = IS_SELECTED
+    elif 'range_of_years' == form.getvalue('timescale'):
+        timescale='yearly'
+        date1 = '%s-01-01' % form.getvalue('yearly_from_year')
+        date2 = '%s-12-31' % form.getvalue('yearly_to_year')
+        values['range_of_years_checked'] = IS_CHECKED
+        values['year_'+form.getvalue('yearly_from_year')+'_selected'] = IS_SELECTED
+        values['to_year_'+form.getvalue('yearly_to_year')+'_selected'] = IS_SELECTED
+    elif 'single_year' == form.getvalue('timescale'):
+        timescale='yearly'
+        date1 = '%s-01-01' % form.getvalue('yearly_year')
+        date2 = '%s-12-31' % form.getvalue('yearly_year')
+        values['single_year_checked'] = IS_CHECKED
+        values['year_'+form.getvalue('yearly_year')+'_selected'] = IS_SELECTED
+    else:
+        raise ValueError('unknown value "%s" in "timescale" field' % form.getvalue('timescale'))
+
+    user = form.getvalue('user', '').strip()
+    if user:
+        if not VALID_USER.match(user):
+            raise ValueError('invalid value "%s" in "user" field' % user)
+        values['user_value'] = 'value="%s"' % user
+    else:
+        user = None
+
+    return y, scopes, timescale, date1, date2, user
+
+
+# SQL expression mapping the `date` column to the period it
+# belongs to; must produce the same values `DateRange` iterates over
+PERIOD = {
+    'daily':'date',
+    'monthly':'SUBSTR(date,1,7)',
+    'yearly':'SUBSTR(date,1,4)',
+    }
+
+def plan_where(scopes, date1, date2):
+    """Return a pair `(where, params)` with the SQL condition
+    selecting the rows of a rollup table that are needed to compute
+    `scopes` between `date1` and `date2`, and its parameters."""
     if date2 != None:
-        query = "SELECT date,%s FROM accounting WHERE date>='%s' and date<='%s' %s GROUP BY date ORDER BY date" \
-            % (y, date1, date2, scope[1])
+        where = "date>=%s AND date<=%s" % (PARAM, PARAM)
+        params = [ date1, date2 ]
     else:
-        query = "SELECT date,%s FROM accounting WHERE date='%s' %s GROUP BY date ORDER BY date" \
-            % (y, date1, scope[1])
+        where = "date=%s" % PARAM
+        params = [ date1 ]
+    vos = scope_vos(scopes)
+    if vos is not None:
+        where += " AND vo IN (%s)" % str.join(",", [PARAM] * len(vos))
+        params.extend(vos)
+    return where, params
+
+def plan_query(y, scopes, timescale, date1, date2, table='accounting_daily'):
+    """Return a pair `(query, params)` for a single SQL query that
+    fetches the `y` values for all of `scopes` at once from `table`,
+    grouped by period (day, month or year, according to
+    `timescale`), VO and role.  The per-scope series are then built
+    by `split_scopes`."""
+    where, params = plan_where(scopes, date1, date2)
+    return (("SELECT %s AS period,vo,role,%s FROM %s WHERE %s GROUP BY period,vo,role"
+             % (PERIOD[timescale], y, table, where)),
+            tuple(params))
+
+def plan_quantile_query(metric, scopes, timescale, date1, date2):
+    """Return a pair `(query, params)` for the SQL query that fetches
+    the daily sketches of `metric` needed for `scopes`, in period
+    order."""
+    where, params = plan_where(scopes, date1, date2)
+    return (("SELECT %s AS period,vo,role,sketch FROM quantile_daily"
+             " WHERE metric=%s AND %s ORDER BY period"
+             % (PERIOD[timescale], PARAM, where)),
+            tuple([metric] + params))
+
+def rollup_table(y):
+    """Return the name of the DB table to query for metric `y`."""
+    if y in OCCUPANCY:
+        return 'occupancy_daily'
+    else:
+        return 'accounting_daily'
+
+def to_date(date):
+    """Convert a ``YYYY-MM-DD`` string to a `datetime.date`."""
+    return datetime.date(*[ int(x) for x in date.split('-') ])
+
+def period_seconds(period, timescale, date1, date2):
+    """Return the number of seconds of `period` (as generated by
+    `DateRange`) that fall between dates `date1` and `date2`."""
+    if timescale == 'daily':
+        return 86400
+    elif timescale == 'monthly':
+        year, month = int(period[:4]), int(period[5:7])
+        first = datetime.date(year, month, 1)
+        last = datetime.date(year + month / 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    else: # yearly
+        first = datetime.date(int(period), 1, 1)
+        last = datetime.date(int(period), 12, 31)
+    first = max(first, to_date(date1))
+    last = min(last, to_date(date2 or date1))
+    return ((last - first).days + 1) * 86400
+
+def per_second(value, period, timescale, date1, date2):
+    """Return the average over `period` of a total of seconds of
+    occupancy `value`, i.e., the average number of running jobs
+    (or busy slots)."""
+    return round(value / float(period_seconds(period, timescale, date1, date2)), 2)
+
+def scope_vos(scopes):
+    """Return the list of VOs whose data is needed to compute
+    `scopes`, or `None` if all VOs are (because totals are plotted)."""
+    vos = [ scope[1] for scope in scopes ]
+    if None in vos:
+        return None
+    return sorted(set(vos))
+
+def split_scopes(rows, scopes):
+    """Distribute the `(date, vo, role, value)` rows returned by the
+    query from `plan_query` into one `{period: value}` dictionary
+    per scope, in a single pass; return the list of dictionaries."""
+    results = [ {} for scope in scopes ]
+    # cache the list of scopes each (vo, role) pair contributes to
+    targets = {}
+    for period, vo, role, value in rows:
+        try:
+            matching = targets[vo, role]
+        except KeyError:
+            matching = [ results[i] for i in range(len(scopes))
+                         if scopes[i][1] in (None, vo) and scopes[i][2] in (None, role) ]
+            targets[vo, role] = matching
+        for result in matching:
+            result[period] = result.get(period, 0) + value
+    return results
+
+def fetch_watermark(db):
+    """Return the `(last_date, serial, epoch)` triple recorded by
+    `pbslogs2sql.py` when it last loaded data."""
+    db.execute("SELECT last_date, serial, epoch FROM ingest_watermark WHERE id=1")
+    row = db.fetchone()
+    if row is None: # no data loaded yet
+        return (None, 0, 0)
+    return tuple(row)
+
+
+def run_query(db, y, scopes, timescale, date1, date2):
+    timer = request_timer()
+    query, params = plan_query(Y[y], scopes, timescale, date1, date2, rollup_table(y))
+    timer.start('sql')
+    t = time.time()
     try:
-        db.execute(query)
+        db.execute(query, params)
     except sql.ProgrammingError, x:
         raise RuntimeError("Failed SQL query: %s: MySQL said: %s" % (query, x))
-    results.append(dict(db.fetchall()))
+    rows = db.fetchall()
+    timer.query(query, params, len(rows), time.time() - t)
+    timer.stop()
+    timer.start('split')
+    results = split_scopes(rows, scopes)
+    timer.stop()
+    return results
+
+
+def run_quantile_query(conn, y, scopes, timescale, date1, date2):
+    """
+    Return the per-scope results for percentile plot `y` (see
+    `QUANTILES`): for each period, the sketches of all its days and
+    of the VOs and roles in a scope are merged, and the percentile
+    estimated from the result.  Rows are read in period order
+    through a server-side cursor, so only the sketches of one
+    period are kept in memory at a time.
+    """
+    metric, q = QUANTILES[y]
+    query, params = plan_quantile_query(metric, scopes, timescale, date1, date2)
+    results = [ {} for scope in scopes ]
+    def estimate(period, merged):
+        for i in range(len(scopes)):
+            if merged[i] is not None:
+                value = merged[i].quantile(q)
+                if value is not None:
+                    if metric == 'efficiency':
+                        results[i][period] = round(value, 2)
+                    else:
+                        results[i][period] = int(round(value))
+    # cache the list of scopes each (vo, role) pair contributes to
+    targets = {}
+    current = merged = None
+    timer = request_timer()
+    timer.start('sketches')
+    t = time.time()
+    db = conn.cursor(SSCursor)
+    try:
+        db.execute(query, params)
+    except sql.ProgrammingError, x:
+        raise RuntimeError("Failed SQL query: %s: MySQL said: %s" % (query, x))
+    rows = 0
+    for period, vo, role, blob in db:
+        rows += 1
+        if period != current:
+            if current is not None:
+                estimate(current, merged)
+            current = period
+            merged = [ None ] * len(scopes)
+        try:
+            matching = targets[vo, role]
+        except KeyError:
+            matching = [ i for i in range(len(scopes))
+                         if scopes[i][1] in (None, vo) and scopes[i][2] in (None, role) ]
+            targets[vo, role] = matching
+        sketch = DDSketch.from_string(str(blob))
+        for i in matching:
+            if merged[i] is None:
+                merged[i] = DDSketch(sketch.alpha)
+            merged[i].merge(sketch)
+    if current is not None:
+        estimate(current, merged)
+    db.close()
+    timer.query(query, params, rows, time.time() - t)
+    timer.stop()
+    return results
+
+
+def plan_scope_query(y, scope, timescale, date1, date2, user):
+    """Return a pair `(query, params)` for fetching the `y` values
+    of a single scope from the per-job table, restricted to the
+    jobs of UNIX user `user` and grouped by period."""
+    if date2 != None:
+        where = "date>=%s AND date<=%s AND user=%s" % (PARAM, PARAM, PARAM)
+        params = [ date1, date2, user ]
+    else:
+        where = "date=%s AND user=%s" % (PARAM, PARAM)
+        params = [ date1, user ]
+    label, vo, role = scope
+    if vo is not None:
+        where += " AND vo=%s" % PARAM
+        params.append(vo)
+    if role is not None:
+        where += " AND role=%s" % PARAM
+        params.append(role)
+    return (("SELECT %s AS period,%s FROM accounting WHERE %s GROUP BY period"
+             % (PERIOD[timescale], Y_RAW[y], where)),
+            tuple(params))
+
+
+def run_scope_queries(y, scopes, timescale, date1, date2, user, deadline):
+    """
+    Run one query per scope (see `plan_scope_query`), concurrently
+    on up to `query_max_concurrent` pooled DB connections.  Return a
+    list with the `{period: value}` dictionary for each scope, or
+    `None` for scopes whose query did not complete within `deadline`
+    seconds.
+    """
+    results = [ None ] * len(scopes)
+    errors = []
+    todo = Queue.Queue()
+    for i in range(len(scopes)):
+        todo.put(i)
+    cancelled = threading.Event()
+    timer = request_timer()
+
+    def worker():
+        conn = pool.get()
+        try:
+            db = conn.cursor()
+            while not cancelled.isSet():
+                try:
+                    i = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                query, params = plan_scope_query(y, scopes[i], timescale, date1, date2, user)
+                t = time.time()
+                db.execute(query, params)
+                rows = db.fetchall()
+                timer.query(query, params, len(rows), time.time() - t)
+                results[i] = dict(rows)
+            db.close()
+        except:
+            errors.append(sys.exc_info())
+            conn.close()
+            return
+        pool.put(conn)
+
+    threads = [ threading.Thread(target=worker)
+                for n in range(min(query_max_concurrent, len(scopes))) ]
+    end = time.time() + deadline
+    timer.start('sql')
+    for thread in threads:
+        # do not keep the process alive for queries past the deadline
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join(max(0, end - time.time()))
+    timer.stop()
+    # stop workers from starting new queries; running ones are
+    # left to finish in the background
+    cancelled.set()
+    if errors:
+        t, v, tb = errors[0]
+        raise t, v, tb
+    return list(results)
+
+
+def fetch_results(y, scopes, timescale, date1, date2, user=None):
+    """Return the per-scope results for the given plot parameters,
+    from the cache if possible, otherwise by querying the DB: if no
+    `user` is given, with the single query of `plan_query`, else
+    with `run_scope_queries`.  Results for scopes that could not be
+    computed within the query deadline are `None`."""
+    if not scopes:
+        return []
+    if y in OCCUPANCY or y in QUANTILES:
+        if user is not None or store is not None:
+            raise ValueError('the "%s" plot is only available for all users,'
+                             ' and not with the "columnar" DB engine' % y)
+    key = repr((y, scopes, timescale, date1, date2, user))
+    if store is not None:
+        return fetch_columnar_results(key, y, scopes, timescale, date1, date2, user)
+    # the occupancy of a day grows as the jobs that ran on it exit and
+    # are loaded, possibly days later, so it is never final
+    final = y not in OCCUPANCY
+    timer = request_timer()
+    conn = pool.get()
+    try:
+        db = conn.cursor()
+        if cache is not None:
+            timer.start('cache')
+            watermark = fetch_watermark(db)
+            results = cache.get(key, watermark)
+            timer.stop()
+            timer.cache = (results is not None and 'hit') or 'miss'
+        else:
+            results = None
+        if results is None and y in QUANTILES:
+            results = run_quantile_query(conn, y, scopes, timescale, date1, date2)
+            if cache is not None:
+                timer.start('cache')
+                cache.put(key, watermark, date2 or date1, results)
+                timer.stop()
+        elif results is None and user is None:
+            results = run_query(db, y, scopes, timescale, date1, date2)
+            if cache is not None:
+                timer.start('cache')
+                cache.put(key, watermark, date2 or date1, results, final)
+                timer.stop()
+        db.close()
+    except:
+        conn.close()
+        raise
+    pool.put(conn)
+    if results is None:
+        results = run_scope_queries(y, scopes, timescale, date1, date2, user, query_deadline)
+        if cache is not None and None not in results:
+            timer.start('cache')
+            cache.put(key, watermark, date2 or date1, results, final)
+            timer.stop()
+    if y in OCCUPANCY:
+        # results are cached as totals of seconds
+        results = [ dict([ (period, per_second(value, period, timescale, date1, date2))
+                           for period, value in result.iteritems() ])
+                    for result in results ]
+    return results
 
-db.close()
-mysql.close()
 
+def fetch_columnar_results(key, y, scopes, timescale, date1, date2, user):
+    """Same as `fetch_results`, but aggregate over the column store."""
+    if user is not None:
+        raise ValueError('plots restricted to a single user are not supported'
+                         ' by the "columnar" DB engine')
+    timer = request_timer()
+    if cache is not None:
+        timer.start('cache')
+        watermark = store.watermark()
+        results = cache.get(key, watermark)
+        timer.stop()
+        timer.cache = (results is not None and 'hit') or 'miss'
+        if results is not None:
+            return results
+    timer.start('aggregate')
+    rows = store.aggregate(y, timescale, date1, date2, scope_vos(scopes))
+    timer.stop()
+    timer.start('split')
+    results = split_scopes(rows, scopes)
+    timer.stop()
+    if cache is not None:
+        timer.start('cache')
+        cache.put(key, watermark, date2 or date1, results)
+        timer.stop()
+    return results
 
-# post-process data for generating graph:
-if timescale == 'daily':
-    data = [ ([ date ] + [ results[i].get(date, 0) for i in range(n) ])
-             for date in DateRange(date1, date2) ]
-else: # monthly or yearly
-    data = [ ([ period ] + [ sum([ results[i][date] 
-                                   for date in [ day for day in results[i].iterkeys() 
-                                                 if day.isoformat().startswith(period) ] ])
-                             for i in range(n) ])
+
+def make_table(results, timescale, date1, date2):
+    """Return the table of values to plot: one row per period,
+    starting with the period itself and followed by the value for
+    each scope.  The DB has already bucketed values by period, just
+    fill in the periods with no jobs."""
+    n = len(results)
+    return [ ([ period ] + [ results[i].get(period, 0) for i in range(n) ])
              for period in DateRange(date1, date2, timescale) ]
 
 
+def stream_table(y, scopes, timescale, date1, date2, user=None):
+    """
+    Generate the rows of the table that `make_table` would return
+    for the given plot parameters, with `None` in place of the values
+    of scopes that could not be computed within the query deadline.
+
+    Unless the plot is restricted to a single user, or data is read
+    from the column store, or percentiles are plotted, rows are
+    streamed from the DB through an unbuffered server-side cursor,
+    and the result cache is bypassed: memory use does not depend on
+    the number of periods.  Without any scope, there are no rows.
+    """
+    if not scopes:
+        return
+    if user is not None or store is not None or y in QUANTILES:
+        results = fetch_results(y, scopes, timescale, date1, date2, user)
+        for period in DateRange(date1, date2, timescale):
+            row = [ period ]
+            for result in results:
+                if result is None:
+                    row.append(None)
+                else:
+                    row.append(result.get(period, 0))
+            yield row
+        return
+    n = len(scopes)
+    timer = request_timer()
+    conn = pool.get()
+    db = conn.cursor(SSCursor)
+    done = False
+    try:
+        query, params = plan_query(Y[y], scopes, timescale, date1, date2, rollup_table(y))
+        query += " ORDER BY period"
+        timer.start('sql')
+        t = time.time()
+        db.execute(query, params)
+        timer.stop()
+        count = [ 0 ]
+        def fetch():
+            row = db.fetchone()
+            if row is not None:
+                count[0] += 1
+            return row
+        rows = iter(fetch, None)
+        row = next(rows, None)
+        # the indices of the scopes each (vo, role) pair contributes to
+        targets = {}
+        for period in DateRange(date1, date2, timescale):
+            values = [ 0 ] * n
+            # rows for periods that `DateRange` does not produce
+            # would otherwise stall the merge
+            while row is not None and row[0] < period:
+                row = next(rows, None)
+            while row is not None and row[0] == period:
+                p, vo, role, value = row
+                try:
+                    matching = targets[vo, role]
+                except KeyError:
+                    matching = [ i for i in range(n)
+                                 if scopes[i][1] in (None, vo) and scopes[i][2] in (None, role) ]
+                    targets[vo, role] = matching
+                for i in matching:
+                    values[i] += value
+                row = next(rows, None)
+            if y in OCCUPANCY:
+                values = [ per_second(value, period, timescale, date1, date2)
+                           for value in values ]
+            yield [ period ] + values
+        timer.query(query, params, count[0], time.time() - t)
+        done = True
+    finally:
+        if done:
+            db.close()
+            pool.put(conn)
+        else:
+            # unread rows are still pending on the connection
+            conn.close()
+
+
+CHART_COLORS = ( # number of colors must match max number of data sets
+    '000000', # black
+    'cd0000', # red3
+    '00cd00', # green3
+    'cdcd00', # yellow3
+    '0000ee', # blue2
+    'cd00cd', # magenta3
+    '00cdcd', # cyan3
+    'e5e5e5', # gray90
+    '7f7f7f', # gray50
+    'ff0000', # red
+    '00ff00', # green
+    'ffff00', # yellow
+    'ff00ff', # magenta
+    '00ffff', # cyan
+    '262626', # gray15
+    )
+
 # incantation for drawing chart with Google API
-def chart_url(data, axes=None, title=None,
-              colors=( # number of colors must match max number of data sets
-                  '000000', # black
-                  'cd0000', # red3
-                  '00cd00', # green3
-                  'cdcd00', # yellow3
-                  '0000ee', # blue2
-                  'cd00cd', # magenta3
-                  '00cdcd', # cyan3
-                  'e5e5e5', # gray90
-                  '7f7f7f', # gray50
-                  'ff0000', # red
-                  '00ff00', # green
-                  'ffff00', # yellow
-                  'ff00ff', # magenta
-                  '00ffff', # cyan
-                  '262626', # gray15
-                  )
-              ):
+def chart_url(data, axes=None, title=None, colors=CHART_COLORS):
     """Return URL for the Google graph depicting `data`."""
+    n = len(data[0]) - 1
     xs = len(data)
     if xs == 1:
         cht = 'bvg&chbh=75,25,50' # vertical bar chart (alter default width of the bars)
@@ -310,6 +1246,115 @@ def chart_url(data, axes=None, title=None,
                chd, chds, chdl, chtt, 
                M, chxr, chxl))
 
+def lttb(points, threshold):
+    """
+    Downsample the list of `(x, y)` `points` (sorted by `x`) to
+    `threshold` points, with the Largest-Triangle-Three-Buckets
+    algorithm: the first and last point are kept, and from each
+    bucket in between, the point that forms the largest triangle
+    with the point kept from the previous bucket and the average
+    of the next bucket.  Peaks and troughs are thus preserved.
+    """
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return points
+    sampled = [ points[0] ]
+    every = float(n - 2) / (threshold - 2)
+    a = 0 # index of the last point kept
+    for i in range(threshold - 2):
+        start = int((i + 1) * every) + 1
+        end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum([ p[0] for p in points[start:end] ]) / float(end - start)
+        avg_y = sum([ p[1] for p in points[start:end] ]) / float(end - start)
+        ax, ay = points[a]
+        best, best_area = start - 1, -1
+        for j in range(int(i * every) + 1, start):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def svg_chart(data, axes, title, width=800, height=375, colors=CHART_COLORS):
+    """
+    Return an SVG document depicting `data`, the same table that
+    `chart_url` takes: a bar chart if there is a single period, a
+    line chart otherwise.  Series with more points than the plot is
+    wide are downsampled with `lttb`, so the size of the output is
+    bounded by `width`, whatever the number of periods.  If there
+    is no series to plot, the chart is empty but for a "No data"
+    notice.
+    """
+    xs = len(data)
+    if xs > 0:
+        n = len(data[0]) - 1
+    else:
+        n = 0
+    left, right, top, bottom = 80, 20, 30, 50 + 15*((n + 3) / 4)
+    pw, ph = width - left - right, height - top - bottom
+    M = max(* [1,1] + [ max(* [1,1] + row[1:]) for row in data ])
+    def X(x):
+        if xs == 1:
+            return left + pw / 2.0
+        return left + pw * x / float(xs - 1)
+    def Y(y):
+        return top + ph * (1 - y / float(M))
+    out = [ ('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d"'
+             ' viewBox="0 0 %d %d" font-family="sans-serif" font-size="11">'
+             % (width, height, width, height)),
+            ('<text x="%d" y="18" text-anchor="middle" font-size="14">%s</text>'
+             % (width / 2, cgi.escape(title))) ]
+    # y-axis, ticks at "powers of 10" interval as in `chart_url`
+    step = 10**int(log(M/8.0) / log(10) + .5)
+    if step < 1:
+        step = 1
+    while M / step > 10:
+        step *= 2
+    for tick in range(0, int(M) + 1, step):
+        out.append('<line x1="%d" y1="%.1f" x2="%d" y2="%.1f" stroke="#e5e5e5" />'
+                   % (left, Y(tick), left + pw, Y(tick)))
+        out.append('<text x="%d" y="%.1f" text-anchor="end">%d</text>'
+                   % (left - 4, Y(tick) + 4, tick))
+    out.append('<rect x="%d" y="%d" width="%d" height="%d" fill="none" stroke="#7f7f7f" />'
+               % (left, top, pw, ph))
+    # x-axis labels: 10 at most
+    every = max(1, xs / 10)
+    for x in range(0, xs, every):
+        out.append('<text x="%.1f" y="%d" text-anchor="middle">%s</text>'
+                   % (X(x), top + ph + 15, cgi.escape(str(data[x][0]))))
+    # data
+    if n == 0:
+        out.append('<text x="%.1f" y="%.1f" text-anchor="middle" fill="#7f7f7f">No data</text>'
+                   % (left + pw / 2.0, top + ph / 2.0))
+    elif xs == 1:
+        bw = min(75, pw / (2*n))
+        for i in range(n):
+            value = data[0][i+1]
+            out.append('<rect x="%.1f" y="%.1f" width="%d" height="%.1f" fill="#%s" />'
+                       % (left + pw / 2.0 - n*bw/2.0 + i*bw, Y(value), bw,
+                          top + ph - Y(value), colors[i % len(colors)]))
+    else:
+        for i in range(n):
+            points = lttb([ (x, data[x][i+1]) for x in range(xs) ], pw)
+            out.append('<polyline fill="none" stroke="#%s" stroke-width="1.5" points="%s" />'
+                       % (colors[i % len(colors)],
+                          str.join(" ", [ ("%.1f,%.1f" % (X(x), Y(y))) for x, y in points ])))
+    # legend, 4 entries per line
+    for i in range(n):
+        lx = left + (i % 4) * (pw / 4)
+        ly = top + ph + 35 + 15 * (i / 4)
+        out.append('<rect x="%d" y="%d" width="10" height="10" fill="#%s" />'
+                   % (lx, ly - 9, colors[i % len(colors)]))
+        out.append('<text x="%d" y="%d">%s</text>'
+                   % (lx + 14, ly, cgi.escape(axes[i])))
+    out.append('</svg>')
+    return str.join("\n", out)
+
+
 # format HTML result table
 def prettyprint_time(t):
     s = t % 60
@@ -329,13 +1374,7 @@ def prettyprint_time(t):
 def prettyprint_num(t):
     return str(t)
 
-if form.getvalue('y') in ['cputime', 'walltime']:
-    prettyprint = prettyprint_time
-else:
-    prettyprint = prettyprint_num
-
-
-def table_rows(data):
+def table_rows(data, prettyprint):
     return str.join("\n", 
                     [(" <tr>" 
                       + ("  <td>%s</td>" % row[0])
@@ -345,12 +1384,27 @@ def table_rows(data):
                       + " </tr>")
                      for row in data ])
 
-# print out results (this is why people like templating languages...)
-output = '''
+
+def render(y, scopes, data):
+    """Return the HTML fragment with the plot and table of `data`."""
+    if y in ['cputime', 'walltime']:
+        prettyprint = prettyprint_time
+    else:
+        prettyprint = prettyprint_num
+
+    timer = request_timer()
+    timer.start('chart')
+    axes = [scope[0] for scope in scopes]
+    if chart_renderer == 'google':
+        chart = '<img src="%s" />' % chart_url(data, axes, Y_LEGEND[y])
+    else:
+        chart = svg_chart(data, axes, Y_LEGEND[y])
+    timer.stop()
+
+    # (this is why people like templating languages...)
+    return '''
 <div style="text-align: center;">
- <img src="%s" />''' % chart_url(data, 
-                                 [scope[0] for scope in scopes], 
-                                 y_legend) + '''
+ ''' + chart + '''
 </div>
 
 <br />
@@ -362,15 +1416,212 @@ output = '''
   <th>Date</th>
 ''' + str.join("\n", [("  <th>%s</th>" % scope[0]) for scope in scopes]) + '''
  </tr>
-''' + table_rows(data) + '''
+''' + table_rows(data, prettyprint) + '''
 </table>
 </center>
 '''
 
-if form.has_key('ajax'):
-    print output
-else:
-    # print full HTML doc
-    values['content'] = output
-    html = file('pbsplots.template.html', 'r').read()
-    print html % values
+
+# machine-readable output
+def export_csv(y, scopes, rows):
+    """Generate the lines of a CSV file with the table `rows`."""
+    buf = StringIO()
+    out = csv.writer(buf)
+    out.writerow([ 'period' ] + [ scope[0] for scope in scopes ])
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    for row in rows:
+        out.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+def export_json(y, scopes, rows):
+    """Generate the pieces of a JSON document with the table `rows`."""
+    import json # Python 2.6+
+    yield '{"y": %s, "legend": %s, "columns": %s, "rows": [' % (
+        json.dumps(y), json.dumps(Y_LEGEND[y]),
+        json.dumps([ 'period' ] + [ scope[0] for scope in scopes ]))
+    sep = '\n'
+    for row in rows:
+        yield sep + json.dumps([ str(row[0]) ] + row[1:])
+        sep = ',\n'
+    yield '\n]}\n'
+
+# `format` value: (content type, export function)
+EXPORTS = {
+    'csv':('text/csv', export_csv),
+    'json':('application/json', export_json),
+    }
+
+def chunked(pieces, size=65536):
+    """Concatenate the strings from iterable `pieces` into chunks of
+    about `size` bytes, for writing out efficiently."""
+    chunk = []
+    length = 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield str.join('', chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield str.join('', chunk)
+
+
+# request instrumentation
+def log_request(timer):
+    """Append the report of `timer` to the slow request log, if the
+    request took at least `slow_threshold` milliseconds."""
+    if slow_log is None or 1000 * timer.elapsed < slow_threshold:
+        return
+    import json # Python 2.6+
+    # one `write` per line in append mode, so lines written by
+    # concurrent processes do not get mixed
+    output = open(slow_log, 'a')
+    try:
+        output.write(json.dumps(timer.report(), default=str) + '\n')
+    finally:
+        output.close()
+
+def render_timings(timer):
+    """Return an HTML fragment with the phase and query times of
+    the request timed by `timer`."""
+    timer.done()
+    report = timer.report()
+    return """
+<div class="debug">
+<table>
+ <tr><th>Phase</th><th>ms</th></tr>
+""" + str.join("\n", [(" <tr><td>%s</td><td>%.1f</td></tr>" % phase)
+                      for phase in report['phases_ms']]) + """
+ <tr><td>total</td><td>%.1f</td></tr>
+</table>
+<table>
+ <tr><th>Query</th><th>Rows</th><th>ms</th></tr>
+""" % report['total_ms'] + str.join("\n", [
+        (" <tr><td><code>%s</code></td><td>%d</td><td>%.1f</td></tr>"
+         % (cgi.escape(query['sql']), query['rows'], query['ms']))
+        for query in report['queries']]) + """
+</table>
+<p>Result cache: %s</p>
+</div>
+""" % (report['cache'] or 'not used')
+
+def timed_stream(chunks, timer):
+    """Yield the chunks of a streamed response, charging the time
+    spent producing them to `timer`; log the request when done."""
+    _current.timer = timer
+    try:
+        timer.start('stream')
+        for chunk in chunks:
+            yield chunk
+        timer.stop()
+        timer.done()
+        log_request(timer)
+    finally:
+        del _current.timer
+
+
+## main
+
+def application(environ, start_response):
+    """WSGI entry point: serve one plot request."""
+    timer = RequestTimer()
+    _current.timer = timer
+    try:
+        output = serve(environ, start_response, timer)
+    finally:
+        del _current.timer
+    if timer.params.get('format') in EXPORTS:
+        # the data is read from the DB while the response is sent
+        return timed_stream(output, timer)
+    timer.done()
+    log_request(timer)
+    return output
+
+
+def serve(environ, start_response, timer):
+    """Serve one plot request, recording times into `timer`."""
+    values = DictWithEmptyStringDefault([
+            ('content', 'Select plot characteristics above and click the "plot" button.')
+            ])
+    form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ)
+    if not form.has_key('y'):
+        start_response('200 OK', [('Content-type', 'text/html')])
+        values['vo_checkboxes'] = vo_checkboxes(values)
+        return [ TEMPLATE % values ]
+
+    timer.start('parse')
+    y, scopes, timescale, date1, date2, user = parse_form(form, values)
+    timer.params = {
+        'y':y,
+        'scopes':[ scope[0] for scope in scopes ],
+        'timescale':timescale,
+        'from':date1,
+        'to':date2,
+        'user':user,
+        'format':form.getvalue('format', 'html'),
+        }
+    timer.stop()
+    if form.getvalue('format') in EXPORTS:
+        content_type, export = EXPORTS[form.getvalue('format')]
+        start_response('200 OK', [('Content-type', content_type)])
+        return chunked(export(y, scopes, stream_table(y, scopes, timescale, date1, date2, user)))
+
+    timer.start('fetch')
+    results = fetch_results(y, scopes, timescale, date1, date2, user)
+    timer.stop()
+    # leave out scopes that could not be computed in time
+    missed = [ scopes[i][0] for i in range(len(scopes)) if results[i] is None ]
+    if missed:
+        scopes = [ scopes[i] for i in range(len(scopes)) if results[i] is not None ]
+        results = [ result for result in results if result is not None ]
+
+    if form.getvalue('format') == 'svg':
+        # just the chart, e.g. for an <img> tag; browsers and proxies
+        # may keep it for a while, unless it is incomplete
+        if missed:
+            max_age = 0
+        else:
+            max_age = chart_max_age
+        start_response('200 OK', [('Content-type', 'image/svg+xml'),
+                                  ('Cache-Control', 'max-age=%d' % max_age)])
+        return [ svg_chart(make_table(results, timescale, date1, date2),
+                           [scope[0] for scope in scopes], Y_LEGEND[y]) ]
+
+    if scopes:
+        timer.start('table')
+        data = make_table(results, timescale, date1, date2)
+        timer.stop()
+        timer.start('html')
+        output = render(y, scopes, data)
+        timer.stop()
+    else:
+        output = ''
+    if missed:
+        output = ('''
+<div class="error">
+ <p>Partial results: no data could be retrieved within %d seconds for: %s</p>
+</div>
+''' % (query_deadline, cgi.escape(str.join(", ", missed)))) + output
+    if debug_footer:
+        output += render_timings(timer)
+
+    start_response('200 OK', [('Content-type', 'text/html')])
+    if form.has_key('ajax'):
+        return [ output ]
+    else:
+        # full HTML doc
+        values['content'] = output
+        values['vo_checkboxes'] = vo_checkboxes(values)
+        return [ TEMPLATE % values ]
+
+
+if __name__ == '__main__':
+    # run as a CGI script
+    import cgitb; cgitb.enable(display=1, logdir="/tmp")
+    from wsgiref.handlers import CGIHandler
+    CGIHandler().run(application)
@@ -7,8 +7,15 @@ ignored.  Example line::
 
   11/23/2009 00:00:00;E;2931170.ce01.lcg.cscs.ch;user=atlasplt group=atlas jobname=STDIN queue=egee48h ctime=1258930667 qtime=1258930667 etime=1258930667 start=1258930691 owner=atlasplt@ce01.lcg.cscs.ch exec_host=wn14.lcg.cscs.ch/7 Resource_List.cput=48:00:00 Resource_List.mem=2000mb Resource_List.neednodes=1 Resource_List.nodect=1 Resource_List.nodes=1 Resource_List.walltime=60:00:00 session=13810 end=1258930800 Exit_status=0 resources_used.cput=00:00:04 resources_used.mem=26312kb resources_used.vmem=253280kb resources_used.walltime=00:01:49
 
+Log files compressed with gzip, bzip2 or xz (e.g., by logrotate) are
+decompressed on the fly.  Directories and shell glob patterns can be
+given on the command line in place of file names, so that a whole
+archive of logs can be loaded in one go.
+
 Results are written to DB 'pbs.db', in a table 'accounting'
-which is created according to the following spec::
+which is created according to the following spec (plus columns
+`unix_group`, `line_hash` and `slots` since schema versions 4, 5 and
+7, see below)::
 
   CREATE TABLE accounting (
     jobid         VARCHAR(32) PRIMARY KEY,
@@ -31,6 +38,163 @@ which is created according to the following spec::
     exit_status   INTEGER
   );
 
+For each job written to table 'accounting', a daily rollup table
+'accounting_daily' is updated in the same transaction; it holds the
+number of jobs and the total used wall-clock and CPU time per
+(date, VO, role, queue) and is what the web interface queries::
+
+  CREATE TABLE accounting_daily (
+    date          DATE NOT NULL,
+    vo            VARCHAR(32) NOT NULL,
+    role          VARCHAR(32) NOT NULL,
+    queue         VARCHAR(16) NOT NULL,
+    jobs          INTEGER UNSIGNED NOT NULL,
+    used_cputime  BIGINT UNSIGNED NOT NULL,
+    used_walltime BIGINT UNSIGNED NOT NULL,
+    PRIMARY KEY (date, vo, role, queue)
+  );
+
+The rollup table can be (re)built from the contents of table
+'accounting' with the ``--rebuild-rollup`` option.
+
+How far each log file has been read is recorded in table
+'ingest_checkpoint', so that a file that is still being written to
+can be loaded again and again, and only the lines appended since the
+previous run are parsed::
+
+  CREATE TABLE ingest_checkpoint (
+    filename      VARCHAR(255) PRIMARY KEY,
+    inode         BIGINT UNSIGNED NOT NULL,
+    byte_offset   BIGINT UNSIGNED NOT NULL,
+    last_line_md5 CHAR(32) NOT NULL
+  );
+
+A checkpoint is discarded (and the file read from the start) if the
+file has been replaced by one with a different inode, or truncated,
+or if the line before the recorded offset does not match
+`last_line_md5`.  Use option ``--rescan`` to ignore checkpoints.
+
+Table 'ingest_watermark' holds a single row, which tells clients
+(e.g., the result cache of the web interface) whether the data has
+changed since they last looked::
+
+  CREATE TABLE ingest_watermark (
+    id            INTEGER PRIMARY KEY,
+    last_date     DATE,
+    serial        INTEGER UNSIGNED NOT NULL,
+    epoch         INTEGER UNSIGNED NOT NULL
+  );
+
+The VO and VOMS role of each job are computed from its UNIX user
+and group by the ordered list of rules in table 'vo_role_map' (its
+initial content is `DEFAULT_VO_ROLE_MAP`)::
+
+  CREATE TABLE vo_role_map (
+    position      INTEGER PRIMARY KEY,
+    user          VARCHAR(32),
+    unix_group    VARCHAR(32),
+    vo            VARCHAR(32) NOT NULL,
+    role          VARCHAR(32) NOT NULL
+  );
+
+A NULL `user` or `unix_group` matches anything.  Since the UNIX group
+of each job is stored in table 'accounting' as well, option
+``--remap`` can apply changed rules to all the jobs already in the
+DB, followed by a rebuild of the rollup table, without reading the
+logs again; option ``--mapping FILE`` replaces the rules with those
+in FILE, one per line, as ``USER GROUP VO ROLE`` (``*`` for any
+user or group).
+
+Since schema version 6, table 'catalog' lists each combination of
+VO, role and queue found in the data, with the dates of the first
+and last job; it is kept up-to-date as records are written, and
+read by the web interface to build the list of VOs and roles::
+
+  CREATE TABLE catalog (
+    vo            VARCHAR(32) NOT NULL,
+    role          VARCHAR(32) NOT NULL,
+    queue         VARCHAR(16) NOT NULL,
+    first_seen    DATE NOT NULL,
+    last_seen     DATE NOT NULL,
+    PRIMARY KEY (vo, role, queue)
+  );
+
+Since schema version 5, table 'accounting' also stores a 64-bit hash
+of the log line each job was loaded from (column `line_hash`).
+Before parsing a job exit record, its hash is looked up among those
+stored for the same date (see `JobFilter`): records already in the
+DB, unchanged, are skipped, so that reloading overlapping sets of
+log files costs little more than reading them.  Use option
+``--force`` to write all records anyway.
+
+Since schema version 7, table 'accounting' also stores the number of
+job slots each job ran on (column `slots`, the number of entries in
+`exec_host`), and table 'occupancy_daily' holds, per (date, VO,
+role), the seconds that jobs (resp. job slots) have been running on
+that day: each job's run time is split at local midnights between
+the days it spans.  Divided by the length of a period, these give
+the average number of running jobs and busy slots; the table is
+maintained together with the rollup table::
+
+  CREATE TABLE occupancy_daily (
+    date          DATE NOT NULL,
+    vo            VARCHAR(32) NOT NULL,
+    role          VARCHAR(32) NOT NULL,
+    job_seconds   BIGINT NOT NULL,
+    slot_seconds  BIGINT NOT NULL,
+    PRIMARY KEY (date, vo, role)
+  );
+
+Since schema version 8, table 'quantile_daily' holds, per (date, VO,
+role) and metric (per-job `walltime`, `mem` and CPU `efficiency`,
+i.e., CPU time over wall-clock time), a sketch of the distribution
+of the metric's values (see module `sketch`), from which the web
+interface estimates percentiles over any range of dates.  Sketches
+are updated as records are written, and rebuilt together with the
+rollup table::
+
+  CREATE TABLE quantile_daily (
+    date          DATE NOT NULL,
+    vo            VARCHAR(32) NOT NULL,
+    role          VARCHAR(32) NOT NULL,
+    metric        VARCHAR(16) NOT NULL,
+    sketch        BLOB NOT NULL,
+    PRIMARY KEY (date, vo, role, metric)
+  );
+
+`last_date` is the most recent job exit date loaded so far: data for
+earlier dates is considered complete.  `serial` is incremented every
+time new records are written, and `epoch` every time existing data
+is rewritten wholesale (e.g., by ``--rebuild-rollup``).
+
+The version of the DB schema is recorded in table 'schema_version';
+``--create-table`` creates the latest version, and ``--migrate``
+upgrades a DB created by an earlier version of this script.  Version
+2 adds composite indexes on (user, date, vo, role) and (date, vo,
+role, queue) to table 'accounting', which include the summed columns
+so that the queries of the web interface and ``--rebuild-rollup``
+are answered from the index alone.  Version 3 (MySQL only)
+partitions table 'accounting' by month of `date`, so that queries
+only read the months they need; its primary key then becomes
+(jobid, date), and partitions for new months are added by each run
+of this script.  Option ``--explain`` prints the execution plans
+of typical queries (before and after the upgrade, if given together
+with ``--migrate``).
+
+For a full reload of the logs, option ``--bulk-load`` drops the
+secondary indexes of table 'accounting', loads all records with
+``LOAD DATA LOCAL INFILE`` (MySQL) or in a single transaction
+(SQLite), then rebuilds the indexes and all rollup tables; see
+`BulkLoader`.  It implies ``--rescan`` and ``--force``: saved
+checkpoints are ignored and all records are written.
+
+With ``--db-engine columnar``, records are written instead into the
+column store implemented in module `colstore` (which requires NumPy),
+in the directory given with ``--db``; the web interface can aggregate
+over it directly, without a database server.  Options ``--create-table``,
+``--rebuild-rollup``, ``--migrate``, ``--explain`` and ``--bulk-load`` do
+not apply to it.
+
 A MySQL db can be created with::
 
   mysql> create user 'pbs'@'ce01.lcg.cscs.ch' IDENTIFIED BY 'TheVerySecretPassword';
@@ -40,100 +204,85 @@ A MySQL db can be created with::
 __docformat__ = 'reStructuredText'
 
 
-# customize the following to fit the current config
+# customize the following to fit the current config: rules
+# `(UNIX user, UNIX group, VO, VOMS role)` are tried in order, and
+# the first one matching both user and group wins; `None` matches
+# any user or group.  This is only the initial content of DB table
+# 'vo_role_map', which is what is actually used (see `--mapping`).
+DEFAULT_VO_ROLE_MAP = [
+    # ATLAS
+    ('atlasprd', None, 'atlas', 'production'),
+    ('atlasplt', None, 'atlas', 'pilot'),
+    ('nordugrid', None, 'atlas', 'NULL'),
+    (None, 'nordugrid', 'atlas', 'NULL'),
+    (None, 'atlas', 'atlas', 'NULL'),
+    # CMS
+    (None, 'prdcms', 'cms', 'production'),
+    (None, 'pricms', 'cms', 'priorityuser'),
+    (None, 'cms', 'cms', 'NULL'),
+    # LHCb
+    ('lhcbprd', None, 'lhcb', 'production'),
+    (None, 'lhcb', 'lhcb', 'NULL'),
+    ]
+
+# the rules in use
+VO_ROLE_MAP = DEFAULT_VO_ROLE_MAP
+
 def creds_to_vo_and_role_map(user, group):
     """
     Given a pair `(user, group)` return a tuple `(vo, role)`
     comprising the VO and the VOMS role that are mapped to it.
     """
-    # ATLAS
-    if user=='atlasprd':
-        return ('atlas', 'production')
-    elif user=='atlasplt':
-        return ('atlas', 'pilot')
-    elif user=='nordugrid' or group=='nordugrid' or group=='atlas':
-        return ('atlas', 'NULL')
-    # CMS
-    elif group=='prdcms':
-        return ('cms', 'production')
-    elif group=='pricms':
-        return ('cms', 'priorityuser')
-    elif group=='cms':
-        return ('cms', 'NULL')
-    # LHCb
-    elif user=='lhcbprd':
-        return ('lhcb', 'production')
-    elif group=='lhcb':
-        return ('lhcb', 'NULL')
+    for rule_user, rule_group, vo, role in VO_ROLE_MAP:
+        if rule_user in (None, user) and rule_group in (None, group):
+            return (vo, role)
     # if a (user,group) pair is not found in the table above,
     # then the group name is considered to be a VO name and
     # returned unchanged.
-    else:
-        return (group, 'NULL')
+    return (group, 'NULL')
 
 
+from optparse import OptionParser
+from array import array
+from bisect import bisect_left
+import datetime
+import glob
+import os
+import Queue
+import signal
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 
-## parse command line
-from optparse import OptionParser
+from sketch import DDSketch, job_values
+try:
+    from hashlib import md5
+except ImportError: # Python < 2.5
+    from md5 import new as md5
+
+
+# placeholder for bound parameters in SQL statements; set by `main`
+# according to the `paramstyle` of the DB module in use
+PARAM = '%s'
 
-parser = OptionParser()
-parser.add_option("-f", "--config", dest="config_file", default=None,
-                  help="read DB connection parameters from this file (overrides other command-line options")
-parser.add_option("-c", "--create-table", dest="create", 
-                  action="store_true", default=False,
-                  help="Create DB table to hold accounting data")
-parser.add_option("-e", "--db-engine", dest="engine", default="mysql",
-                  help="which database backend to use: mysql/sqlite")
-parser.add_option("-D", "--db", dest="db",
-                  help="connect to database DB", metavar="DB")
-parser.add_option("-H", "--host", dest="host",
-                  help="database server host")
-parser.add_option("-u", "--user", dest="user", default="testme",
-                  help="user for connecting to the database")
-parser.add_option("-p", "--password", dest="passwd", default="TheVerySecretPassword",
-                  help="password to connect to database")
-(options, args) = parser.parse_args()
-
-
-## import SQL
-if options.engine == 'mysql':
-    import MySQLdb as sql
-    if options.host is None:
-        options.host = 'localhost'
-    if options.db is None:
-        options.db = 'pbs'
-elif options.engine == 'sqlite':
-    import sqlite as sql
-    if options.db is None:
-        options.db = 'pbs.db'
-else:
-    sys.stderr.write('Unknown value for "--engine" option: %s,'
-                     ' valid values are: mysql, sqlite' % options.engine)
-
-if options.config_file:
-    # get configuration options
-    from ConfigParser import SafeConfigParser
-    config = SafeConfigParser()
-    config.read(options.config_file)
-    options.db = config.get('database', 'db')
-    options.user = config.get('database', 'user')
-    options.host = config.get('database', 'host')
-    options.passwd = config.get('database', 'password')
-
-
-## main: run tests
-
-# initialize DB
-if options.engine == 'mysql':
-    conn = sql.connect(host=options.host, user=options.user, 
-                       passwd=options.passwd, db=options.db)
-else: # sqlite
-    conn = sql.connect(options.db, autocommit=0)
-db = conn.cursor()
-# XXX: SQLite-specific syntax?
-if options.create:
-                      db.execute("""
+# wrapper for binary string parameters (BLOB values); set by `main`
+# to the `Binary` constructor of the DB module in use
+BINARY = str
+
+
+def create_tables(db, engine='mysql'):
+    """Create the DB tables, unless they already exist."""
+    if engine == 'mysql':
+        indexes = """,
+  INDEX (vo),
+  INDEX (role)"""
+    else:
+        # SQLite has no inline index definitions
+        indexes = ""
+    db.execute("""
 CREATE TABLE IF NOT EXISTS accounting (
   jobid         VARCHAR(32) PRIMARY KEY,
   date          DATE NOT NULL,
@@ -152,124 +301,1951 @@ CREATE TABLE IF NOT EXISTS accounting (
   used_walltime INTEGER UNSIGNED,
   used_mem      BIGINT UNSIGNED,
   used_vmem     BIGINT UNSIGNED,
-  exit_status   INTEGER,
-  INDEX (vo),
-  INDEX (role)
+  exit_status   INTEGER%s
+);
+""" % indexes)
+    if engine != 'mysql':
+        db.execute("CREATE INDEX IF NOT EXISTS accounting_vo ON accounting (vo)")
+        db.execute("CREATE INDEX IF NOT EXISTS accounting_role ON accounting (role)")
+    db.execute("""
+CREATE TABLE IF NOT EXISTS accounting_daily (
+  date          DATE NOT NULL,
+  vo            VARCHAR(32) NOT NULL,
+  role          VARCHAR(32) NOT NULL,
+  queue         VARCHAR(16) NOT NULL,
+  jobs          INTEGER UNSIGNED NOT NULL,
+  used_cputime  BIGINT UNSIGNED NOT NULL,
+  used_walltime BIGINT UNSIGNED NOT NULL,
+  PRIMARY KEY (date, vo, role, queue)
+);
+""")
+    db.execute("""
+CREATE TABLE IF NOT EXISTS ingest_checkpoint (
+  filename      VARCHAR(255) PRIMARY KEY,
+  inode         BIGINT UNSIGNED NOT NULL,
+  byte_offset   BIGINT UNSIGNED NOT NULL,
+  last_line_md5 CHAR(32) NOT NULL
+);
+""")
+    db.execute("""
+CREATE TABLE IF NOT EXISTS ingest_watermark (
+  id            INTEGER PRIMARY KEY,
+  last_date     DATE,
+  serial        INTEGER UNSIGNED NOT NULL,
+  epoch         INTEGER UNSIGNED NOT NULL
+);
+""")
+
+
+def rebuild_rollup(db):
+    """Recompute table `accounting_daily` from table `accounting`,
+    and table `catalog` from it."""
+    db.execute("DELETE FROM accounting_daily")
+    db.execute("INSERT INTO accounting_daily"
+               " (date, vo, role, queue, jobs, used_cputime, used_walltime)"
+               " SELECT date, vo, role, queue,"
+               "   COUNT(*), SUM(used_cputime), SUM(used_walltime)"
+               " FROM accounting GROUP BY date, vo, role, queue")
+    version = schema_version(db)
+    if version >= 6:
+        rebuild_catalog(db)
+    if version >= 7:
+        rebuild_occupancy(db)
+    if version >= 8:
+        rebuild_sketches(db)
+    update_watermark(db, epoch=True)
+
+
+def rebuild_catalog(db):
+    """Recompute table `catalog` from table `accounting_daily`."""
+    db.execute("DELETE FROM catalog")
+    db.execute("INSERT INTO catalog (vo, role, queue, first_seen, last_seen)"
+               " SELECT vo, role, queue, MIN(date), MAX(date)"
+               " FROM accounting_daily WHERE jobs > 0 GROUP BY vo, role, queue")
+
+
+def update_catalog(db, vo, role, queue, first, last):
+    """
+    Record in table `catalog` that jobs of the `(vo, role, queue)`
+    combination have been seen between dates `first` and `last`,
+    widening the range already recorded, if any.
+    """
+    db.execute(("UPDATE catalog"
+                " SET first_seen=CASE WHEN first_seen>%s THEN %s ELSE first_seen END,"
+                "  last_seen=CASE WHEN last_seen<%s THEN %s ELSE last_seen END"
+                " WHERE vo=%s AND role=%s AND queue=%s") % ((PARAM,) * 7),
+               (first, first, last, last, vo, role, queue))
+    if db.rowcount == 0:
+        db.execute("INSERT INTO catalog (vo, role, queue, first_seen, last_seen)"
+                   " VALUES (%s)" % str.join(",", [PARAM] * 5),
+                   (vo, role, queue, first, last))
+
+
+def update_watermark(db, last_date=None, epoch=False, first_date=None):
+    """
+    Record in table `ingest_watermark` that new data has been
+    written, up to job exit date `last_date`; if `epoch` is true,
+    record that existing data may have been changed as well.  So
+    does a `first_date` (the earliest date of the rows written or
+    replaced) before the `last_date` recorded so far: data for the
+    dates in between was considered complete.
+    """
+    if epoch:
+        increment = 1
+    else:
+        increment = 0
+    # MySQL assigns from left to right, so `epoch` must be set before
+    # `last_date` to compare `first_date` with the old value
+    if last_date is None:
+        db.execute(("UPDATE ingest_watermark SET serial=serial+1,"
+                    "  epoch=epoch+CASE WHEN last_date>%s THEN 1 ELSE %s END"
+                    " WHERE id=1") % (PARAM, PARAM),
+                   (first_date, increment))
+    else:
+        db.execute(("UPDATE ingest_watermark SET serial=serial+1,"
+                    "  epoch=epoch+CASE WHEN last_date>%s THEN 1 ELSE %s END,"
+                    "  last_date=CASE WHEN last_date IS NULL OR last_date<%s THEN %s ELSE last_date END"
+                    " WHERE id=1") % ((PARAM,) * 4),
+                   (first_date, increment, last_date, last_date))
+    if db.rowcount == 0:
+        db.execute("INSERT INTO ingest_watermark (id, last_date, serial, epoch)"
+                   " VALUES (1, %s, 1, %s)" % (PARAM, PARAM),
+                   (last_date, increment))
+
+
+# local time of the midnight ending each date, see `split_by_day`
+_midnight = {}
+
+def split_by_day(start, end):
+    """
+    Yield a `(date, seconds)` pair for each date (``YYYY-MM-DD``, in
+    local time, like the `date` column) that the time span between
+    UNIX timestamps `start` and `end` overlaps, with the number of
+    seconds of the span falling on that date.
+    """
+    if start <= 0:
+        # job never started
+        return
+    t = start
+    while t < end:
+        tm = time.localtime(t)
+        date = '%04d-%02d-%02d' % tm[:3]
+        try:
+            midnight = _midnight[date]
+        except KeyError:
+            midnight = int(time.mktime((tm[0], tm[1], tm[2]+1, 0, 0, 0, 0, 0, -1)))
+            _midnight[date] = midnight
+        yield date, min(end, midnight) - t
+        t = midnight
+
+
+def rebuild_occupancy(db):
+    """Recompute table `occupancy_daily` from table `accounting`."""
+    totals = {}
+    db.execute("SELECT MIN(date), MAX(date) FROM accounting")
+    first, last = db.fetchone()
+    if first is not None:
+        # one month at a time, to bound memory use (MySQLdb fetches
+        # all rows of a result at once)
+        month = month_start(to_date(first))
+        while month <= to_date(last):
+            db.execute("SELECT vo, role, start_time, end_time, slots FROM accounting"
+                       " WHERE date>=%s AND date<%s" % (PARAM, PARAM),
+                       (str(month), str(month_start(month, 1))))
+            for vo, role, start, end, slots in db.fetchall():
+                for date, seconds in split_by_day(start, end):
+                    t = totals.setdefault((date, vo, role), [0, 0])
+                    t[0] += seconds
+                    t[1] += seconds * (slots or 1)
+            month = month_start(month, 1)
+    db.execute("DELETE FROM occupancy_daily")
+    db.executemany("INSERT INTO occupancy_daily (date, vo, role, job_seconds, slot_seconds)"
+                   " VALUES (%s)" % str.join(",", [PARAM] * 5),
+                   [ (key + tuple(value)) for key, value in totals.iteritems() ])
+
+
+def rebuild_sketches(db):
+    """Recompute table `quantile_daily` from table `accounting`."""
+    db.execute("DELETE FROM quantile_daily")
+    db.execute("SELECT MIN(date), MAX(date) FROM accounting")
+    first, last = db.fetchone()
+    if first is None:
+        return
+    # one month at a time, as in `rebuild_occupancy`; sketches of
+    # a month are complete once its jobs have been read
+    month = month_start(to_date(first))
+    while month <= to_date(last):
+        sketches = {}
+        db.execute("SELECT date, vo, role, used_cputime, used_walltime, used_mem"
+                   " FROM accounting WHERE date>=%s AND date<%s" % (PARAM, PARAM),
+                   (str(month), str(month_start(month, 1))))
+        for date, vo, role, cputime, walltime, mem in db.fetchall():
+            for metric, value in job_values(cputime, walltime, mem):
+                key = (str(date), vo, role, metric)
+                try:
+                    sketch = sketches[key]
+                except KeyError:
+                    sketch = sketches[key] = DDSketch()
+                sketch.add(value)
+        db.executemany("INSERT INTO quantile_daily (date, vo, role, metric, sketch)"
+                       " VALUES (%s)" % str.join(",", [PARAM] * 5),
+                       [ (key + (BINARY(sketch.to_string()),))
+                         for key, sketch in sketches.iteritems() ])
+        month = month_start(month, 1)
+
+
+def update_sketch(db, date, vo, role, metric, delta):
+    """
+    Merge sketch `delta` (whose counts may be negative) into the one
+    stored in table `quantile_daily` for the `(date, vo, role,
+    metric)` combination, creating the row if it does not exist yet,
+    and deleting it if no value is left.
+    """
+    db.execute("SELECT sketch FROM quantile_daily"
+               " WHERE date=%s AND vo=%s AND role=%s AND metric=%s" % ((PARAM,) * 4),
+               (date, vo, role, metric))
+    row = db.fetchone()
+    if row is None:
+        db.execute("INSERT INTO quantile_daily (date, vo, role, metric, sketch)"
+                   " VALUES (%s)" % str.join(",", [PARAM] * 5),
+                   (date, vo, role, metric, BINARY(delta.to_string())))
+        return
+    sketch = DDSketch.from_string(str(row[0]))
+    sketch.merge(delta)
+    if sketch.count() == 0:
+        db.execute("DELETE FROM quantile_daily"
+                   " WHERE date=%s AND vo=%s AND role=%s AND metric=%s" % ((PARAM,) * 4),
+                   (date, vo, role, metric))
+    else:
+        db.execute("UPDATE quantile_daily SET sketch=%s"
+                   " WHERE date=%s AND vo=%s AND role=%s AND metric=%s" % ((PARAM,) * 5),
+                   (BINARY(sketch.to_string()), date, vo, role, metric))
+
+
+def update_occupancy(db, date, vo, role, job_seconds, slot_seconds):
+    """
+    Add `job_seconds` and `slot_seconds` (which may be negative) to
+    the totals stored in table `occupancy_daily` for the `(date, vo,
+    role)` combination, creating the row if it does not exist yet.
+    """
+    db.execute(("UPDATE occupancy_daily"
+                " SET job_seconds=job_seconds+%s, slot_seconds=slot_seconds+%s"
+                " WHERE date=%s AND vo=%s AND role=%s") % ((PARAM,) * 5),
+               (job_seconds, slot_seconds, date, vo, role))
+    if db.rowcount == 0:
+        db.execute("INSERT INTO occupancy_daily (date, vo, role, job_seconds, slot_seconds)"
+                   " VALUES (%s)" % str.join(",", [PARAM] * 5),
+                   (date, vo, role, job_seconds, slot_seconds))
+
+
+def update_rollup(db, date, vo, role, queue, jobs, cputime, walltime):
+    """
+    Add `jobs`, `cputime` and `walltime` (which may be negative)
+    to the totals stored in table `accounting_daily` for the
+    `(date, vo, role, queue)` combination, creating the row if
+    it does not exist yet.
+    """
+    db.execute(("UPDATE accounting_daily"
+                " SET jobs=jobs+%s, used_cputime=used_cputime+%s, used_walltime=used_walltime+%s"
+                " WHERE date=%s AND vo=%s AND role=%s AND queue=%s")
+               % ((PARAM,) * 7),
+               (jobs, cputime, walltime, date, vo, role, queue))
+    if db.rowcount == 0:
+        db.execute(("INSERT"
+                    " INTO accounting_daily (date, vo, role, queue, jobs, used_cputime, used_walltime)"
+                    " VALUES (%s)") % str.join(",", [PARAM] * 7),
+                   (date, vo, role, queue, jobs, cputime, walltime))
+
+
+## schema versions
+#
+# Changes to the DB schema are applied by `migrate`, in order, as
+# listed in `MIGRATIONS`; table `schema_version` records which ones
+# have already been applied.  Version 1 is the schema created by
+# `create_tables`.  To change the schema, append a new migration:
+# never edit one that has been released.
+
+def create_schema_version(db):
+    db.execute("""
+CREATE TABLE IF NOT EXISTS schema_version (
+  version       INTEGER PRIMARY KEY,
+  description   VARCHAR(255) NOT NULL,
+  applied       INTEGER UNSIGNED NOT NULL
+);
+""")
+
+
+def schema_version(db):
+    """Return the version of the DB schema, or 0 for a new DB."""
+    create_schema_version(db)
+    db.execute("SELECT MAX(version) FROM schema_version")
+    version = db.fetchone()[0]
+    if version is None:
+        return 0
+    return version
+
+
+# secondary indexes of table `accounting`, as `(name, columns)`
+# pairs: those of the initial schema (in MySQL, named after the
+# column) and those that replace them since schema version 2
+INITIAL_INDEXES = {
+    'mysql':[ ('vo', '(vo)'), ('role', '(role)') ],
+    'sqlite':[ ('accounting_vo', '(vo)'), ('accounting_role', '(role)') ],
+    }
+COVERING_INDEXES = [
+    ('accounting_date_vo_role', '(date, vo, role, queue, used_cputime, used_walltime)'),
+    ('accounting_user_date', '(user, date, vo, role, used_cputime, used_walltime)'),
+    ]
+
+def add_covering_indexes(db, engine):
+    # the per-user plots of the web interface filter on `user` and
+    # a `date` range, then on VO and role; `--rebuild-rollup` groups
+    # by date, VO, role and queue.  Both indexes include the summed
+    # columns, so that the table rows need not be read at all.
+    # (`jobid` is the primary key: MySQL adds it to every index.)
+    if engine == 'mysql':
+        db.execute("ALTER TABLE accounting %s"
+                   % str.join(", ", [ ("DROP INDEX %s" % name)
+                                      for name, columns in INITIAL_INDEXES[engine] ]
+                              + [ ("ADD INDEX %s %s" % index)
+                                  for index in COVERING_INDEXES ]))
+    else:
+        for name, columns in INITIAL_INDEXES[engine]:
+            db.execute("DROP INDEX IF EXISTS %s" % name)
+        for index in COVERING_INDEXES:
+            db.execute("CREATE INDEX %s ON accounting %s" % index)
+        # with InnoDB, the rows of `accounting_daily` are stored in
+        # primary key order already; SQLite needs an index to answer
+        # plot queries without reading the table
+        db.execute("CREATE INDEX accounting_daily_cover ON accounting_daily"
+                   " (date, vo, role, jobs, used_cputime, used_walltime)")
+
+
+def accounting_indexes(engine, version):
+    """Return the secondary indexes of table `accounting` at schema
+    `version`, as `(name, columns)` pairs."""
+    if version >= 2:
+        return COVERING_INDEXES
+    else:
+        return INITIAL_INDEXES[engine]
+
+
+def drop_accounting_indexes(db, engine, version):
+    """Drop the secondary indexes of table `accounting` (those that
+    exist: a previous run may have been interrupted)."""
+    if engine == 'mysql':
+        db.execute("SHOW INDEX FROM accounting")
+        existing = set([ row[2] for row in db.fetchall() ])
+        drop = [ name for name, columns in accounting_indexes(engine, version)
+                 if name in existing ]
+        if drop:
+            db.execute("ALTER TABLE accounting %s"
+                       % str.join(", ", [ ("DROP INDEX %s" % name) for name in drop ]))
+    else:
+        for name, columns in accounting_indexes(engine, version):
+            db.execute("DROP INDEX IF EXISTS %s" % name)
+
+
+def create_accounting_indexes(db, engine, version):
+    """Create the secondary indexes of table `accounting` that
+    `drop_accounting_indexes` dropped."""
+    if engine == 'mysql':
+        db.execute("SHOW INDEX FROM accounting")
+        existing = set([ row[2] for row in db.fetchall() ])
+        add = [ index for index in accounting_indexes(engine, version)
+                if index[0] not in existing ]
+        if add:
+            # one statement, so the table is read only once
+            db.execute("ALTER TABLE accounting %s"
+                       % str.join(", ", [ ("ADD INDEX %s %s" % index) for index in add ]))
+    else:
+        for index in accounting_indexes(engine, version):
+            db.execute("CREATE INDEX IF NOT EXISTS %s ON accounting %s" % index)
+
+
+def to_date(value):
+    """Return the DB value `value` of a DATE column as a `datetime.date`
+    (SQLite returns strings)."""
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date(*[ int(x) for x in str(value).split('-') ])
+
+
+def month_start(date, months=0):
+    """Return the first day of the month of `date`, moved forward
+    by `months` months."""
+    m = date.year * 12 + date.month - 1 + months
+    return datetime.date(m / 12, m % 12 + 1, 1)
+
+
+def partition_by_month(db, engine):
+    # MySQL only: partition the per-job table by month of the exit
+    # date, so that queries on a date range only read the partitions
+    # that overlap it.  The partitioning column must be part of every
+    # unique key, hence the primary key is extended with `date`.
+    if engine != 'mysql':
+        return
+    db.execute("SELECT MIN(date) FROM accounting")
+    first = db.fetchone()[0] or datetime.date.today()
+    db.execute("ALTER TABLE accounting DROP PRIMARY KEY, ADD PRIMARY KEY (jobid, date)")
+    partitions = []
+    month = month_start(first)
+    while month <= month_start(datetime.date.today()):
+        partitions.append(month)
+        month = month_start(month, 1)
+    db.execute("ALTER TABLE accounting PARTITION BY RANGE (TO_DAYS(date)) (%s)"
+               % partition_definitions(partitions))
+
+
+def partition_definitions(months):
+    """Return the SQL definitions of monthly partitions of table
+    `accounting` for `months`, plus a catch-all one."""
+    return str.join(", ", [
+        ("PARTITION p%04d%02d VALUES LESS THAN (TO_DAYS('%s'))"
+         % (month.year, month.month, month_start(month, 1)))
+        for month in months ] + [ "PARTITION pmax VALUES LESS THAN MAXVALUE" ])
+
+
+def extend_partitions(db, until=None):
+    """
+    Split monthly partitions, up to the month of date `until`
+    (default: next month), off the catch-all partition of table
+    `accounting`.  Does nothing if the table is not partitioned.
+    """
+    if until is None:
+        until = month_start(datetime.date.today(), 1)
+    db.execute("SELECT partition_name FROM information_schema.partitions"
+               " WHERE table_schema=DATABASE() AND table_name='accounting'"
+               "  AND partition_name IS NOT NULL")
+    names = [ row[0] for row in db.fetchall() ]
+    if 'pmax' not in names:
+        return
+    last = max([ name for name in names if name != 'pmax' ])
+    month = month_start(datetime.date(int(last[1:5]), int(last[5:7]), 1), 1)
+    months = []
+    while month <= until:
+        months.append(month)
+        month = month_start(month, 1)
+    if months:
+        db.execute("ALTER TABLE accounting REORGANIZE PARTITION pmax INTO (%s)"
+                   % partition_definitions(months))
+
+
+def add_unix_group(db, engine):
+    # keep the UNIX group of each job, so that the VO/role mapping
+    # can be changed later without reloading the logs; the mapping
+    # rules are moved into the DB for the same reason
+    db.execute("ALTER TABLE accounting ADD COLUMN unix_group VARCHAR(32)")
+    db.execute("""
+CREATE TABLE IF NOT EXISTS vo_role_map (
+  position      INTEGER PRIMARY KEY,
+  user          VARCHAR(32),
+  unix_group    VARCHAR(32),
+  vo            VARCHAR(32) NOT NULL,
+  role          VARCHAR(32) NOT NULL
+);
+""")
+    store_vo_role_map(db, DEFAULT_VO_ROLE_MAP)
+
+
+def add_line_hash(db, engine):
+    # hash of the log line each job was loaded from, see `JobFilter`
+    db.execute("ALTER TABLE accounting ADD COLUMN line_hash BIGINT")
+
+
+def add_catalog(db, engine):
+    # the VO, role and queue values found in the data, so that the
+    # web interface need not scan table `accounting` to list them
+    db.execute("""
+CREATE TABLE IF NOT EXISTS catalog (
+  vo            VARCHAR(32) NOT NULL,
+  role          VARCHAR(32) NOT NULL,
+  queue         VARCHAR(16) NOT NULL,
+  first_seen    DATE NOT NULL,
+  last_seen     DATE NOT NULL,
+  PRIMARY KEY (vo, role, queue)
+);
+""")
+    rebuild_catalog(db)
+
+
+def add_occupancy(db, engine):
+    # number of job slots used by each job, and the time that jobs
+    # of each VO and role have been running on each day, whatever
+    # the day they ended
+    db.execute("ALTER TABLE accounting ADD COLUMN slots INTEGER UNSIGNED")
+    db.execute("""
+CREATE TABLE IF NOT EXISTS occupancy_daily (
+  date          DATE NOT NULL,
+  vo            VARCHAR(32) NOT NULL,
+  role          VARCHAR(32) NOT NULL,
+  job_seconds   BIGINT NOT NULL,
+  slot_seconds  BIGINT NOT NULL,
+  PRIMARY KEY (date, vo, role)
+);
+""")
+    rebuild_occupancy(db)
+
+
+def add_quantile_sketches(db, engine):
+    # distribution of per-job wall-clock time, memory and CPU
+    # efficiency, as a quantile sketch (see module `sketch`)
+    db.execute("""
+CREATE TABLE IF NOT EXISTS quantile_daily (
+  date          DATE NOT NULL,
+  vo            VARCHAR(32) NOT NULL,
+  role          VARCHAR(32) NOT NULL,
+  metric        VARCHAR(16) NOT NULL,
+  sketch        BLOB NOT NULL,
+  PRIMARY KEY (date, vo, role, metric)
 );
 """)
+    rebuild_sketches(db)
+
+
+# (version, description, function) applying the change for a given
+# DB engine; functions are called in order, with the DB cursor and
+# the engine name as arguments
+MIGRATIONS = [
+    (1, "initial schema", create_tables),
+    (2, "covering indexes for date range queries", add_covering_indexes),
+    (3, "monthly partitions of table accounting (MySQL only)", partition_by_month),
+    (4, "UNIX group of jobs and VO/role mapping table", add_unix_group),
+    (5, "hash of the log line of jobs", add_line_hash),
+    (6, "catalog of VO, role and queue values", add_catalog),
+    (7, "job slots and daily occupancy table", add_occupancy),
+    (8, "daily quantile sketches of job metrics", add_quantile_sketches),
+    ]
+
+
+def migrate(db, engine='mysql', target=None):
+    """
+    Bring the DB schema to version `target` (default: the latest
+    one), by applying the pending `MIGRATIONS`.  Return the list of
+    versions applied.  Migration 1 only creates the tables that do
+    not exist yet, so DBs created by earlier versions of this script,
+    which did not track the schema version, are upgraded as well.
+    """
+    version = schema_version(db)
+    applied = []
+    for number, description, change in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        change(db, engine)
+        db.execute("INSERT INTO schema_version (version, description, applied)"
+                   " VALUES (%s, %s, %s)" % (PARAM, PARAM, PARAM),
+                   (number, description, int(time.time())))
+        applied.append(number)
+    return applied
+
+
+
+## VO/role mapping
+
+def load_vo_role_map(db):
+    """Return the rules in table 'vo_role_map', in order."""
+    db.execute("SELECT user, unix_group, vo, role FROM vo_role_map ORDER BY position")
+    return [ tuple(row) for row in db.fetchall() ]
+
+
+def store_vo_role_map(db, rules):
+    """Replace the contents of table 'vo_role_map' with `rules`."""
+    db.execute("DELETE FROM vo_role_map")
+    db.executemany("INSERT INTO vo_role_map (position, user, unix_group, vo, role)"
+                   " VALUES (%s)" % str.join(",", [PARAM] * 5),
+                   [ ((n,) + tuple(rule)) for n, rule in enumerate(rules) ])
+
+
+def read_vo_role_map(filename):
+    """
+    Read mapping rules from file `filename`: one per line, as
+    whitespace-separated UNIX user, UNIX group, VO and VOMS role,
+    where ``*`` matches any user or group.  Empty lines and lines
+    starting with ``#`` are ignored.
+    """
+    rules = []
+    for n, line in enumerate(open(filename, 'r')):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) != 4:
+            raise ValueError("%s, line %d: expected 4 fields (user, group, VO, role), got %d"
+                             % (filename, n+1, len(fields)))
+        user, group, vo, role = fields
+        rules.append((user != '*' and user or None,
+                      group != '*' and group or None,
+                      vo, role))
+    return rules
+
+
+def remap(db, rules):
+    """
+    Recompute the VO and role of all jobs in table 'accounting'
+    according to `rules` (see `DEFAULT_VO_ROLE_MAP`), then rebuild
+    the rollup table.  Return the number of jobs whose UNIX group
+    is unknown, which could not be remapped.
+    """
+    # a single pass over the table: in a ``CASE`` expression, the
+    # first matching rule wins, as in `creds_to_vo_and_role_map`
+    vo_case = [ "CASE" ]
+    role_case = [ "CASE" ]
+    vo_params = []
+    role_params = []
+    for user, group, vo, role in rules:
+        condition = []
+        params = []
+        if user is not None:
+            condition.append("user=%s" % PARAM)
+            params.append(user)
+        if group is not None:
+            condition.append("unix_group=%s" % PARAM)
+            params.append(group)
+        when = "WHEN %s THEN %s" % (str.join(" AND ", condition) or "1=1", PARAM)
+        vo_case.append(when)
+        vo_params.extend(params + [vo])
+        role_case.append(when)
+        role_params.extend(params + [role])
+    vo_case.append("ELSE unix_group END")
+    role_case.append("ELSE 'NULL' END")
+    if not rules:
+        vo_case = [ "unix_group" ]
+        role_case = [ "'NULL'" ]
+    db.execute("UPDATE accounting SET vo=%s, role=%s WHERE unix_group IS NOT NULL"
+               % (str.join(" ", vo_case), str.join(" ", role_case)),
+               vo_params + role_params)
+    rebuild_rollup(db)
+    db.execute("SELECT COUNT(*) FROM accounting WHERE unix_group IS NULL")
+    return db.fetchone()[0]
+
+
+# queries whose plans are shown by `--explain`: they have the same
+# shape as the ones run by the web interface and `--rebuild-rollup`;
+# parameters are the first and last date of a month and a user name
+EXPLAIN_QUERIES = [
+    ("monthly plot",
+     "SELECT SUBSTR(date,1,7) AS period,vo,role,SUM(used_walltime) FROM accounting_daily"
+     " WHERE date>=%(p)s AND date<=%(p)s GROUP BY period,vo,role", 2),
+    ("per-user plot",
+     "SELECT SUBSTR(date,1,7) AS period,SUM(used_walltime) FROM accounting"
+     " WHERE date>=%(p)s AND date<=%(p)s AND user=%(p)s AND vo=%(p)s GROUP BY period", 4),
+    ("rollup rebuild, one month",
+     "SELECT date, vo, role, queue, COUNT(*), SUM(used_cputime), SUM(used_walltime)"
+     " FROM accounting WHERE date>=%(p)s AND date<=%(p)s GROUP BY date, vo, role, queue", 2),
+    ]
+
+def explain(db, engine='mysql', output=sys.stdout):
+    """Print the execution plans of `EXPLAIN_QUERIES` to `output`,
+    for the last month of data in the DB."""
+    db.execute("SELECT MAX(date) FROM accounting")
+    last = db.fetchone()[0]
+    if last is None:
+        output.write("Table 'accounting' is empty, nothing to explain.\n")
+        return
+    last = to_date(last)
+    date1 = str(month_start(last))
+    date2 = str(month_start(last, 1) - datetime.timedelta(days=1))
+    db.execute("SELECT user, vo FROM accounting WHERE date>=%s AND date<=%s LIMIT 1"
+               % (PARAM, PARAM), (date1, date2))
+    user, vo = db.fetchone()
+    if engine == 'mysql':
+        prefix = "EXPLAIN "
+    else:
+        prefix = "EXPLAIN QUERY PLAN "
+    for title, query, nparams in EXPLAIN_QUERIES:
+        query = query % { 'p':PARAM }
+        params = (date1, date2, user, vo)[:nparams]
+        output.write("-- %s\n%s\n" % (title, query))
+        db.execute(prefix + query, params)
+        names = [ column[0] for column in db.description ]
+        for row in db.fetchall():
+            output.write("   %s\n" % str.join(" ", [ ("%s=%s" % (name, value))
+                                                   for name, value in zip(names, row)
+                                                   if value is not None ]))
+        output.write("\n")
+
+
+## parsing of PBS accounting logs
+
+# TORQUE attributes that are stored in the DB; all others are
+# discarded right after splitting the line
+NEEDED_ATTRS = frozenset([
+    'Exit_status',
+    'Resource_List.cput',
+    'Resource_List.mem',
+    'Resource_List.walltime',
+    'end',
+    'etime',
+    'exec_host',
+    'group',
+    'queue',
+    'resources_used.cput',
+    'resources_used.mem',
+    'resources_used.vmem',
+    'resources_used.walltime',
+    'start',
+    'user',
+    ])
 
 
-class Record(object):
-    
-    ATTRS_TO_COLUMNS_MAP = {
-        'Exit_status':'exit_status',
-        'Resource_List.cput':'req_cputime',
-        'Resource_List.mem':'req_mem',
-        'Resource_List.pmem':None,
-        'Resource_List.pvmem':None,
-        'Resource_List.vmem':None,
-        'Resource_List.neednodes':None,
-        'Resource_List.nodect':None,
-        'Resource_List.nodes':None,
-        'Resource_List.walltime':'req_walltime',
-        'ctime':None,
-        'end':'end_time',
-        'etime':'timestamp',
-        'exec_host':'wn',
-        'group':'group',
-        'jobname':None,
-        'owner':None,
-        'queue':'queue',
-        'qtime':None,
-        'resources_used.cput':'used_cputime',
-        'resources_used.mem':'used_mem',
-        'resources_used.vmem':'used_vmem',
-        'resources_used.walltime':'used_walltime',
-        'session':None,
-        'start':'start_time',
-        'user':'user',
-        }
-
-    def __init__(self, jobid, timestamp, attrs):
-        self.jobid = jobid
-        
-        # provide defaults
-        self.req_mem = '0'
-        self.req_cputime = '0:00:00'
-        self.req_walltime = '0:00:00'
-
-        # parse timestamp 
-        date, time = timestamp.split()
-        month, day, year = date.split("/")
-        self.date = '%s-%s-%s' % (year, month, day)
-        
-        # parse attrs
-        for kv in attrs.split():
-            key, val = kv.split("=")
+def to_seconds(val):
+    """Convert a TORQUE time value ``HH:MM:SS`` into seconds."""
+    hrs, mins, secs = val.split(":")
+    return int(hrs)*3600 + int(mins)*60 + int(secs)
+
+
+MEM_UNITS = {
+    'kb':1024,
+    'mb':1024*1024,
+    'gb':1024*1024*1024,
+    }
+
+def to_bytes(val):
+    """Convert a TORQUE memory value like ``26312kb`` into bytes."""
+    if 'b' != val[-1]:
+        return int(val)
+    try:
+        return int(val[:-2]) * MEM_UNITS[val[-2:]]
+    except KeyError: # plain bytes, e.g. ``512b``
+        return int(val[:-1])
+
+
+# cache of `creds_to_vo_and_role_map` results
+_vo_and_role = {}
+
+def parse_line(line):
+    """
+    Parse a line from a PBS accounting log.  Return `None` if it is
+    not a job exit (E) record, otherwise the tuple of values of the
+    'accounting' table columns, in the order of `BulkWriter.COLUMNS`.
+    Raise `ValueError` if the record lacks a required attribute.
+    """
+    # the timestamp ``MM/DD/YYYY HH:MM:SS`` has fixed width, so
+    # other records can be skipped without splitting the line
+    if line[19:22] != ';E;':
+        return None
+    timestamp, kind, jobid, attrs = line.split(";", 3)
+    a = {}
+    for kv in attrs.split():
+        key, sep, val = kv.partition("=")
+        if key in NEEDED_ATTRS:
+            a[key] = val
+    try:
+        used_cputime = to_seconds(a['resources_used.cput'])
+        used_walltime = to_seconds(a['resources_used.walltime'])
+        used_mem = to_bytes(a['resources_used.mem'])
+        used_vmem = to_bytes(a['resources_used.vmem'])
+        user = a['user']
+        group = a['group']
+        row_head = (jobid,
+                    timestamp[6:10] + '-' + timestamp[0:2] + '-' + timestamp[3:5],
+                    a['etime'])
+        row_tail = (a['queue'], a['start'], a['end'],
+                    # only keep hostname for WNs
+                    a['exec_host'].split(".", 1)[0],
+                    to_seconds(a.get('Resource_List.cput', '0:00:00')),
+                    to_seconds(a.get('Resource_List.walltime', '0:00:00')),
+                    to_bytes(a.get('Resource_List.mem', '0')),
+                    used_cputime, used_walltime, used_mem, used_vmem,
+                    a['Exit_status'])
+    except KeyError, x:
+        raise ValueError("missing required attribute '%s'" % x.args[0])
+    # convert group names to VO names
+    try:
+        vo_and_role = _vo_and_role[user, group]
+    except KeyError:
+        vo_and_role = creds_to_vo_and_role_map(user, group)
+        _vo_and_role[user, group] = vo_and_role
+    # ``exec_host`` lists one ``host/slot`` item per slot used
+    slots = a['exec_host'].count('+') + 1
+    return (row_head + (user,) + vo_and_role + row_tail
+            + (group, line_hash(line), slots))
+
+
+def line_hash(line):
+    """Return a 64-bit hash of the log record `line`, as a (signed)
+    integer that fits a SQL ``BIGINT`` column."""
+    return struct.unpack('<q', md5(line.rstrip()).digest()[:8])[0]
+
+
+def line_date(line):
+    """Return the date of the log record `line`, as ``YYYY-MM-DD``."""
+    return line[6:10] + '-' + line[0:2] + '-' + line[3:5]
+
+
+class JobFilter(object):
+    """
+    Tell whether a job exit record has already been loaded into the
+    DB, unchanged, by looking up the hash of its line (see
+    `line_hash`) among those stored in table 'accounting' for the
+    same date.  The hashes of a date are loaded from the DB the first
+    time it is looked up, and kept in a sorted array; only the
+    `max_dates` most recently loaded dates are kept in memory.
+    """
+
+    def __init__(self, db, max_dates=64):
+        self.db = db
+        self.max_dates = max_dates
+        self.hashes = {}
+        self.dates = []
+        self.skipped = 0
+
+    def _load(self, date):
+        self.db.execute("SELECT line_hash FROM accounting"
+                        " WHERE date=%s AND line_hash IS NOT NULL" % PARAM, (date,))
+        hashes = sorted([ row[0] for row in self.db.fetchall() ])
+        if array('l').itemsize == 8:
+            # 8 bytes per hash instead of a Python object each
+            hashes = array('l', hashes)
+        if len(self.dates) >= self.max_dates:
+            del self.hashes[self.dates.pop(0)]
+        self.hashes[date] = hashes
+        self.dates.append(date)
+        return hashes
+
+    def contains(self, date, h):
+        """Return `True` if a job with exit date `date` (a string)
+        and line hash `h` is in the DB."""
+        try:
+            hashes = self.hashes[date]
+        except KeyError:
+            hashes = self._load(date)
+        i = bisect_left(hashes, h)
+        if i < len(hashes) and hashes[i] == h:
+            self.skipped += 1
+            return True
+        return False
+
+    def seen(self, line):
+        """Return `True` if the job exit record `line` is in the DB."""
+        return self.contains(line_date(line), line_hash(line))
+
+
+class BulkWriter(object):
+    """
+    Buffer parsed records and write them into the DB in batches
+    of `batch_size`, using one `executemany` call with bound
+    parameters per batch.  The daily rollup table is updated and
+    the transaction committed at the end of each batch, so an
+    interrupted run only loses the current batch.
+    """
+
+    COLUMNS = ('jobid', 'date', 'timestamp', 'user', 'vo', 'role', 'queue', 'start_time', 'end_time', 'wn', 'req_cputime', 'req_walltime', 'req_mem', 'used_cputime', 'used_walltime', 'used_mem', 'used_vmem', 'exit_status', 'unix_group', 'line_hash', 'slots')
+
+    # schema version (see `MIGRATIONS`) that added each column,
+    # if later than 1; such columns must come last in `COLUMNS`
+    SINCE = { 'unix_group':4, 'line_hash':5, 'slots':7 }
+
+    # SQLite limits the number of bound parameters in a statement
+    # to 999 by default, so look up old records in chunks
+    LOOKUP_CHUNK = 500
+
+    def __init__(self, conn, batch_size=1000):
+        self.conn = conn
+        self.db = conn.cursor()
+        self.batch_size = batch_size
+        # leave out the columns added by later schema versions
+        version = schema_version(self.db)
+        self.columns = [ name for name in BulkWriter.COLUMNS
+                         if BulkWriter.SINCE.get(name, 1) <= version ]
+        self.occupancy = (version >= 7)
+        self.sketches = (version >= 8)
+        # if set to a `JobFilter`, records already in the DB are skipped
+        self.seen = None
+        # map `(vo, role, queue)` to the `(first, last)` date range
+        # already recorded in table `catalog` (if there is one)
+        if version >= 6:
+            self.catalog = {}
+        else:
+            self.catalog = None
+        # map jobid to row; a later record for the same job replaces
+        # an earlier one, just as `REPLACE` would do
+        self.pending = {}
+        # map file name to `(inode, offset, last line)`
+        self.checkpoints = {}
+        # map file name to `(inode, offset)` of all files seen so far
+        self.positions = {}
+
+    def add(self, row):
+        """Queue a row of column values (see `parse_line`) for writing."""
+        self.pending[row[0]] = row
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def checkpoint(self, filename, inode, offset, line):
+        """
+        Record that file `filename` has been read up to byte `offset`,
+        `line` being the last line read.  The checkpoint is saved to
+        the DB together with the next batch of records.
+        """
+        self.checkpoints[filename] = (inode, offset, line)
+        self.positions[filename] = (inode, offset)
+
+    def find_checkpoint(self, filename, logfile):
+        """
+        Return the offset into `logfile` up to which it has already
+        been ingested, or 0 if there is no valid checkpoint for it.
+        """
+        self.db.execute("SELECT inode, byte_offset, last_line_md5"
+                        " FROM ingest_checkpoint WHERE filename=%s" % PARAM,
+                        (filename,))
+        row = self.db.fetchone()
+        if row is None:
+            return 0
+        inode, offset, digest = row
+        return check_checkpoint(logfile, inode, offset, digest)
+
+    def flush(self):
+        """Write all buffered records and checkpoints to the DB and commit."""
+        if not (self.pending or self.checkpoints):
+            return
+        if self.pending:
+            self._write_records()
+        for filename, (inode, offset, line) in self.checkpoints.iteritems():
+            self.db.execute("REPLACE INTO ingest_checkpoint"
+                            " (filename, inode, byte_offset, last_line_md5)"
+                            " VALUES (%s)" % str.join(",", [PARAM] * 4),
+                            (filename, inode, offset, md5(line).hexdigest()))
+        self.conn.commit()
+        self.pending = {}
+        self.checkpoints = {}
+
+    def _write_records(self):
+        # compute changes to the rollup table: the old values of jobs
+        # that are already in the DB must be taken out first
+        deltas = {}
+        def account(key, jobs, cputime, walltime):
+            d = deltas.setdefault(key, [0, 0, 0])
+            d[0] += jobs
+            d[1] += cputime
+            d[2] += walltime
+        # same for table `occupancy_daily`
+        occupancy = {}
+        def occupy(vo, role, start, end, slots, sign):
+            for date, seconds in split_by_day(int(start or 0), int(end or 0)):
+                o = occupancy.setdefault((date, vo, role), [0, 0])
+                o[0] += sign * seconds
+                o[1] += sign * seconds * (slots or 1)
+        # same for table `quantile_daily`
+        sketches = {}
+        def sketch(date, vo, role, cputime, walltime, mem, count):
+            for metric, value in job_values(cputime, walltime, mem):
+                key = (date, vo, role, metric)
+                try:
+                    delta = sketches[key]
+                except KeyError:
+                    delta = sketches[key] = DDSketch()
+                delta.add(value, count)
+        if self.occupancy:
+            extra = ", used_mem, start_time, end_time, slots"
+        elif self.sketches:
+            extra = ", used_mem"
+        else:
+            extra = ""
+        jobids = self.pending.keys()
+        # old records of the same job with a different date: on a
+        # partitioned table (see `partition_by_month`) the primary key
+        # is `(jobid, date)`, so `REPLACE` would not remove them
+        stale = []
+        for n in range(0, len(jobids), BulkWriter.LOOKUP_CHUNK):
+            chunk = jobids[n:n+BulkWriter.LOOKUP_CHUNK]
+            self.db.execute("SELECT jobid, date, vo, role, queue, used_cputime, used_walltime%s"
+                            " FROM accounting WHERE jobid IN (%s)"
+                            % (extra, str.join(",", [PARAM] * len(chunk))),
+                            chunk)
+            for old in self.db.fetchall():
+                jobid, date, vo, role, queue, cputime, walltime = old[:7]
+                account((str(date), vo, role, queue), -1, -cputime, -walltime)
+                if self.sketches:
+                    sketch(str(date), vo, role, cputime, walltime, old[7], -1)
+                if self.occupancy:
+                    occupy(vo, role, old[8], old[9], old[10], -1)
+                if str(date) != self.pending[jobid][1]:
+                    stale.append((jobid, date))
+        if stale:
+            self.db.executemany("DELETE FROM accounting WHERE jobid=%s AND date=%s"
+                                % (PARAM, PARAM), stale)
+        rows = self.pending.values()
+        for row in rows:
+            account((row[1], row[4], row[5], row[6]), 1, row[13], row[14])
+            if self.occupancy:
+                occupy(row[4], row[5], row[7], row[8], row[20], 1)
+            if self.sketches:
+                sketch(row[1], row[4], row[5], row[13], row[14], row[15], 1)
+        n = len(self.columns)
+        if n < len(BulkWriter.COLUMNS):
+            rows = [ row[:n] for row in rows ]
+        self.db.executemany("REPLACE INTO accounting (%s) VALUES (%s)"
+                            % (str.join(",", self.columns), str.join(",", [PARAM] * n)),
+                            rows)
+        for (date, vo, role, queue), (jobs, cputime, walltime) in deltas.iteritems():
+            if jobs != 0 or cputime != 0 or walltime != 0:
+                update_rollup(self.db, date, vo, role, queue, jobs, cputime, walltime)
+        for (date, vo, role), (job_seconds, slot_seconds) in occupancy.iteritems():
+            if job_seconds != 0 or slot_seconds != 0:
+                update_occupancy(self.db, date, vo, role, job_seconds, slot_seconds)
+        for (date, vo, role, metric), delta in sketches.iteritems():
+            if delta.buckets or delta.zeros:
+                update_sketch(self.db, date, vo, role, metric, delta)
+        if self.catalog is not None:
+            for key, (first, last) in date_ranges(rows).iteritems():
+                known = self.catalog.get(key)
+                if known is not None:
+                    if known[0] <= first and last <= known[1]:
+                        continue
+                    first, last = min(first, known[0]), max(last, known[1])
+                update_catalog(self.db, key[0], key[1], key[2], first, last)
+                self.catalog[key] = (first, last)
+        # late records, `--rescan` and re-dated jobs change the totals
+        # of days the web interface may have cached as final; changes
+        # to the occupancy of past days are expected, see `joplot.py`
+        update_watermark(self.db, max([ row[1] for row in rows ]),
+                         first_date=min([ key[0] for key in deltas ]))
+
+
+def date_ranges(rows):
+    """Return a dictionary mapping each `(vo, role, queue)` found
+    in `rows` to the `(first, last)` dates of its jobs."""
+    ranges = {}
+    for row in rows:
+        key = (row[4], row[5], row[6])
+        date = row[1]
+        if key in ranges:
+            first, last = ranges[key]
+            if date < first:
+                ranges[key] = (date, last)
+            elif date > last:
+                ranges[key] = (first, date)
+        else:
+            ranges[key] = (date, date)
+    return ranges
+
+
+class ColumnarWriter(BulkWriter):
+    """
+    Like `BulkWriter`, but write records into a `colstore.ColumnStore`
+    instead of a SQL database.  There is no rollup table to maintain:
+    the web interface aggregates the columns directly.
+    """
+
+    def __init__(self, store, batch_size=1000):
+        self.store = store
+        self.db = None
+        self.seen = None
+        self.batch_size = batch_size
+        self.pending = {}
+        self.checkpoints = {}
+        self.positions = {}
+
+    def find_checkpoint(self, filename, logfile):
+        saved = self.store.checkpoint(filename)
+        if saved is None:
+            return 0
+        inode, offset, digest = saved
+        return check_checkpoint(logfile, inode, offset, digest)
+
+    def flush(self):
+        if not (self.pending or self.checkpoints):
+            return
+        if self.pending:
+            rows = self.pending.values()
+            first_date = self.store.write(rows, BulkWriter.COLUMNS)
+            self.store.update_catalog(date_ranges(rows))
+            self.store.update_watermark(max([ row[1] for row in rows ]), first_date)
+        if self.checkpoints:
+            checkpoints = {}
+            for filename, (inode, offset, line) in self.checkpoints.iteritems():
+                checkpoints[filename] = (inode, offset, md5(line).hexdigest())
+            self.store.save_checkpoints(checkpoints)
+        self.pending = {}
+        self.checkpoints = {}
+
+
+class BulkLoader(BulkWriter):
+    """
+    Like `BulkWriter`, but for full reloads of the logs (option
+    ``--bulk-load``): the secondary indexes of table 'accounting' are
+    dropped, all records are loaded with the DB's fastest method, then
+    the indexes and the rollup tables are rebuilt from scratch.
+
+    With MySQL, records are written to a temporary TSV file, which is
+    loaded with ``LOAD DATA LOCAL INFILE ... REPLACE``.  With SQLite,
+    they are inserted with ``REPLACE`` in a single transaction, with
+    syncing to disk turned off.  Either way, a later record for the
+    same job replaces an earlier one, as with `BulkWriter`.  Nothing
+    is written to the DB until `flush` is called, at the end of the
+    run.  The time taken by each step is recorded in `timings`.
+    """
+
+    def __init__(self, conn, engine, batch_size=1000):
+        BulkWriter.__init__(self, conn, batch_size)
+        self.engine = engine
+        self.version = schema_version(self.db)
+        self.loaded = 0
+        self.last_date = None
+        # list of `(step, seconds)` pairs
+        self.timings = []
+        self._started = None
+        self._rows = []
+        self._tsv = None
+
+    def add(self, row):
+        """Queue a row of column values (see `parse_line`) for loading."""
+        if self._started is None:
+            self._begin()
+        row = row[:len(self.columns)]
+        if self.engine == 'mysql':
+            self._tsv.write(str.join('\t', [ tsv_field(value) for value in row ]) + '\n')
+        else:
+            self._rows.append(row)
+            if len(self._rows) >= self.batch_size:
+                self._insert()
+        self.loaded += 1
+        if self.last_date is None or row[1] > self.last_date:
+            self.last_date = row[1]
+
+    def _begin(self):
+        t = time.time()
+        drop_accounting_indexes(self.db, self.engine, self.version)
+        self.conn.commit()
+        if self.engine == 'mysql':
+            fd, self._tsv_name = tempfile.mkstemp(prefix='pbslogs2sql.', suffix='.tsv')
+            self._tsv = os.fdopen(fd, 'wb', READ_BUFFER)
+        else:
+            self.db.execute("PRAGMA synchronous")
+            self._synchronous = self.db.fetchone()[0]
+            self.db.execute("PRAGMA synchronous=OFF")
+        self._started = time.time()
+        self.timings.append(('drop indexes', self._started - t))
+
+    def _insert(self):
+        self.db.executemany("REPLACE INTO accounting (%s) VALUES (%s)"
+                            % (str.join(",", self.columns),
+                               str.join(",", [PARAM] * len(self.columns))),
+                            self._rows)
+        self._rows = []
+
+    def flush(self):
+        """Load all records, rebuild the indexes and rollup tables, and
+        commit.  Only the first call after records were added does so."""
+        if self._started is None:
+            if self.checkpoints:
+                BulkWriter.flush(self)
+            return
+        if self.engine == 'mysql':
+            self._tsv.close()
+            try:
+                self.db.execute("LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE accounting"
+                                " FIELDS TERMINATED BY '\\t' (%s)"
+                                % (PARAM, str.join(",", self.columns)),
+                                (self._tsv_name,))
+            finally:
+                os.remove(self._tsv_name)
+            if self.version >= 3:
+                # on a partitioned table, the primary key is `(jobid,
+                # date)` (see `partition_by_month`), so `REPLACE` keeps
+                # the old record of a job whose date has changed
+                self.db.execute("DELETE a FROM accounting a JOIN accounting b"
+                                " ON a.jobid=b.jobid AND a.date<b.date")
+        else:
+            self._insert()
+        self.conn.commit()
+        t = time.time()
+        self.timings.append(('load', t - self._started))
+        create_accounting_indexes(self.db, self.engine, self.version)
+        self.conn.commit()
+        self.timings.append(('create indexes', time.time() - t))
+        t = time.time()
+        update_watermark(self.db, self.last_date)
+        rebuild_rollup(self.db)
+        self.timings.append(('rebuild rollup', time.time() - t))
+        self._started = None
+        # writes the checkpoints, if any (there are none for
+        # compressed logs), and commits
+        BulkWriter.flush(self)
+        self.conn.commit()
+        if self.engine != 'mysql':
+            # cannot be changed within a transaction
+            self.db.execute("PRAGMA synchronous=%d" % self._synchronous)
+
+    def report(self, output=sys.stdout):
+        """Write the number of records loaded, and the time taken by
+        each step, to stream `output`."""
+        output.write("Bulk-loaded %d records: %s\n"
+                     % (self.loaded, str.join(", ", [ "%s %.2fs" % timing
+                                                      for timing in self.timings ])))
+
+
+def tsv_field(value):
+    """Format `value` for ``LOAD DATA INFILE``, with the default
+    escaping rules of MySQL."""
+    if value is None:
+        return '\\N'
+    value = str(value)
+    if '\\' in value or '\t' in value or '\n' in value:
+        value = value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+    return value
+
+
+def check_checkpoint(logfile, inode, offset, digest):
+    """
+    Return `offset` if the checkpoint `(inode, offset, digest)` is
+    still valid for `logfile`, or 0 otherwise.
+    """
+    st = os.fstat(logfile.fileno())
+    if inode != st.st_ino or offset > st.st_size:
+        return 0
+    # check that the file still has the same contents up to
+    # `offset`, by comparing the last line before it
+    start = max(0, offset - 65536)
+    logfile.seek(start)
+    lines = logfile.read(offset - start).splitlines(True)
+    if (not lines) or (start > 0 and len(lines) < 2) \
+           or md5(lines[-1]).hexdigest() != digest:
+        return 0
+    return offset
+
+
+def parse_lines(logfile, offset, seen=None):
+    """
+    Read complete lines from `logfile`, which is positioned at byte
+    `offset`, and yield a triple `(offset, line, row)` for each one:
+    `offset` is the position just past `line`, and `row` is the
+    tuple of DB column values for a job exit record, or `None` if
+    the line is not one (or is incomplete, or `seen` is a
+    `JobFilter` that knows it already).
+    """
+    while True:
+        line = logfile.readline()
+        if not line.endswith('\n'):
+            # EOF, or last line still being written by PBS: it will
+            # be read again on the next run
+            break
+        offset += len(line)
+        if seen is not None and line[19:22] == ';E;' and seen.seen(line):
+            yield offset, line, None
+            continue
+        yield offset, line, parse_record(line)
+
+
+def parse_record(line):
+    """Same as `parse_line`, but report incomplete records on
+    standard error and return `None` for them."""
+    try:
+        return parse_line(line)
+    except ValueError, x:
+        timestamp, kind, jobid, attrs = line.split(";", 3)
+        sys.stderr.write("Incomplete record: job %s at %s: %s\n" % (jobid, timestamp, x))
+        return None
+
+
+# size of the read buffer for log files
+READ_BUFFER = 1024*1024
+
+# compressed file formats: name, file name extension and magic bytes
+COMPRESSION = [
+    ('gzip', '.gz', '\x1f\x8b'),
+    ('bzip2', '.bz2', 'BZh'),
+    ('xz', '.xz', '\xfd7zXZ\x00'),
+    ]
+
+def compression(filename, head):
+    """
+    Return the name of the compression format of file `filename`,
+    whose first bytes are `head`, or `None` if it is not compressed.
+    The file name extension is checked first, then the magic bytes.
+    """
+    for name, ext, magic in COMPRESSION:
+        if filename.endswith(ext):
+            return name
+    for name, ext, magic in COMPRESSION:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+class PipeReader(object):
+    """Read the output of command `args`; raise `IOError` on close
+    if the command failed."""
+
+    def __init__(self, args):
+        self.args = args
+        self.proc = subprocess.Popen(args, bufsize=READ_BUFFER, stdout=subprocess.PIPE)
+        self.read = self.proc.stdout.read
+        self.readline = self.proc.stdout.readline
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.wait() != 0:
+            raise IOError("Command '%s' exited with code %d"
+                          % (str.join(" ", self.args), self.proc.returncode))
+
+
+def open_log(filename):
+    """
+    Open the PBS accounting log `filename` for reading, decompressing
+    it on the fly if needed.  Return a pair `(logfile, compressed)`.
+    """
+    logfile = open(filename, 'rb', READ_BUFFER)
+    kind = compression(filename, logfile.read(6))
+    logfile.seek(0)
+    if kind is None:
+        return logfile, False
+    elif kind == 'gzip':
+        import gzip, io # Python 2.6+
+        # `GzipFile.readline` is slow, read through a C buffer instead
+        return io.BufferedReader(gzip.GzipFile(fileobj=logfile), READ_BUFFER), True
+    logfile.close()
+    if kind == 'bzip2':
+        import bz2
+        return bz2.BZ2File(filename, 'rb', READ_BUFFER), True
+    else: # xz: no LZMA module in Python 2, use the command-line tool
+        return PipeReader(['xz', '--decompress', '--stdout', filename]), True
+
+
+def expand_args(args):
+    """
+    Return the list of log files named by the command-line arguments
+    `args`: a directory stands for all the files in it, and shell
+    glob patterns are expanded (both in file name order, which is
+    the chronological order for TORQUE's ``YYYYMMDD`` names).
+    """
+    filenames = []
+    for arg in args:
+        if os.path.isdir(arg):
+            filenames.extend(sorted([ os.path.join(arg, name) for name in os.listdir(arg)
+                                      if os.path.isfile(os.path.join(arg, name)) ]))
+        elif os.path.exists(arg):
+            filenames.append(arg)
+        else:
+            matches = glob.glob(arg)
+            if matches:
+                filenames.extend(sorted(matches))
+            else:
+                # let `open` complain about it
+                filenames.append(arg)
+    return filenames
+
+
+def open_logfile(writer, filename, rescan=False):
+    """
+    Open the PBS accounting log `filename` and return a tuple
+    `(path, logfile, inode, start)`, where `start` is the offset
+    reading should start from.  A file that has already been read
+    by `writer` is read on from where it stopped; otherwise, unless
+    `rescan` is true, reading starts where the previous run left off.
+
+    Compressed files are always read in full, since they are no
+    longer being written to; `inode` is `None` for them, meaning
+    that no checkpoint is kept.
+    """
+    filename = os.path.abspath(filename)
+    logfile, compressed = open_log(filename)
+    if compressed:
+        return filename, logfile, None, 0
+    st = os.fstat(logfile.fileno())
+    inode = st.st_ino
+    position = writer.positions.get(filename)
+    if position is not None and position[0] == inode and position[1] <= st.st_size:
+        # already read in this run, possibly not yet committed
+        start = position[1]
+    elif rescan:
+        start = 0
+    else:
+        start = writer.find_checkpoint(filename, logfile)
+    logfile.seek(start)
+    return filename, logfile, inode, start
+
+
+def ingest(writer, filename, rescan=False):
+    """
+    Parse the PBS accounting log `filename` and queue its job exit
+    records in `writer`, starting at the position determined by
+    `open_logfile`.  Return the number of bytes read.
+    """
+    filename, logfile, inode, start = open_logfile(writer, filename, rescan)
+    offset = start
+    for offset, line, row in parse_lines(logfile, start, writer.seen):
+        if row is not None:
+            writer.add(row)
+        if inode is not None:
+            writer.checkpoint(filename, inode, offset, line)
+    logfile.close()
+    return offset - start
+
+
+def start_positions(writer, filenames, rescan=False):
+    """Return the list of `(filename, start)` pairs telling where
+    reading of each of `filenames` should start (see `open_logfile`)."""
+    tasks = []
+    for filename in filenames:
+        filename, logfile, inode, start = open_logfile(writer, filename, rescan)
+        logfile.close()
+        tasks.append((filename, start))
+    return tasks
+
+
+def reopen_log(filename, start):
+    """Open log `filename`, positioned at byte `start`, as planned
+    by `start_positions`.  Return a pair `(logfile, inode)`; `inode`
+    is `None` for compressed files (see `open_logfile`)."""
+    logfile, compressed = open_log(filename)
+    if compressed:
+        return logfile, None
+    logfile.seek(start)
+    return logfile, os.fstat(logfile.fileno()).st_ino
+
+
+def parse_file(task):
+    """
+    Parse the PBS accounting log `filename` from byte `start` on,
+    where `task` is the tuple `(filename, start)`.  Return a tuple
+    `(filename, inode, offset, line, rows)`, where `offset` is the
+    position past the last line read, `line` is that line, and
+    `rows` is the list of parsed job records; `inode` is `None` for
+    compressed files (see `open_logfile`).
+
+    This is run in worker processes by `ingest_parallel`.
+    """
+    filename, start = task
+    logfile, inode = reopen_log(filename, start)
+    offset, line, rows = start, None, []
+    for offset, line, row in parse_lines(logfile, start):
+        if row is not None:
+            rows.append(row)
+    logfile.close()
+    return filename, inode, offset, line, rows
+
+
+def ingest_parallel(writer, filenames, jobs, rescan=False):
+    """
+    Parse the PBS accounting logs `filenames` in a pool of `jobs`
+    worker processes, and queue the resulting records in `writer`
+    in the order the files are given, so that the outcome is the
+    same as calling `ingest` on each file in turn.
+
+    At most `jobs` + `PIPELINE_DEPTH` files are parsed ahead of the
+    one being written, so that the parsed records waiting for a slow
+    DB do not pile up in memory.
+    """
+    import multiprocessing # Python 2.6+
+    tasks = start_positions(writer, filenames, rescan)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # results of the files submitted to the pool, in order
+        pending = []
+        n = 0
+        while n < len(tasks) or pending:
+            while n < len(tasks) and len(pending) < jobs + PIPELINE_DEPTH:
+                pending.append(pool.apply_async(parse_file, (tasks[n],)))
+                n += 1
+            filename, inode, offset, line, rows = pending.pop(0).get()
+            for row in rows:
+                # workers have no DB connection: filter here
+                if writer.seen is None or not writer.seen.contains(row[1], row[19]):
+                    writer.add(row)
+            if inode is not None and line is not None:
+                writer.checkpoint(filename, inode, offset, line)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# number of items (chunks of log lines, resp. lists of parsed rows)
+# that may wait between two stages of the ingest pipeline, see
+# `ingest_pipelined`; a stage that gets this far ahead of the next
+# one blocks until that catches up
+PIPELINE_DEPTH = 8
+
+# marks the end of the items in a pipeline queue
+END = None
+
+
+class PipelineCancelled(Exception):
+    """Raised within a stage of the ingest pipeline when another
+    stage has failed."""
+    pass
+
+
+class StageStats(object):
+    """
+    Throughput of one stage of the ingest pipeline: the number of
+    items and bytes it has processed, the time it spent waiting for
+    input (`starved`) and waiting for the next stage to accept its
+    output (`blocked`), and the depth of its output queue, sampled
+    each time an item is put in it.
+    """
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.depth_max = 0
+
+    def busy(self):
+        """Return the seconds the stage spent working."""
+        return max(0.0, self.elapsed - self.starved - self.blocked)
+
+    def report(self, output=sys.stdout):
+        """Write the statistics to stream `output`, in two lines."""
+        busy = self.busy()
+        if busy > 0:
+            rate = "%.0f %s/s" % (self.items / busy, self.unit)
+            if self.bytes:
+                rate += ", %.1f MB/s" % (self.bytes / busy / (1024*1024))
+        else:
+            rate = "-"
+        output.write("%-6s %9d %-6s busy %7.2fs (%s)  starved %7.2fs  blocked %7.2fs\n"
+                     % (self.name, self.items, self.unit,
+                        busy, rate, self.starved, self.blocked))
+        if self.depth_samples:
+            output.write("%-6s output queue depth: average %.1f, max %d of %d\n"
+                         % ('', float(self.depth_total) / self.depth_samples,
+                            self.depth_max, PIPELINE_DEPTH))
+
+
+class Pipeline(object):
+    """
+    Bounded queues and the cancellation flag shared by the stages of
+    the ingest pipeline.  A stage that fails records the exception
+    and cancels the pipeline: the other stages then stop at their
+    next `get` or `put`, and `ingest_pipelined` re-raises the
+    exception in the main thread.
+    """
+
+    def __init__(self):
+        self.lines = Queue.Queue(PIPELINE_DEPTH)
+        self.rows = Queue.Queue(PIPELINE_DEPTH)
+        self.cancelled = threading.Event()
+        self.errors = []
+
+    def get(self, queue, stats):
+        t = time.time()
+        while True:
+            if self.cancelled.isSet():
+                raise PipelineCancelled()
+            try:
+                item = queue.get(True, 0.1)
+                break
+            except Queue.Empty:
+                pass
+        stats.starved += time.time() - t
+        return item
+
+    def put(self, queue, item, stats):
+        t = time.time()
+        while True:
+            if self.cancelled.isSet():
+                raise PipelineCancelled()
+            try:
+                queue.put(item, True, 0.1)
+                break
+            except Queue.Full:
+                pass
+        stats.blocked += time.time() - t
+        depth = queue.qsize()
+        stats.depth_total += depth
+        stats.depth_samples += 1
+        stats.depth_max = max(stats.depth_max, depth)
+
+    def fail(self):
+        """Record the exception being handled, and stop all stages."""
+        self.errors.append(sys.exc_info())
+        self.cancelled.set()
+
+    def run_stage(self, fn, stats, *args):
+        """Run stage function `fn` (in a thread), recording the
+        elapsed time in `stats`, and any exception as a failure."""
+        t = time.time()
+        try:
             try:
-                key = Record.ATTRS_TO_COLUMNS_MAP[key]
-            except KeyError: # no mapping, keep "key" unchanged
+                fn(self, stats, *args)
+            except PipelineCancelled:
                 pass
-            if key is not None:
-                setattr(self, key, val)
-
-        # check required fields
-        for attr in ['used_mem', 'used_vmem', 'used_cputime', 'used_walltime']:
-            if not hasattr(self, attr):
-                raise ValueError("missing required attribute '%s'" % attr)
-
-        # only keep hostname for WNs
-        self.wn = self.wn.split(".")[0]
-
-        # convert group names to VO names
-        self.vo, self.role = creds_to_vo_and_role_map(self.user, self.group)
-                
-        # convert memory units
-        def to_bytes(val):
-            if 'b' != val[-1]:
-                return int(val)
-            val = val[:-1] # strip off last char
-            if 'k' == val[-1]:
-                return int(val[:-1]) * 1024
-            elif 'm' == val[-1]:
-                return int(val[:-1]) * 1024 * 1024
-            elif 'g' == val[-1]:
-                return int(val[:-1]) * 1024 * 1024 * 1024
-            return int(val)
-        for attr in ['req_mem', 'used_mem', 'used_vmem']:
-            setattr(self, attr, to_bytes(getattr(self, attr)))
-
-        # convert time units
-        def to_seconds(val):
-            hrs, mins, secs = val.split(":")
-            return (int(hrs)*3600 + int(mins)*60 + int(secs))
-        for attr in ['req_cputime', 'req_walltime', 'used_cputime', 'used_walltime']:
-            setattr(self, attr, to_seconds(getattr(self, attr)))
-
-
-    def write(self, db):
-        db.execute("REPLACE"
-               " INTO accounting (jobid, date, timestamp, user, vo, role, queue, start_time, end_time, wn, req_cputime, req_walltime, req_mem, used_cputime, used_walltime, used_mem, used_vmem, exit_status)"
-               " VALUES ('%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s', '%s')"
-               % (self.jobid, self.date, self.timestamp, self.user, self.vo, self.role, self.queue, self.start_time, self.end_time, self.wn, self.req_cputime, self.req_walltime, self.req_mem, self.used_cputime, self.used_walltime, self.used_mem, self.used_vmem, self.exit_status))
-
-
-# let's go
-for filename in args:
-    logfile = open(filename, 'r')
-    for line in logfile:
-        timestamp, kind, jobid, attrs = line.split(";")
-        if kind != 'E':
-            continue # with next line
+            except:
+                self.fail()
+        finally:
+            stats.elapsed = time.time() - t
+
+
+def read_stage(pipeline, stats, tasks):
+    """
+    Read the log files in `tasks` (see `start_positions`) in chunks
+    of `READ_BUFFER` bytes, and put tuples `(filename, inode, offset,
+    chunk)` in the `lines` queue, where `chunk` holds complete lines
+    only and `offset` is the position just past it.
+    """
+    for filename, start in tasks:
+        logfile, inode = reopen_log(filename, start)
+        try:
+            offset = start
+            rest = ''
+            while True:
+                data = logfile.read(READ_BUFFER)
+                if not data:
+                    # an incomplete last line is left for the next run,
+                    # as in `parse_lines`
+                    break
+                stats.bytes += len(data)
+                data = rest + data
+                end = data.rfind('\n') + 1
+                rest = data[end:]
+                if end > 0:
+                    offset += end
+                    stats.items += 1
+                    pipeline.put(pipeline.lines, (filename, inode, offset, data[:end]), stats)
+        finally:
+            logfile.close()
+    pipeline.put(pipeline.lines, END, stats)
+
+
+def parse_stage(pipeline, stats):
+    """
+    Parse the chunks of log lines from the `lines` queue, and put
+    tuples `(filename, inode, offset, line, rows)` in the `rows`
+    queue, where `rows` is the list of job records in the chunk and
+    `line` is its last line, for the checkpoint.
+    """
+    while True:
+        item = pipeline.get(pipeline.lines, stats)
+        if item is END:
+            break
+        filename, inode, offset, chunk = item
+        stats.bytes += len(chunk)
+        lines = chunk.split('\n')
+        lines.pop() # empty string after the last newline
+        stats.items += len(lines)
+        rows = []
+        for line in lines:
+            if line[19:22] == ';E;':
+                row = parse_record(line)
+                if row is not None:
+                    rows.append(row)
+        pipeline.put(pipeline.rows, (filename, inode, offset, lines[-1] + '\n', rows), stats)
+    pipeline.put(pipeline.rows, END, stats)
+
+
+def write_stage(pipeline, stats, writer):
+    """
+    Queue the rows from the `rows` queue in `writer`, together with
+    the file checkpoints, and flush it.  Records already in the DB
+    (see `JobFilter`) are left out here, since only this stage may
+    use the DB connection.
+    """
+    seen = writer.seen
+    while True:
+        item = pipeline.get(pipeline.rows, stats)
+        if item is END:
+            break
+        filename, inode, offset, line, rows = item
+        for row in rows:
+            if seen is None or not seen.contains(row[1], row[19]):
+                stats.items += 1
+                writer.add(row)
+        if inode is not None:
+            writer.checkpoint(filename, inode, offset, line)
+    writer.flush()
+
+
+def ingest_pipelined(writer, filenames, rescan=False, report=sys.stdout):
+    """
+    Load the PBS accounting logs `filenames` into `writer` through a
+    pipeline of three stages, connected by bounded queues: a reader
+    thread (see `read_stage`), a parser thread (`parse_stage`) and
+    the DB writer (`write_stage`), which runs in the calling thread
+    as DB connections may not be shared among threads.  So file I/O,
+    parsing and DB round-trips overlap.  At the end, the throughput
+    of each stage is written to stream `report`, if not `None`.
+    """
+    tasks = start_positions(writer, filenames, rescan)
+    pipeline = Pipeline()
+    stats = [ StageStats('read', 'chunks'),
+              StageStats('parse', 'lines'),
+              StageStats('write', 'rows') ]
+    threads = [
+        threading.Thread(target=pipeline.run_stage, args=(read_stage, stats[0], tasks)),
+        threading.Thread(target=pipeline.run_stage, args=(parse_stage, stats[1])),
+        ]
+    for thread in threads:
+        # do not keep the process alive if the main thread dies
+        thread.setDaemon(True)
+        thread.start()
+    pipeline.run_stage(write_stage, stats[2], writer)
+    # the other stages are done by now, unless the writer failed
+    pipeline.cancelled.set()
+    for thread in threads:
+        thread.join()
+    if pipeline.errors:
+        t, v, tb = pipeline.errors[0]
+        raise t, v, tb
+    if report is not None:
+        for stage in stats:
+            stage.report(report)
+        report.write("Slowest stage: %s\n"
+                     % max([ (stage.busy(), stage.name) for stage in stats ])[1])
+    return stats
+
+
+def newest_logfile(directory):
+    """
+    Return the path to the most recent TORQUE accounting file
+    (named after the date, as in ``20091123``) in `directory`,
+    or `None` if there is none.
+    """
+    names = [ name for name in os.listdir(directory)
+              if len(name) == 8 and name.isdigit() ]
+    if not names:
+        return None
+    return os.path.join(directory, max(names))
+
+
+def follow(writer, directory, poll_interval, flush_interval, rescan=False):
+    """
+    Load new job records from the TORQUE accounting files in
+    `directory` as they are written, switching to the new file when
+    the daily file rolls over.  Buffered records are written to the
+    DB at least every `flush_interval` seconds.  Return (after
+    flushing the buffer) when SIGTERM or SIGINT is received.
+    """
+    stop = []
+    def terminate(signum, frame):
+        stop.append(signum)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    current = None
+    last_flush = time.time()
+    while not stop:
+        latest = newest_logfile(directory)
+        if latest != current:
+            if current is not None:
+                # pick up the records written just before the rollover
+                ingest(writer, current)
+            current = latest
+        if current is not None:
+            ingest(writer, current, rescan)
+        if time.time() - last_flush >= flush_interval:
+            writer.flush()
+            last_flush = time.time()
+        if not stop:
+            # returns early if interrupted by a signal
+            time.sleep(poll_interval)
+    writer.flush()
+
+
+def run(parser, options, args, writer):
+    """Load the log files as requested on the command line into `writer`."""
+    if options.pipeline and (options.follow or options.jobs > 1):
+        parser.error("Option --pipeline cannot be used together with --follow or --jobs")
+    if options.bulk_load and options.follow:
+        parser.error("Option --bulk-load cannot be used together with --follow")
+    if options.follow:
+        if len(args) > 1:
+            parser.error("Option --follow takes exactly one argument: the accounting directory")
+        elif len(args) == 1:
+            directory = args[0]
+        else:
+            directory = '/var/spool/pbs/server_priv/accounting'
+        follow(writer, directory,
+               options.poll_interval, options.flush_interval, options.rescan)
+    elif options.jobs > 1:
+        ingest_parallel(writer, expand_args(args), options.jobs, options.rescan)
+    elif options.pipeline:
+        ingest_pipelined(writer, expand_args(args), options.rescan)
+    else:
+        for filename in expand_args(args):
+            ingest(writer, filename, options.rescan)
+
+
+## main
+
+def main():
+    # parse command line
+    parser = OptionParser()
+    parser.add_option("-f", "--config", dest="config_file", default=None,
+                      help="read DB connection parameters from this file (overrides other command-line options")
+    parser.add_option("-c", "--create-table", dest="create", 
+                      action="store_true", default=False,
+                      help="Create DB table to hold accounting data")
+    parser.add_option("-M", "--migrate", dest="migrate",
+                      action="store_true", default=False,
+                      help="Upgrade the DB schema to the latest version")
+    parser.add_option("--explain", dest="explain",
+                      action="store_true", default=False,
+                      help="Print the execution plans of typical queries (before and after --migrate)")
+    parser.add_option("-r", "--rebuild-rollup", dest="rebuild_rollup",
+                      action="store_true", default=False,
+                      help="Recompute the daily rollup table from the accounting table")
+    parser.add_option("-m", "--mapping", dest="mapping", default=None, metavar="FILE",
+                      help="Replace the UNIX user/group to VO/role mapping rules in the DB with those in FILE")
+    parser.add_option("--remap", dest="remap",
+                      action="store_true", default=False,
+                      help="Recompute VO and role of all jobs in the DB with the current mapping rules")
+    parser.add_option("-e", "--db-engine", dest="engine", default="mysql",
+                      help="which database backend to use: mysql/sqlite/columnar")
+    parser.add_option("-D", "--db", dest="db",
+                      help="connect to database DB", metavar="DB")
+    parser.add_option("-H", "--host", dest="host",
+                      help="database server host")
+    parser.add_option("-u", "--user", dest="user", default="testme",
+                      help="user for connecting to the database")
+    parser.add_option("-p", "--password", dest="passwd", default="TheVerySecretPassword",
+                      help="password to connect to database")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=1000,
+                      help="write parsed records to the DB (and commit) in batches of this size")
+    parser.add_option("-R", "--rescan", dest="rescan",
+                      action="store_true", default=False,
+                      help="ignore saved checkpoints and parse log files from the beginning")
+    parser.add_option("--force", dest="force",
+                      action="store_true", default=False,
+                      help="write all records, even those already in the DB unchanged")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="parse this many log files in parallel (not with --follow)")
+    parser.add_option("--bulk-load", dest="bulk_load",
+                      action="store_true", default=False,
+                      help="reload all records in one go with the DB's bulk loader,"
+                      " rebuilding indexes and rollup tables at the end (implies --rescan and --force)")
+    parser.add_option("-P", "--pipeline", dest="pipeline",
+                      action="store_true", default=False,
+                      help="read, parse and write to the DB in concurrent stages,"
+                      " and report the throughput of each stage (not with --follow or --jobs)")
+    parser.add_option("-F", "--follow", dest="follow",
+                      action="store_true", default=False,
+                      help="keep running, loading new records from the newest file in the accounting directory given as argument")
+    parser.add_option("--poll-interval", dest="poll_interval", type="float", default=5,
+                      help="in --follow mode, check for new data every this many seconds")
+    parser.add_option("--flush-interval", dest="flush_interval", type="float", default=60,
+                      help="in --follow mode, write buffered records to the DB at least every this many seconds")
+    (options, args) = parser.parse_args()
+    if options.bulk_load:
+        # the indexes and rollup tables are rebuilt from what is loaded
+        options.rescan = True
+        options.force = True
+
+    # import SQL
+    if options.engine == 'mysql':
+        import MySQLdb as sql
+        from MySQLdb.constants import CLIENT
+        if options.host is None:
+            options.host = 'localhost'
+        if options.db is None:
+            options.db = 'pbs'
+    elif options.engine == 'sqlite':
         try:
-            Record(jobid, timestamp, attrs).write(db)
-        except ValueError, x:
-            sys.stderr.write("Incomplete record: job %s at %s: %s\n" % (jobid, timestamp, x))
+            import sqlite as sql
+        except ImportError: # no PySQLite 1.x, use the standard library module
+            import sqlite3 as sql
+        if options.db is None:
+            options.db = 'pbs.db'
+    elif options.engine == 'columnar':
+        import colstore
+        if options.db is None:
+            options.db = 'pbs.store'
+        if (options.rebuild_rollup or options.migrate or options.explain
+            or options.mapping or options.remap or options.bulk_load):
+            parser.error("Options --rebuild-rollup, --migrate, --explain, --mapping,"
+                         " --remap and --bulk-load do not apply to the columnar engine")
+    else:
+        parser.error('Unknown value for "--engine" option: %s,'
+                     ' valid values are: mysql, sqlite, columnar' % options.engine)
+
+    if options.config_file:
+        # get configuration options
+        from ConfigParser import SafeConfigParser
+        config = SafeConfigParser()
+        config.read(options.config_file)
+        options.db = config.get('database', 'db')
+        options.user = config.get('database', 'user')
+        options.host = config.get('database', 'host')
+        options.passwd = config.get('database', 'password')
+
+    if options.engine == 'columnar':
+        store = colstore.ColumnStore(options.db, create=options.create)
+        writer = ColumnarWriter(store, options.batch_size)
+        run(parser, options, args, writer)
+        writer.flush()
+        return
 
+    global PARAM, BINARY
+    if sql.paramstyle == 'qmark':
+        PARAM = '?'
+    else: # 'format' (MySQLdb) or 'pyformat' (pysqlite)
+        PARAM = '%s'
+    BINARY = sql.Binary
 
-# done
-if options.engine == 'sqlite':
-    # actually write to DB
+    # initialize DB
+    if options.engine == 'mysql':
+        conn = sql.connect(host=options.host, user=options.user, 
+                           passwd=options.passwd, db=options.db,
+                           # make `rowcount` count the rows an UPDATE
+                           # matches, not those it changes, as SQLite
+                           # does: `update_rollup` and friends insert
+                           # a new row when it is 0
+                           client_flag=CLIENT.FOUND_ROWS,
+                           # needed by `LOAD DATA LOCAL INFILE`, see `BulkLoader`
+                           local_infile=int(options.bulk_load))
+    elif sql.__name__ == 'sqlite3':
+        # transactions are implicit, as with `autocommit=0` below
+        conn = sql.connect(options.db)
+    else: # sqlite
+        conn = sql.connect(options.db, autocommit=0)
+    db = conn.cursor()
+    if options.explain and not options.create:
+        explain(db, options.engine)
+    if options.create or options.migrate:
+        applied = migrate(db, options.engine)
+        conn.commit()
+        if applied:
+            print "Upgraded DB schema to version %d" % applied[-1]
+            if options.explain:
+                explain(db, options.engine)
+    version = schema_version(db)
+    if version < MIGRATIONS[-1][0]:
+        sys.stderr.write("DB schema is at version %d, the latest is %d:"
+                         " upgrade it with option --migrate.\n"
+                         % (version, MIGRATIONS[-1][0]))
+    if options.engine == 'mysql' and version >= 3:
+        # make room for the data of the coming month
+        extend_partitions(db)
+    if version >= 4:
+        global VO_ROLE_MAP
+        if options.mapping:
+            store_vo_role_map(db, read_vo_role_map(options.mapping))
+        VO_ROLE_MAP = load_vo_role_map(db)
+    elif options.mapping or options.remap:
+        parser.error("Options --mapping and --remap need DB schema version 4 or later")
+    if options.remap:
+        unknown = remap(db, VO_ROLE_MAP)
+        if unknown:
+            sys.stderr.write("%d jobs loaded before the UNIX group was stored in the DB"
+                             " could not be remapped; reload their log files to fix them.\n"
+                             % unknown)
+    elif options.rebuild_rollup:
+        rebuild_rollup(db)
     conn.commit()
-db.close()
-conn.close()
+
+    # let's go
+    if options.bulk_load:
+        writer = BulkLoader(conn, options.engine, options.batch_size)
+    else:
+        writer = BulkWriter(conn, options.batch_size)
+        if version >= 5 and not options.force:
+            writer.seen = JobFilter(conn.cursor())
+    run(parser, options, args, writer)
+
+    # done: write the last (partial) batch
+    writer.flush()
+    if options.bulk_load:
+        writer.report()
+    db.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
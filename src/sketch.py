@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+#
+"""
+Mergeable quantile sketches, for the distribution of per-job values
+(wall-clock time, memory, CPU efficiency) over any range of dates.
+
+``pbslogs2sql.py`` keeps one sketch per (date, VO, role, metric) in
+table ``quantile_daily``, and ``joplot.py`` merges the sketches of
+the days and VO/roles in each period and scope to plot percentiles;
+so the cost of a plot depends on the number of days and scopes, not
+on the number of jobs.
+
+The sketch is a DDSketch_: value `x` is counted in bucket
+``ceil(log(x) / log(gamma))``, with ``gamma = (1 + alpha) / (1 -
+alpha)``, and a quantile is estimated by the midpoint of the bucket
+holding the requested rank.  Thus every quantile is within relative
+error `alpha` of the exact value (for the same rank), whatever the
+distribution.  Values smaller than `MIN_VALUE` (e.g., zero) are
+counted apart and estimated as 0.
+
+Buckets are never collapsed: their number is bounded by
+``log(max/min) / log(gamma)`` over the range of non-zero values,
+i.e., about 115 buckets per factor of 10 with the default
+``alpha=0.01``, or at most some 12 kB per sketch for values that
+span 9 orders of magnitude.  Because buckets are plain counts, two
+sketches are merged by adding counts, and a value is removed by
+adding it with count -1; so sketches can be kept up-to-date when a
+job record is replaced.
+
+.. _DDSketch: https://arxiv.org/abs/1908.10693
+"""
+__docformat__ = 'reStructuredText'
+
+
+from math import ceil, log
+import struct
+
+
+# relative accuracy of quantile estimates
+DEFAULT_ALPHA = 0.01
+
+# values below this are counted as zeros
+MIN_VALUE = 1e-9
+
+# serialized header: format version, alpha, count of zeros, number of buckets
+HEADER = struct.Struct('<Bdqi')
+FORMAT_VERSION = 1
+
+
+class DDSketch(object):
+    """
+    A quantile sketch with relative accuracy `alpha` (see module
+    documentation).  Bucket counts may temporarily be negative, as
+    values can be removed by adding them with a negative `count`.
+    """
+
+    def __init__(self, alpha=DEFAULT_ALPHA):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = log(self.gamma)
+        # map bucket index to count
+        self.buckets = {}
+        self.zeros = 0
+
+    def add(self, value, count=1):
+        """Count `value` `count` times; a `None` value is ignored."""
+        if value is None:
+            return
+        if value < MIN_VALUE:
+            self.zeros += count
+            return
+        i = int(ceil(log(value) / self._log_gamma))
+        n = self.buckets.get(i, 0) + count
+        if n == 0:
+            del self.buckets[i]
+        else:
+            self.buckets[i] = n
+
+    def merge(self, other, sign=1):
+        """Add the counts of sketch `other` to this one (or subtract
+        them, if `sign` is -1)."""
+        if other.alpha != self.alpha:
+            raise ValueError("Cannot merge sketches with relative accuracy %g and %g"
+                             % (self.alpha, other.alpha))
+        self.zeros += sign * other.zeros
+        buckets = self.buckets
+        for i, count in other.buckets.iteritems():
+            n = buckets.get(i, 0) + sign * count
+            if n == 0:
+                del buckets[i]
+            else:
+                buckets[i] = n
+
+    def count(self):
+        """Return the number of values in the sketch."""
+        return self.zeros + sum(self.buckets.itervalues())
+
+    def quantile(self, q):
+        """Return an estimate of the `q`-quantile (0 <= q <= 1) of the
+        values in the sketch, or `None` if the sketch is empty."""
+        n = self.count()
+        if n <= 0:
+            return None
+        rank = q * (n - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if rank < seen:
+                break
+        return 2 * self.gamma**i / (self.gamma + 1)
+
+    def to_string(self):
+        """Return a compact binary representation of the sketch."""
+        indexes = sorted(self.buckets)
+        n = len(indexes)
+        return (HEADER.pack(FORMAT_VERSION, self.alpha, self.zeros, n)
+                + struct.pack('<%di' % n, *indexes)
+                + struct.pack('<%dq' % n, *[ self.buckets[i] for i in indexes ]))
+
+    @staticmethod
+    def from_string(data):
+        """Return the sketch serialized into string `data` by `to_string`."""
+        version, alpha, zeros, n = HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError("Unknown sketch format version %d" % version)
+        sketch = DDSketch(alpha)
+        sketch.zeros = zeros
+        offset = HEADER.size
+        indexes = struct.unpack_from('<%di' % n, data, offset)
+        counts = struct.unpack_from('<%dq' % n, data, offset + 4*n)
+        sketch.buckets = dict(zip(indexes, counts))
+        return sketch
+
+
+# names of the per-job values that are sketched, see `job_values`
+METRICS = ['walltime', 'mem', 'efficiency']
+
+def job_values(cputime, walltime, mem):
+    """Return the list of `(metric, value)` pairs for a job with the
+    given used CPU time, wall-clock time and memory; the value is
+    `None` where it cannot be computed.  The efficiency is the ratio
+    of CPU time to wall-clock time."""
+    if cputime is not None and walltime:
+        efficiency = float(cputime) / walltime
+    else:
+        efficiency = None
+    return [ ('walltime', walltime), ('mem', mem), ('efficiency', efficiency) ]